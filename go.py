@@ -9,15 +9,26 @@ common phone numbers, and just about everyone needs a way around bookmarks.
 __author__ = "Saul Pwanson <saul@pwanson.com>"
 __credits__ = "Bill Booth, Bryce Bockman, treebird, Sean Smith, layertwo"
 
+import array
+import ast
 import base64
+import bisect
+import collections
+import contextlib
 import datetime
+import json
+import mmap
 import os
 import pickle
+import queue
 import random
 import re
 import string
+import struct
 import sys
+import threading
 import time
+import signal
 import urllib.request
 import urllib.error
 import urllib.parse
@@ -25,7 +36,20 @@ import configparser
 import cherrypy
 import jinja2
 import shutil
+import sqlite3
 import html
+import http.client
+import http.cookies
+import itertools
+import cProfile
+import hmac
+import io
+import marshal
+import pstats
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 
 config = configparser.ConfigParser()
@@ -45,6 +69,60 @@ except:
 cfg_urlEditBase = ("https://" if cfg_sslEnabled else "http://") + cfg_hostname
 cfg_sslCertificate = config.get('goconfig', 'cfg_sslCertificate')
 cfg_sslPrivateKey = config.get('goconfig', 'cfg_sslPrivateKey')
+cfg_persistence = "pickle"  # pickle | journal | sqlite
+try:
+    cfg_persistence = config.get('goconfig', 'cfg_persistence')
+except:
+    pass
+cfg_fnSqlite = "godb.sqlite"
+try:
+    cfg_fnSqlite = config.get('goconfig', 'cfg_fnSqlite')
+except:
+    pass
+cfg_resolutionCacheSize = 1024
+try:
+    cfg_resolutionCacheSize = config.getint('goconfig', 'cfg_resolutionCacheSize')
+except:
+    pass
+cfg_pageCacheStaleness = 0
+try:
+    cfg_pageCacheStaleness = config.getint('goconfig', 'cfg_pageCacheStaleness')
+except:
+    pass
+cfg_profileEvery = 0
+try:
+    cfg_profileEvery = config.getint('goconfig', 'cfg_profileEvery')
+except:
+    pass
+cfg_profileToken = None
+try:
+    cfg_profileToken = config.get('goconfig', 'cfg_profileToken')
+    if cfg_profileToken == "None":
+        cfg_profileToken = None
+except:
+    pass
+cfg_workers = 1
+try:
+    cfg_workers = config.getint('goconfig', 'cfg_workers')
+except:
+    pass
+cfg_writerPort = 8079
+try:
+    cfg_writerPort = config.getint('goconfig', 'cfg_writerPort')
+except:
+    pass
+cfg_snapshotEvery = 1.0
+try:
+    cfg_snapshotEvery = config.getfloat('goconfig', 'cfg_snapshotEvery')
+except:
+    pass
+cfg_fnMapped = None
+try:
+    cfg_fnMapped = config.get('goconfig', 'cfg_fnMapped')
+    if cfg_fnMapped == "None":
+        cfg_fnMapped = None
+except:
+    pass
 cfg_contactEmail = config.get('goconfig', 'cfg_contactEmail')
 cfg_contactName = config.get('goconfig', 'cfg_contactName')
 cfg_customDocs = config.get('goconfig', 'cfg_customDocs')
@@ -83,7 +161,7 @@ def escapeascii(s):
 
 
 def randomlink():
-    return random.choice([x for x in list(g_db.linksById.values()) if not x.isGenerative() and x.usage()])
+    return g_db.randomLink()
 
 
 def today():
@@ -124,6 +202,40 @@ def prettytime(t):
         return '%d months ago' % int(dt // (30 * 24*3600))
 
 
+def peakRss():
+    """Peak resident set size of this process in MB, or None if unknown."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0  # bytes vs KB
+
+
+class Progress:
+    """Counts lines through an import or export, printing every so often instead of every line."""
+    every = 10000
+
+    def __init__(self, what):
+        self.what = what
+        self.lines = 0
+        self.started = time.time()
+
+    def __repr__(self):
+        return '%s(%s, lines=%s)' % (self.__class__.__name__, self.what, self.lines)
+
+    def tick(self):
+        self.lines += 1
+        if self.lines % self.every == 0:
+            print("  %s %d lines (%.0f lines/s)" % (self.what, self.lines, self.rate()))
+
+    def rate(self):
+        return self.lines / max(time.time() - self.started, 1e-6)
+
+    def report(self):
+        rss = peakRss()
+        print("%s %d lines in %.2fs (%.0f lines/s), peak RSS %s" % (self.what, self.lines, time.time() - self.started,
+                                                                    self.rate(), "%.1f MB" % rss if rss else "unknown"))
+
+
 def makeList(s):
     if isinstance(s, str):
         return [s]
@@ -168,6 +280,412 @@ def byClicks(links):
     return sorted(links, key=lambda L: (-L.recentClicks, -L.totalClicks))
 
 
+class ClickRanking:
+    """Clickables kept in byClicks() order as they are clicked.
+
+    Ties keep the order the items were added in (items added with
+    front=True go before all others), just like byClicks' stable sort over
+    the original list.  Adding, removing and re-ranking are a bisect plus a
+    list insert/delete.
+    """
+    def __init__(self, items=()):
+        self.entries = []   # sorted [(-recentClicks, -totalClicks, tiebreak, item)]
+        self.entryOf = {}   # item -> its entry
+        self._front = 0     # tiebreak for the next item added at the front
+        self._back = 0      # tiebreak for the next item added at the back
+
+        for item in items:
+            self.add(item)
+
+    def __repr__(self):
+        return '%s(items=%s)' % (self.__class__.__name__, len(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return (entry[-1] for entry in self.entries)
+
+    def __contains__(self, item):
+        return item in self.entryOf
+
+    def add(self, item, front=False):
+        if item in self.entryOf:
+            return
+
+        if front:
+            self._front -= 1
+            tiebreak = self._front
+        else:
+            tiebreak = self._back
+            self._back += 1
+
+        entry = (-item.recentClicks, -item.totalClicks, tiebreak, item)
+        bisect.insort(self.entries, entry)
+        self.entryOf[item] = entry
+
+    def remove(self, item):
+        entry = self.entryOf.pop(item, None)
+        if entry:
+            del self.entries[bisect.bisect_left(self.entries, entry)]
+
+    def update(self, item):
+        """Re-rank item after its clicks changed."""
+        entry = self.entryOf.get(item)
+        if entry is None:
+            return
+
+        newentry = (-item.recentClicks, -item.totalClicks) + entry[2:]
+        if newentry != entry:
+            # insert before deleting, so lock-free readers never see the item missing
+            bisect.insort(self.entries, newentry)
+            del self.entries[bisect.bisect_left(self.entries, entry)]
+            self.entryOf[item] = newentry
+
+    def top(self, n=None):
+        return [entry[-1] for entry in self.entries[:n]]
+
+
+class LinkSet:
+    """A set of links that can also pick a random member in constant time.
+
+    Members are kept in a list with each one's position alongside;
+    discarding moves the last member into the hole.
+    """
+    def __init__(self, items=()):
+        self.items = []
+        self.position = {}  # item -> index in self.items
+
+        for item in items:
+            self.add(item)
+
+    def __repr__(self):
+        return '%s(items=%s)' % (self.__class__.__name__, len(self.items))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items[:])
+
+    def __contains__(self, item):
+        return item in self.position
+
+    def add(self, item):
+        if item not in self.position:
+            self.position[item] = len(self.items)
+            self.items.append(item)
+
+    def discard(self, item):
+        i = self.position.pop(item, None)
+        if i is None:
+            return
+
+        last = self.items.pop()
+        if last is not item:
+            self.items[i] = last
+            self.position[last] = i
+
+    def choice(self):
+        return random.choice(self.items)
+
+
+def searchable(text):
+    """Lowercase text with each run of punctuation and spaces made one space, padded with spaces."""
+    return " %s " % re.sub(r"[\W_]+", " ", text.lower()).strip()
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+    """Trigram index for substring search over the text of links or lists.
+
+    Each trigram maps to an array of the ids of the items whose text
+    contains it.  The arrays are only ever appended to: removing or
+    re-indexing an item leaves its old postings behind, to be skipped
+    because the item's current text no longer matches, until the stale
+    postings outnumber the live ones and the index is rebuilt.
+    Queries of under three characters match at the start of a word.
+    """
+    def __init__(self):
+        self.postings = {}   # trigram -> array('I') of item ids
+        self.texts = {}      # item id -> (item, searchable text)
+        self.ids = {}        # item -> its id; ids aren't reused, so stale postings never match
+        self.nextid = 0
+        self.live = 0        # postings of the current texts
+        self.stale = 0       # postings left behind by removed or changed items
+
+    def __repr__(self):
+        return '%s(items=%s, postings=%s, stale=%s)' % (self.__class__.__name__, len(self.texts),
+                                                        self.live, self.stale)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add(self, item, text):
+        text = searchable(text)
+        itemid = self.ids.get(item)
+        if itemid is None:
+            itemid = self.ids[item] = self.nextid
+            self.nextid += 1
+        old = self.texts.get(itemid)
+        self.texts[itemid] = (item, text)
+        if old is not None and old[1] == text:
+            return
+
+        grams = trigrams(text)
+        for gram in grams:
+            posting = self.postings.get(gram)
+            if posting is None:
+                self.postings[gram] = array.array('I', [itemid])
+            else:
+                posting.append(itemid)
+        self.live += len(grams)
+
+        if old is not None:
+            self._unpost(old[1])
+
+    def remove(self, item):
+        old = self.texts.pop(self.ids.pop(item, None), None)
+        if old is not None:
+            self._unpost(old[1])
+
+    def _unpost(self, text):
+        n = len(trigrams(text))
+        self.live -= n
+        self.stale += n
+        if self.stale > max(self.live, 100000):
+            self._rebuild()
+
+    def _rebuild(self):
+        postings = collections.defaultdict(lambda: array.array('I'))
+        for itemid, (item, text) in list(self.texts.items()):
+            for gram in trigrams(text):
+                postings[gram].append(itemid)
+        self.postings = dict(postings)  # swapped whole, so readers see the old or the new
+        self.stale = 0
+
+    def search(self, query, ranking=None, n=None):
+        """The items whose text contains query (or, for short queries, has a word starting with it).
+
+        With a ClickRanking of the items, just the first n matches in its order.
+        """
+        query = searchable(query).strip()
+        if len(query) < 3:
+            query = " " + query
+        grams = trigrams(query)
+        if not grams:
+            return []
+
+        postings, texts = self.postings, self.texts
+        shortest = min((postings.get(gram, ()) for gram in grams), key=len)
+
+        if ranking is not None and len(shortest) * 8 > len(texts):
+            # most items could match; walk the ranking until n do
+            ret = []
+            for item in ranking:
+                if len(ret) >= n:
+                    break
+                if query in texts.get(self.ids.get(item), (None, ""))[1]:
+                    ret.append(item)
+            return ret
+
+        ret = []
+        for itemid in set(shortest):
+            item, text = texts.get(itemid, (None, ""))
+            if query in text:
+                ret.append(item)
+
+        if ranking is not None:
+            entryOf = ranking.entryOf
+            unranked = (0, 0, sys.maxsize)  # added since the ranking was read
+            ret = sorted(ret, key=lambda item: entryOf.get(item, unranked)[:3])[:n]
+        return ret
+
+    def stats(self):
+        return {"items": len(self.texts), "postings": self.live, "stale": self.stale}
+
+
+def editDistance(a, b):
+    """Levenshtein distance: the fewest single-character inserts, deletes and substitutions from a to b."""
+    if len(a) < len(b):
+        a, b = b, a
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+
+class SpellingIndex:
+    """Words filed under themselves and each of their one-character deletions.
+
+    Two words within one edit of each other (and many within two, like a
+    transposition) share some deletion, so the words near a misspelling
+    are found by looking up its own deletions and checking the few
+    candidates' real edit distance, rather than comparing it to every word.
+    """
+    def __init__(self, words=()):
+        self.deletes = {}   # deletion -> word, or tuple of words, it came from
+        self.words = set()
+
+        for word in words:
+            self.add(word)
+
+    def __repr__(self):
+        return '%s(words=%s, deletes=%s)' % (self.__class__.__name__, len(self.words), len(self.deletes))
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.words
+
+    @staticmethod
+    def variants(word):
+        return {word} | {word[:i] + word[i + 1:] for i in range(len(word))}
+
+    def add(self, word):
+        if word in self.words:
+            return
+        self.words.add(word)
+
+        for v in self.variants(word):
+            have = self.deletes.get(v)
+            if have is None:
+                self.deletes[v] = word   # most have just one; a str is far smaller than a set
+            elif isinstance(have, str):
+                self.deletes[v] = (have, word)
+            else:
+                self.deletes[v] = have + (word, )
+
+    def remove(self, word):
+        if word not in self.words:
+            return
+        self.words.discard(word)
+
+        for v in self.variants(word):
+            have = self.deletes.get(v)
+            if have == word:
+                del self.deletes[v]
+            elif isinstance(have, tuple):
+                rest = tuple(w for w in have if w != word)
+                self.deletes[v] = rest[0] if len(rest) == 1 else rest
+
+    def search(self, word, maxdist=2):
+        """[(distance, word)] for the indexed words other than word itself, within maxdist of it."""
+        candidates = set()
+        for v in self.variants(word):
+            have = self.deletes.get(v)
+            if isinstance(have, str):
+                candidates.add(have)
+            elif have:
+                candidates.update(have)
+        candidates.discard(word)
+
+        ret = []
+        for candidate in candidates:
+            d = editDistance(word, candidate)
+            if d <= maxdist:
+                ret.append((d, candidate))
+        return ret
+
+    def stats(self):
+        return {"words": len(self.words), "deletes": len(self.deletes)}
+
+
+class ResolutionCache:
+    """Bounded LRU of keyword resolutions: key -> (list, target link, url).
+
+    Entries are filed under their list's name, so a change to a list or
+    to one of its links drops just that list's entries.  Every
+    invalidation bumps the epoch; put() refuses a value computed under an
+    older epoch, so a reader racing a writer can't cache a stale target.
+    """
+    maxsize = 1024
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize or self.maxsize
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key -> (LL, target, url)
+        self.keysOf = {}    # list name -> set of keys
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __repr__(self):
+        return '%s(entries=%s, hits=%s, misses=%s)' % (self.__class__.__name__, len(self.entries),
+                                                       self.hits, self.misses)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, epoch):
+        LL = value[0]
+        with self.lock:
+            if epoch != self.epoch:
+                return
+
+            self.entries[key] = value
+            self.keysOf.setdefault(LL.name, set()).add(key)
+            while len(self.entries) > self.maxsize:
+                oldkey, (oldLL, _, _) = self.entries.popitem(last=False)
+                self._unfile(oldLL.name, oldkey)
+
+    def _unfile(self, listname, key):
+        keys = self.keysOf.get(listname)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keysOf[listname]
+
+    def invalidate(self, listname, unless=None):
+        """Drop the entries for listname, except those already resolving to the link unless."""
+        with self.lock:
+            self.epoch += 1
+            for key in list(self.keysOf.get(listname, ())):
+                if self.entries[key][1] is not unless:
+                    del self.entries[key]
+                    self._unfile(listname, key)
+                    self.invalidations += 1
+
+    def invalidateWhere(self, pred):
+        """Drop every entry (LL, target, url) for which pred is true."""
+        with self.lock:
+            self.epoch += 1
+            for key, value in list(self.entries.items()):
+                if pred(*value):
+                    del self.entries[key]
+                    self._unfile(value[0].name, key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.keysOf.clear()
+
+    def stats(self):
+        return {"entries": len(self.entries), "maxsize": self.maxsize,
+                "hits": self.hits, "misses": self.misses, "invalidations": self.invalidations}
+
+
 def getCurrentEditableUrl():
     redurl = cfg_urlEditBase + cherrypy.request.path_info
     if cherrypy.request.query_string:
@@ -218,10 +736,23 @@ def getSSOUsername(redirect=True):
     return user
 
 
+def slotsOf(cls):
+    """All the __slots__ of cls and its bases."""
+    return [name for c in reversed(cls.__mro__) for name in c.__dict__.get("__slots__", ())]
+
+
 class Clickable:
+    # slots instead of a __dict__ per object; pickles hold a dict of the slots not in _unpickled
+    __slots__ = ("archivedClicks", "dayClicks", "_recentClicks", "_lastClickDay")
+    _unpickled = ()
+
+    recentDays = 30  # days of clicks kept per day before they are archived
+
     def __init__(self):
         self.archivedClicks = 0
-        self.clickData = {}
+        self.dayClicks = None    # array('I') of clicks by day % recentDays; None until first clicked
+        self._recentClicks = 0   # sum(dayClicks), kept up to date by clicked()
+        self._lastClickDay = 0   # newest day in dayClicks, which holds the recentDays up to it; 0 if never clicked
 
     def __repr__(self):
         return '%s(archivedClicks=%s, clickData=%s)' % (self.__class__.__name__,
@@ -231,48 +762,106 @@ class Clickable:
     def clickinfo(self):
         return "%s recent clicks (%s total); last visited %s" % (self.recentClicks, self.totalClicks, prettyday(self.lastClickDay))
 
-    def __getattr__(self, attrname):
-        if attrname == "totalClicks":
-            return self.archivedClicks + sum(self.clickData.values())
-        elif attrname == "recentClicks":
-            return sum(self.clickData.values())
-        elif attrname == "lastClickTime":
-            if not self.clickData:
-                return 0
-            maxk = max(self.clickData.keys())
-            return time.mktime(datetime.date.fromordinal(maxk).timetuple())
-        elif attrname == "lastClickDay":
-            if not self.clickData:
-                return 0
-            return max(self.clickData.keys())
-        else:
-            raise AttributeError(attrname)
-
-    def clicked(self, n=1):
+    def __getstate__(self):
+        state = {name: getattr(self, name) for name in slotsOf(type(self))
+                 if name not in self._unpickled and hasattr(self, name)}
+        del state["dayClicks"], state["_recentClicks"]
+        state["clickData"] = self.clickData  # smaller than the array, and what older versions pickled
+        return state
+
+    def __setstate__(self, state):
+        """Load a pickle of this class, or of the older __dict__-based classes."""
+        if isinstance(state, tuple):  # (__dict__, slots) as pickled without __getstate__
+            state = dict(state[0] or {}, **(state[1] or {}))
+
+        slots = slotsOf(type(self))
+        for name, value in state.items():
+            if name in slots:  # anything else is left over from an older version
+                setattr(self, name, value)
+        self._loadClickData(state.get("clickData", {}))
+
+    @property
+    def totalClicks(self):
+        return self.archivedClicks + self._recentClicks
+
+    @property
+    def recentClicks(self):
+        return self._recentClicks
+
+    @property
+    def lastClickDay(self):
+        return self._lastClickDay
+
+    @property
+    def lastClickTime(self):
+        if not self._lastClickDay:
+            return 0
+        return time.mktime(datetime.date.fromordinal(self._lastClickDay).timetuple())
+
+    @property
+    def clickData(self):
+        """{day ordinal: clicks} for the recent days that had clicks."""
+        ring = self.dayClicks
+        if ring is None:
+            return {}
+        last = self._lastClickDay
+        return {day: ring[day % self.recentDays] for day in range(last - self.recentDays + 1, last + 1)
+                if ring[day % self.recentDays]}
+
+    def _loadClickData(self, clickData):
+        """Replace the recent clicks with clickData ({day: clicks}); days too old for them are archived."""
+        self.dayClicks = None
+        self._recentClicks = 0
+        self._lastClickDay = max(clickData, default=0)
+        for day, n in clickData.items():
+            self._addClicks(day, n)
+
+    def _addClicks(self, day, n):
+        ring = self.dayClicks
+        if ring is None:
+            ring = self.dayClicks = array.array("I", [0] * self.recentDays)
+
+        last = self._lastClickDay
+        if day > last:
+            # a new day; archive the ones falling out of the window
+            stale = 0
+            for d in range(max(last + 1, day - self.recentDays + 1), day + 1):
+                stale += ring[d % self.recentDays]
+                ring[d % self.recentDays] = 0
+            self.archivedClicks += stale
+            self._recentClicks -= stale
+            self._lastClickDay = day
+        elif day <= last - self.recentDays:
+            self.archivedClicks += n
+            return
+
+        ring[day % self.recentDays] += n
+        self._recentClicks += n
+
+    def _recountClicks(self):
+        self._recentClicks = sum(self.dayClicks or ())
+
+    def clicksConsistent(self):
+        """Check the running total against the raw dayClicks."""
+        return self._recentClicks == sum(self.dayClicks or ())
+
+    def recountClicks(self):
+        self._recountClicks()
+        self._reranked()
+        return "recounted clicks for %s" % self
+
+    def _reranked(self):
+        """Called whenever the click totals change."""
+        pass
+
+    def clicked(self, n=1, todayord=None):
         """
         :param n: The number of clicks to record
+        :param todayord: The day they were made (default today)
         :return:
         """
-        todayord = today()
-        if todayord not in self.clickData:
-            # partition clickdata around 30 days ago
-            archival = []
-            recent = []
-            for od, nclicks in list(self.clickData.items()):
-                if todayord - 30 > od:
-                    archival.append((od, nclicks))
-                else:
-                    recent.append((od, nclicks))
-
-            # archive older samples
-            if archival:
-                self.archivedClicks += sum(nclicks for od, nclicks in archival)
-
-            # recent will have at least one sample if it was ever clicked
-            recent.append((todayord, n))
-            self.clickData = dict(recent)
-        else:
-            self.clickData[todayord] += n
+        self._addClicks(today() if todayord is None else todayord, n)
+        self._reranked()
 
     def _export(self):
         return "%d,%s" % (self.archivedClicks, "".join(str(self.clickData).split()))
@@ -280,17 +869,105 @@ class Clickable:
     def _import(self, s):
         archivedClicks, clickdict = s.split(",", 1)
         self.archivedClicks = int(archivedClicks)
-        self.clickData = eval(clickdict)
+        self._loadClickData(ast.literal_eval(clickdict))
+        self._reranked()
         return self
 
 
+class UrlTemplate:
+    """A link url parsed once into literal text and {} slots.
+
+    fill() substitutes in a single pass with the same results as
+    string.Formatter().vformat: unknown {name}s are left as they are, and
+    a missing positional arg makes the whole url None.  Urls using format
+    specs, conversions, attribute/index lookups or mixed numbering are
+    formatted by vformat itself.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.parts = []       # literal strings and (positional index or name, ) slots
+        self.named = False    # any {name} slots, i.e. variables are needed
+        self.fallback = False
+
+        try:
+            parsed = list(string.Formatter().parse(url))
+        except (ValueError, TypeError):
+            self.fallback = True
+            return
+
+        auto = manual = 0
+        for literal, field, spec, conversion in parsed:
+            if literal:
+                self.parts.append(literal)
+            if field is None:
+                continue
+            if spec or conversion or "." in field or "[" in field:
+                self.fallback = True
+            elif field == "":
+                self.parts.append((auto, ))
+                auto += 1
+            elif field.isdecimal():
+                self.parts.append((int(field), ))
+                manual += 1
+            else:
+                self.parts.append((field, ))
+                self.named = True
+
+        if auto and manual:
+            self.fallback = True
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.url)
+
+    def fill(self, args, scopes):
+        """Substitute args and the first of scopes (dicts) that has each name."""
+        if self.fallback:
+            d = {}
+            for scope in reversed(scopes):
+                d.update(scope)
+            while True:
+                try:
+                    return string.Formatter().vformat(self.url, args, d)
+                except KeyError as e:
+                    missingKey = e.args[0]
+                    d[missingKey] = "{%s}" % missingKey
+                except IndexError:
+                    return None
+
+        out = []
+        for part in self.parts:
+            if part.__class__ is str:
+                out.append(part)
+                continue
+
+            key = part[0]
+            if key.__class__ is int:
+                if key >= len(args):
+                    return None
+                out.append(format(args[key]))
+                continue
+
+            for scope in scopes:
+                if key in scope:
+                    out.append(format(scope[key]))
+                    break
+            else:
+                out.append("{%s}" % key)
+
+        return "".join(out)
+
+
 class Link(Clickable):
+    __slots__ = ("linkid", "_url", "title", "edits", "lists", "_template")
+    _unpickled = ("_template", )
+
     def __init__(self, linkid=0, url="", title=""):
         Clickable.__init__(self)
 
         self.linkid = linkid
         self._url = canonicalUrl(url)
         self.title = title
+        self._template = None  # UrlTemplate of _url, compiled by url()
 
         self.edits = []    # (edittime, editorname); [-1] is most recent
         self.lists = []    # List() instances
@@ -301,14 +978,26 @@ class Link(Clickable):
                                                                         self.title, self.edits,
                                                                         self.lists)
 
+    def __setstate__(self, state):
+        Clickable.__setstate__(self, state)
+        self._template = None
+        self.edits = [(t, sys.intern(editor)) for t, editor in self.edits]
+
     def isGenerative(self):
         return any([K.isGenerative() for K in self.lists])
 
+    def _reranked(self):
+        for LL in self.lists:
+            LL.ranking.update(self)
+
+        if g_db is not None:
+            g_db.reranked(self)
+
     def listnames(self):
         return [x.name for x in self.lists]
 
-    def _export(self):
-        a = "+".join(self._url.split())
+    def _export(self, url=None):
+        a = "+".join((self._url if url is None else url).split())
         b = "||".join([x.name for x in self.lists]) or "None"
         c = Clickable._export(self)
         d = ",".join(["%d/%s" % (int(ts), name) for ts, name in self.edits]) or "None"
@@ -325,11 +1014,8 @@ class Link(Clickable):
 
     def _import(self, line):
         self._url, lists, clickdata, edits, title = line.split(" ", 4)
-        print(">>", line)
-        print(self._url)
         if self._url in g_db.linksByUrl:
             self._url = g_db.linksByUrl[self._url].linkid
-            print("XYZ", self._url)
 
         if lists != "None":
             for listname in lists.split("||"):
@@ -344,10 +1030,10 @@ class Link(Clickable):
 
         if edits != "None":
             edits = [x.split("/") for x in edits.split(",")]
-            self.edits = [(float(x[0]), x[1]) for x in edits]
+            self.edits = [(float(x[0]), sys.intern(x[1])) for x in edits]
 
-    def editedBy(self, editor):
-        self.edits.append((time.time(), editor))
+    def editedBy(self, editor, when=None):
+        self.edits.append((time.time() if when is None else when, sys.intern(editor)))
 
     def lastEdit(self):
         if not self.edits:
@@ -368,22 +1054,27 @@ class Link(Clickable):
             else:
                 return self._url
 
-    def url(self, keyword=None, args=None):
-        remainingPath = (keyword or cherrypy.request.path_info).split("/")[2:]
-        d = {"*": "/".join(remainingPath), "0": keyword}
-        d.update(g_db.variables)
-        d.update(getDictFromCookie("variables"))
+    def url(self, keyword=None, args=None, path=None, variables=None):
+        """path and variables (from the cookie) default to the current request's."""
+        template = self._template
+        if template is None:
+            template = self._template = UrlTemplate(self._url)
+
+        remainingPath = (keyword or path or cherrypy.request.path_info).split("/")[2:]
+        if template.named or template.fallback:
+            if variables is None:
+                variables = getDictFromCookie("variables")
+            scopes = (variables, g_db.variables,
+                      {"*": "/".join(remainingPath), "0": keyword})
+        else:
+            scopes = ()
 
-        while True:
-            try:
-                return string.Formatter().vformat(self._url, args or remainingPath, d)
-            except KeyError as e:
-                missingKey = e.args[0]
-                d[missingKey] = "{%s}" % missingKey
-            except IndexError:
-                return None
+        return template.fill(args or remainingPath, scopes)
 
     def mainKeyword(self):
+        if g_db is not None and g_db.linksById.get(self.linkid) is self:
+            return g_db.mainKeywords.get(self)
+
         goesStraightThere = [LL for LL in self.lists if LL.goesDirectlyTo(self)]
 
         if not goesStraightThere:
@@ -407,17 +1098,32 @@ class Link(Clickable):
 class ListOfLinks(Link):
     # for convenience, inherits from Link.  most things that apply
     # to Link applies to a ListOfLinks too
+    __slots__ = ("name", "links", "ranking")
+    _unpickled = ("_template", "ranking")
+
     def __init__(self, linkid=0, name="", redirect="freshest"):
         Link.__init__(self, linkid)
-        self.name = name
+        self.name = sys.intern(name)
         self._url = redirect  # list | freshest | top | random
         self.links = []
+        self.ranking = ClickRanking(self.links)
 
     def __repr__(self):
         return '%s(linkid=%s, name=%s, redirect=%s, links=%s)' % (self.__class__.__name__,
                                                                   self.linkid, self.name,
                                                                   self._url, self.links)
 
+    def __getattr__(self, attrname):
+        if attrname == "ranking":
+            # self.links in popularity order; not pickled, so rebuilt on first use
+            self.ranking = ClickRanking(self.links)
+            return self.ranking
+
+        raise AttributeError(attrname)
+
+    def __setstate__(self, state):
+        Link.__setstate__(self, state)
+        self.name = sys.intern(self.name)
 
     def isGenerative(self):
         return self.name[-1] == "/"
@@ -429,13 +1135,15 @@ class ListOfLinks(Link):
         return self.name
 
     def addLink(self, link):
-        if link not in self.links:
+        if link not in self.ranking:  # same members as self.links, without the linear scan
             self.links.insert(0, link)
+            self.ranking.add(link, front=True)
             link.lists.append(self)
 
     def removeLink(self, link):
         if link in self.links:
             self.links.remove(link)
+            self.ranking.remove(link)
         if self in link.lists:
             link.lists.remove(self)
 
@@ -443,7 +1151,7 @@ class ListOfLinks(Link):
         return self.links
 
     def getPopularLinks(self):
-        return byClicks(self.links)
+        return self.ranking.top()
 
     def getLinks(self, nDaysOfRecentEdits=1):
         earliestRecentEdit = time.time() - nDaysOfRecentEdits * 24 * 3600
@@ -457,10 +1165,10 @@ class ListOfLinks(Link):
         return recent, popular
 
     def getDefaultLink(self):
-        if not self._url or self._url == "list":
+        if not self._url or self._url == "list" or not self.links:
             return None
         elif self._url == "top":
-            return self.getPopularLinks()[0]
+            return self.ranking.top(1)[0]
         elif self._url == "random":
             return random.choice(self.links)
         elif self._url == "freshest":
@@ -468,32 +1176,43 @@ class ListOfLinks(Link):
         else:
             return g_db.getLink(self._url)
 
-    def url(self, keyword=None, args=None):
-        if not self._url or self._url == "list":
+    def url(self, keyword=None, args=None, path=None, variables=None):
+        """Like Link.url(), as a list can be a member of another list (e.g. after an import)."""
+        if not self._url or self._url == "list" or not self.links:
             return None
         elif self._url == "top":
-            return self.getPopularLinks()[0].url(keyword, args)
+            return self.ranking.top(1)[0].url(keyword, args, path, variables)
         elif self._url == "random":
-            return random.choice(self.links).url(keyword, args)
+            return random.choice(self.links).url(keyword, args, path, variables)
         elif self._url == "freshest":
-            return self.getRecentLinks()[0].url(keyword, args)
+            return self.getRecentLinks()[0].url(keyword, args, path, variables)
         else:  # should be a linkid
             return "/_link_/" + self._url
 
+    def directLink(self, db=None):
+        """The link this list always redirects straight to, if any; formats no urls."""
+        if not self._url or self._url == "list" or not self.links:
+            return None
+        elif self._url == "top":
+            return self.ranking.top(1)[0]
+        elif self._url == "random":
+            return self.links[0] if len(self.links) == 1 else None
+        elif self._url == "freshest":
+            return self.links[0]
+        elif str(self._url).isdigit():
+            return (db or g_db).getLink(self._url)
+        return None
+
     def goesDirectlyTo(self, link):
-        return self._url == str(link.linkid) or self.url() == link.url()
+        return self.directLink() is link
 
     def _export(self):
-        if isinstance(self._url, int): # linkid needs to be converted for export
-            L = g_db.getLink(self._url)
-            if L and L in self.links:
-                print(L)
-                self._url = L._url
-            else:
-                print("fixing unknown dest linkid for", self.name)
-                self._url = "list"
+        url = self._url
+        if isinstance(url, int):  # linkid needs to be converted for export
+            L = g_db.getLink(url)
+            url = L._url if L and L in self.links else "list"
 
-        return ("list %s " % self.name) + Link._export(self)
+        return ("list %s " % self.name) + Link._export(self, url)
 
     def _import(self, line):
         self.name, _, rest = line.split(" ", 2)
@@ -503,6 +1222,8 @@ class ListOfLinks(Link):
 
 
 class RegexList(ListOfLinks):
+    __slots__ = ("regex", )
+
     def __init__(self, linkid=0, regex=""):
         ListOfLinks.__init__(self, linkid, regex)
 
@@ -518,13 +1239,18 @@ class RegexList(ListOfLinks):
     def isGenerative(self):
         return True
 
-    def matches(self, kw=None):
+    def directLink(self, db=None):
+        return None  # where it goes depends on the keyword
+
+    def matches(self, kw=None, m=None):
+        """m is the match object if the caller already ran the regex (see RegexDispatcher)"""
         if kw is None:
             kw = cherrypy.request.path_info.split("/")[1]
 
         ret = []
 
-        m = re.match(self.regex, kw, re.IGNORECASE)
+        if m is None:
+            m = re.match(self.regex, kw, re.IGNORECASE)
         if m:
             deflink = self.getDefaultLink()
             for L in deflink and [deflink] or self.links:
@@ -553,7 +1279,454 @@ class RegexList(ListOfLinks):
         ListOfLinks._import(self, rest)
 
 
+# characters that can be part of the literal prefix of a regex
+literalchars = string.ascii_letters + string.digits + "-_/=@:%,~"
+
+
+def literalPrefix(regex):
+    """Return the lowercased literal text every match of regex must start with ("" if unknown)."""
+    if "|" in regex:
+        return ""
+
+    if regex.startswith("^"):
+        regex = regex[1:]
+
+    prefix = ""
+    for i, c in enumerate(regex):
+        if c not in literalchars:
+            break
+        if regex[i+1:i+2] in ("?", "*", "{"):  # c is optional
+            break
+        prefix += c
+
+    return prefix.lower()
+
+
+class RegexDispatcher:
+    """Matches a keyword against all RegexLists at once.
+
+    Every regex is compiled once.  Regexes starting with a literal prefix are
+    bucketed by its first character, so a keyword is only tried against the
+    regexes that can possibly match it (plus the few without a prefix).
+
+    add() and remove() build new tables and swap them in as one tuple, so
+    matching never needs a lock.  Each copies the tables, so the regexes of
+    a whole database are added at once (the constructor, addAll(), or add()
+    inside batch()), copying them once.
+    """
+    def __init__(self, regexes=()):
+        # compiled: regex -> (compiled pattern, RegexList)
+        # order: regex -> insertion sequence, to keep g_db.regexes order
+        # byFirstChar: first char of prefix -> {regex: prefix}
+        # unprefixed: frozenset of regexes without a literal prefix
+        self._tables = ({}, {}, {}, frozenset())
+        self._seq = 0
+        self._pending = None  # RegexLists add()ed inside batch()
+
+        self.addAll(regexes)
+
+    def __repr__(self):
+        return '%s(regexes=%s)' % (self.__class__.__name__, len(self))
+
+    def __len__(self):
+        return len(self._tables[0])
+
+    def add(self, R):
+        if self._pending is not None:
+            self._pending.append(R)
+        else:
+            self.addAll([R])
+
+    def addAll(self, regexes):
+        """Add several RegexLists, copying the tables once for all of them."""
+        compiled, order, byFirstChar, unprefixed = tables = self._copy()
+        copied = set()
+        for R in regexes:
+            self._discard(tables, R.regex, copied)
+
+            compiled[R.regex] = (re.compile(R.regex, re.IGNORECASE), R)
+            order[R.regex] = self._seq
+            self._seq += 1
+
+            prefix = literalPrefix(R.regex)
+            if prefix:
+                self._bucket(byFirstChar, prefix[0], copied)[R.regex] = prefix
+            else:
+                unprefixed.add(R.regex)
+
+        self._tables = (compiled, order, byFirstChar, frozenset(unprefixed))
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Hold back add()s until the end of the block, then addAll() them."""
+        self._pending = []
+        try:
+            yield
+        finally:
+            pending, self._pending = self._pending, None
+            self.addAll(pending)
+
+    def remove(self, regex):
+        if regex in self._tables[0]:
+            compiled, order, byFirstChar, unprefixed = tables = self._copy()
+            self._discard(tables, regex, set())
+            self._tables = (compiled, order, byFirstChar, frozenset(unprefixed))
+
+    def _copy(self):
+        """Copies of the tables that are being matched against, to change."""
+        compiled, order, byFirstChar, unprefixed = self._tables
+        return dict(compiled), dict(order), dict(byFirstChar), set(unprefixed)
+
+    @staticmethod
+    def _bucket(byFirstChar, c, copied):
+        """byFirstChar[c] to change, copied first if it still is the one being matched against."""
+        if c not in copied or c not in byFirstChar:
+            byFirstChar[c] = dict(byFirstChar.get(c, {}))
+            copied.add(c)
+        return byFirstChar[c]
+
+    def _discard(self, tables, regex, copied):
+        """Take regex out of a _copy() of the tables."""
+        compiled, order, byFirstChar, unprefixed = tables
+        if regex not in compiled:
+            return
+
+        del compiled[regex]
+        del order[regex]
+
+        prefix = literalPrefix(regex)
+        if prefix:
+            bucket = self._bucket(byFirstChar, prefix[0], copied)
+            del bucket[regex]
+            if not bucket:
+                del byFirstChar[prefix[0]]
+        else:
+            unprefixed.discard(regex)
+
+    def candidates(self, kw, tables=None):
+        compiled, order, byFirstChar, unprefixed = tables or self._tables
+        if not kw.isascii():  # unicode case folding could defeat the prefix check
+            return list(compiled)
+
+        lkw = kw.lower()
+        ret = [r for r, prefix in byFirstChar.get(lkw[:1], {}).items() if lkw.startswith(prefix)]
+        ret.extend(unprefixed)
+        return ret
+
+    def matches(self, kw):
+        """Return [(RegexList, match object)] for every regex matching kw, in insertion order."""
+        tables = self._tables
+        compiled, order = tables[:2]
+
+        ret = []
+        for regex in sorted(self.candidates(kw, tables), key=order.get):
+            pattern, R = compiled[regex]
+            m = pattern.match(kw)
+            if m:
+                ret.append((R, m))
+
+        return ret
+
+
+class Journal:
+    """Append-only log of LinkDatabase mutations, one JSON record per line.
+
+    The snapshot at fn is a pickled LinkDatabase that knows the seq of the
+    last record it includes; records after that are in fn.journal (and in
+    fn.journal.old while a compaction is writing the new snapshot).
+    """
+    maxRecords = 10000  # compact once the journal has this many records
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.fnJournal = fn + ".journal"
+        self.fnOld = self.fnJournal + ".old"
+        self.seq = 0
+        self.nrecords = 0
+        self.fp = None
+
+    def __repr__(self):
+        return '%s(fn=%s, seq=%s, records=%s)' % (self.__class__.__name__, self.fnJournal,
+                                                 self.seq, self.nrecords)
+
+    def records(self):
+        for fn in (self.fnOld, self.fnJournal):
+            if not os.path.exists(fn):
+                continue
+            with open(fn, "r") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:  # torn write at the end of the journal
+                        print("ignoring incomplete journal record in %s" % fn)
+                        break
+
+    def replay(self, db):
+        self.seq = db._journalSeq
+        for rec in self.records():
+            self.nrecords += 1
+            if rec["seq"] <= self.seq:
+                continue
+            db._replay(rec["op"], rec["args"])
+            self.seq = rec["seq"]
+
+    def open(self):
+        self.fp = open(self.fnJournal, "a")
+
+    def record(self, db, op, args, touched):
+        return self.append(op, args)
+
+    def needsCompaction(self):
+        return self.nrecords >= self.maxRecords
+
+    def compact(self, db):
+        with db.lock:
+            db._journalSeq = self.seq
+            data = pickle.dumps(db)
+            self.rotate()
+        # edits can continue while the snapshot is written
+        self.compacted(data)
+        return len(data)
+
+    def append(self, op, args):
+        self.seq += 1
+        line = json.dumps({"seq": self.seq, "op": op, "args": args}) + "\n"
+        self.fp.write(line)
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.nrecords += 1
+        return len(line)
+
+    def rotate(self):
+        """Set the current records aside for a compaction and start an empty journal."""
+        self.fp.close()
+        if os.path.exists(self.fnOld):  # an earlier compaction didn't finish
+            with open(self.fnOld, "a") as old, open(self.fnJournal, "r") as cur:
+                shutil.copyfileobj(cur, old)
+            os.remove(self.fnJournal)
+        else:
+            os.replace(self.fnJournal, self.fnOld)
+        self.nrecords = 0
+        self.open()
+
+    def compacted(self, data):
+        """Write the snapshot taken at rotate() and drop the records it includes."""
+        tmpfile = self.fn + '.tmp'
+        with open(tmpfile, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpfile, self.fn)
+        os.remove(self.fnOld)
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+
+
+class SqliteStore:
+    """Keeps a LinkDatabase in sqlite, one row per link, list, membership and day of clicks.
+
+    Each mutation rewrites only the rows of the links and lists it touched,
+    in one transaction.  The LinkDatabase itself stays in memory (its
+    indexes need every link), so this replaces the pickle, not the objects.
+    """
+    schema = """
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+        CREATE TABLE IF NOT EXISTS links (linkid INTEGER PRIMARY KEY, url TEXT, title TEXT, archived INTEGER);
+        CREATE INDEX IF NOT EXISTS links_url ON links (url);
+        CREATE TABLE IF NOT EXISTS edits (linkid INTEGER, edittime REAL, editor TEXT);
+        CREATE INDEX IF NOT EXISTS edits_linkid ON edits (linkid);
+        CREATE TABLE IF NOT EXISTS lists (listid INTEGER PRIMARY KEY, name TEXT UNIQUE, behavior, title TEXT, archived INTEGER);
+        CREATE TABLE IF NOT EXISTS regexes (regex TEXT PRIMARY KEY, listid INTEGER UNIQUE);
+        CREATE TABLE IF NOT EXISTS memberships (seq INTEGER PRIMARY KEY AUTOINCREMENT, listid INTEGER, linkid INTEGER,
+                                                UNIQUE (listid, linkid));
+        CREATE INDEX IF NOT EXISTS memberships_linkid ON memberships (linkid);
+        CREATE TABLE IF NOT EXISTS variables (name TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS clicks (id INTEGER, day INTEGER, n INTEGER, PRIMARY KEY (id, day));
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.conn = None
+
+    def __repr__(self):
+        return '%s(fn=%s)' % (self.__class__.__name__, self.fn)
+
+    def open(self):
+        # only used with the LinkDatabase lock held, from whichever thread holds it
+        self.conn = sqlite3.connect(self.fn, check_same_thread=False)
+        self.conn.executescript(self.schema)
+
+    def load(self, fnPickle=cfg_fnDatabase):
+        """Return the LinkDatabase in fn, migrating it from the pickle at fnPickle the first time."""
+        exists = os.path.exists(self.fn)
+        self.open()
+
+        if exists:
+            print("Loading DB from %s" % self.fn)
+            db = self.read()
+        else:
+            if os.path.exists(fnPickle):
+                print("Migrating DB from %s to %s" % (fnPickle, self.fn))
+                db = pickle.load(open(fnPickle, 'rb'))
+            else:
+                print("Creating new database...")
+                db = LinkDatabase()
+            self.compact(db)
+
+        db.store = self
+        return db
+
+    def read(self):
+        c = self.conn
+        db = LinkDatabase()
+        db._nextlinkid = c.execute("SELECT value FROM meta WHERE key='nextlinkid'").fetchone()[0]
+        db.variables = dict(c.execute("SELECT name, value FROM variables"))
+
+        regexes = dict(c.execute("SELECT listid, regex FROM regexes"))
+        byId = {}
+        for listid, name, behavior, title, archived in c.execute("SELECT * FROM lists ORDER BY listid"):
+            if listid in regexes:
+                LL = RegexList(listid, regexes[listid])
+                db.regexes[LL.regex] = LL
+            else:
+                LL = ListOfLinks(listid, name)
+            LL.name, LL._url, LL.title, LL.archivedClicks = name, behavior, title, archived
+            db.lists[name] = byId[listid] = LL
+
+        for linkid, url, title, archived in c.execute("SELECT * FROM links ORDER BY linkid"):
+            link = Link(linkid)
+            link._url, link.title, link.archivedClicks = url, title, archived
+            db.linksById[linkid] = byId[linkid] = link
+            db.linksByUrl[url] = link
+
+        for linkid, edittime, editor in c.execute("SELECT * FROM edits ORDER BY rowid"):
+            byId[linkid].edits.append((edittime, sys.intern(editor)))
+
+        # the newest membership goes first in LL.links, last in link.lists
+        for listid, linkid in c.execute("SELECT listid, linkid FROM memberships ORDER BY seq"):
+            LL, link = byId[listid], byId[linkid]
+            LL.links.append(link)
+            link.lists.append(LL)
+        for LL in db.lists.values():
+            LL.links.reverse()
+
+        clickData = collections.defaultdict(dict)
+        for itemid, day, n in c.execute("SELECT * FROM clicks"):
+            clickData[itemid][day] = n
+        for itemid, item in byId.items():
+            item._loadClickData(clickData[itemid])
+
+        db._buildIndexes()
+        return db
+
+    def record(self, db, op, args, touched):
+        """Returns the number of rows written."""
+        nchanges = self.conn.total_changes
+        with self.conn:
+            c = self.conn
+            c.execute("INSERT OR REPLACE INTO meta VALUES ('nextlinkid', ?)", (db._nextlinkid, ))
+            if op == "setvariable":
+                c.execute("INSERT OR REPLACE INTO variables VALUES (?, ?)", args)
+            elif op == "clicks":
+                for item in touched:
+                    self._writeClicks(item)
+            else:
+                for item in touched:
+                    if isinstance(item, ListOfLinks):
+                        self._writeList(db, item)
+                    else:
+                        self._writeLink(db, item)
+        return self.conn.total_changes - nchanges
+
+    def _writeLink(self, db, link):
+        c = self.conn
+        if db.linksById.get(link.linkid) is not link:
+            c.execute("DELETE FROM links WHERE linkid=?", (link.linkid, ))
+            c.execute("DELETE FROM edits WHERE linkid=?", (link.linkid, ))
+            c.execute("DELETE FROM memberships WHERE linkid=?", (link.linkid, ))
+            c.execute("DELETE FROM clicks WHERE id=?", (link.linkid, ))
+            return
+
+        c.execute("INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?)",
+                  (link.linkid, link._url, link.title, link.archivedClicks))
+        c.execute("DELETE FROM edits WHERE linkid=?", (link.linkid, ))
+        c.executemany("INSERT INTO edits VALUES (?, ?, ?)", [(link.linkid, t, name) for t, name in link.edits])
+
+        listids = [LL.linkid for LL in link.lists]
+        c.execute("DELETE FROM memberships WHERE linkid=? AND listid NOT IN (%s)" % ",".join("?" * len(listids)),
+                  [link.linkid] + listids)
+        c.executemany("INSERT OR IGNORE INTO memberships (listid, linkid) VALUES (?, ?)",
+                      [(listid, link.linkid) for listid in listids])
+
+    def _writeList(self, db, LL):
+        c = self.conn
+        if db.lists.get(LL.name) is not LL:
+            c.execute("DELETE FROM lists WHERE listid=?", (LL.linkid, ))
+            c.execute("DELETE FROM regexes WHERE listid=?", (LL.linkid, ))
+            c.execute("DELETE FROM memberships WHERE listid=?", (LL.linkid, ))
+            c.execute("DELETE FROM clicks WHERE id=?", (LL.linkid, ))
+            return
+
+        c.execute("INSERT OR REPLACE INTO lists VALUES (?, ?, ?, ?, ?)",
+                  (LL.linkid, LL.name, LL._url, LL.title, LL.archivedClicks))
+        if isinstance(LL, RegexList):
+            c.execute("INSERT OR REPLACE INTO regexes VALUES (?, ?)", (LL.regex, LL.linkid))
+
+    def _writeClicks(self, item):
+        c = self.conn
+        if isinstance(item, ListOfLinks):
+            c.execute("UPDATE lists SET archived=? WHERE listid=?", (item.archivedClicks, item.linkid))
+        else:
+            c.execute("UPDATE links SET archived=? WHERE linkid=?", (item.archivedClicks, item.linkid))
+        c.execute("DELETE FROM clicks WHERE id=?", (item.linkid, ))
+        c.executemany("INSERT INTO clicks VALUES (?, ?, ?)", [(item.linkid, day, n) for day, n in item.clickData.items()])
+
+    def needsCompaction(self):
+        return False
+
+    def compact(self, db):
+        """Rewrite every row from db.  Returns the number of rows written."""
+        nchanges = self.conn.total_changes
+        self._compact(db)
+        return self.conn.total_changes - nchanges
+
+    def _compact(self, db):
+        with db.lock, self.conn:
+            c = self.conn
+            for table in ("meta", "links", "edits", "lists", "regexes", "memberships", "variables", "clicks"):
+                c.execute("DELETE FROM %s" % table)
+
+            c.execute("INSERT INTO meta VALUES ('nextlinkid', ?)", (db._nextlinkid, ))
+            c.executemany("INSERT INTO variables VALUES (?, ?)", list(db.variables.items()))
+            for LL in db.lists.values():
+                self._writeList(db, LL)
+                c.executemany("INSERT INTO memberships (listid, linkid) VALUES (?, ?)",
+                              [(LL.linkid, link.linkid) for link in reversed(LL.links)])
+                self._writeClicks(LL)
+            for link in db.linksById.values():
+                c.execute("INSERT INTO links VALUES (?, ?, ?, ?)", (link.linkid, link._url, link.title, link.archivedClicks))
+                c.executemany("INSERT INTO edits VALUES (?, ?, ?)", [(link.linkid, t, name) for t, name in link.edits])
+                self._writeClicks(link)
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+
 class LinkDatabase:
+    # not pickled; recreated when loaded
+    _transient = ("regexDispatcher", "ranking", "listRanking", "lock", "store",
+                  "_depth", "_op", "_touched", "_unsavedClicks", "generation", "clickGeneration",
+                  "_savedGeneration", "_savedClickGeneration", "_startGeneration", "saveStats", "resolutions",
+                  "folders", "nonFolders", "targets", "directLists", "mainKeywords", "searches",
+                  "spelling")
+
     def __init__(self):
         self.regexes = {}        # regex -> RegexList
         self.lists = {}          # listname -> ListOfLinks
@@ -561,6 +1734,9 @@ class LinkDatabase:
         self.linksById = {}      # link.linkid -> Link
         self.linksByUrl = {}     # link._url -> Link
         self._nextlinkid = 1
+        self._journalSeq = 0     # last journal record included in this snapshot
+
+        self._initTransient()
 
     def __repr__(self):
         return '%s(regexes=%s, lists=%s, vars=%s, byId=%s, byUrl=%s)' % (self.__class__.__name__,
@@ -569,31 +1745,326 @@ class LinkDatabase:
                                                                          self.linksById,
                                                                          self.linksByUrl)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in self._transient:
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault("_journalSeq", 0)
+        self.__dict__.update(state)
+        self._initTransient()
+
+    def _initTransient(self):
+        self.lock = threading.RLock()  # held by mutations and snapshots
+        self.store = None              # Journal or SqliteStore; None to pickle everything on save()
+        self._depth = 0                # nesting of mutating() blocks
+        self._op = None                # (op, args) of the outermost mutation
+        self._touched = set()          # links and lists changed by the current mutation
+        self._unsavedClicks = set()    # links and lists clicked since the last save()
+
+        # save() is skipped unless these moved since it last ran
+        self.generation = 0            # bumped by every edit
+        self.clickGeneration = 0       # bumped by every click
+        self._savedGeneration = 0
+        self._startGeneration = 0      # generation when the current mutation began
+        self._savedClickGeneration = 0
+        self.saveStats = {"skipped": 0}  # kind of write -> {count, seconds, written, ...}
+        self.resolutions = ResolutionCache(cfg_resolutionCacheSize)
+        self.searches = None           # (lists, links) SearchIndexes, built by the first search()
+        self.spelling = None           # SpellingIndex of list names, built by the first suggest()
+
+        self._buildIndexes()
+
+    def _buildIndexes(self):
+        # built eagerly, so readers never set attributes while a snapshot is being pickled
+        self.regexDispatcher = RegexDispatcher(list(self.regexes.values()))
+        self.ranking = ClickRanking(list(self.linksById.values()))
+        self.listRanking = ClickRanking(list(self.lists.values()))
+        for LL in self.lists.values():
+            LL.ranking = ClickRanking(LL.links)
+
+        # links split by isGenerative(), kept up to date by _relisted()
+        self.folders = LinkSet()
+        self.nonFolders = LinkSet()
+        for link in self.linksById.values():
+            self._relisted(link)
+
+        # which lists go straight to which links, kept up to date by _retarget()
+        self.targets = {}       # ListOfLinks -> its directLink()
+        self.directLists = {}   # link -> set of lists going straight to it
+        self.mainKeywords = {}  # link -> its mainKeyword()
+        for LL in self.lists.values():
+            self._retarget(LL)
+
+    def _relisted(self, link):
+        """File link under folders or nonFolders after its lists changed, or drop it once deleted."""
+        if self.linksById.get(link.linkid) is not link:
+            self.folders.discard(link)
+            self.nonFolders.discard(link)
+        elif link.isGenerative():
+            self.nonFolders.discard(link)
+            self.folders.add(link)
+        else:
+            self.folders.discard(link)
+            self.nonFolders.add(link)
+
+    def _retarget(self, LL):
+        """Re-file where LL goes straight to, after its links, behavior or clicks changed."""
+        with self.lock:
+            old = self.targets.get(LL)
+            new = LL.directLink(self) if self.lists.get(LL.name) is LL else None
+            if new is old:  # touched links are rekeyed by _invalidate()
+                return
+
+            if old is not None:
+                del self.targets[LL]
+                self.directLists[old].discard(LL)
+                if not self.directLists[old]:
+                    del self.directLists[old]
+                self._rekey(old)
+            if new is not None:
+                self.targets[LL] = new
+                self.directLists.setdefault(new, set()).add(LL)
+                self._rekey(new)
+
+    def _rekey(self, link):
+        """Recompute link's main keyword: the most clicked of its lists that go straight to it."""
+        direct = self.directLists.get(link)
+        goesStraightThere = direct and [LL for LL in link.lists if LL in direct]
+        if goesStraightThere and self.linksById.get(link.linkid) is link:
+            self.mainKeywords[link] = byClicks(goesStraightThere)[0]
+        else:
+            self.mainKeywords.pop(link, None)
+
+    def holds(self, item):
+        """Whether the link or list item is this database's (and not e.g. an older snapshot's)."""
+        if isinstance(item, ListOfLinks):
+            return self.lists.get(item.name) is item
+        return self.linksById.get(item.linkid) is item
+
+    def reranked(self, item):
+        """Re-rank a link or list after its clicks changed."""
+        self.ranking.update(item)
+        self.listRanking.update(item)
+        self.clickGeneration += 1
+        for LL in getattr(item, "lists", ()):
+            if LL._url == "top":  # clicks may have changed where it goes
+                self.resolutions.invalidate(LL.name, unless=LL.ranking.top(1)[0])
+                self._retarget(LL)
+        if item in self.targets:  # a list's clicks may change its target's main keyword
+            self._rekey(self.targets[item])
+        if self.store:
+            self._unsavedClicks.add(item)
+
+    @contextlib.contextmanager
+    def mutating(self):
+        """Serialize a mutation; only the outermost one is passed to the store."""
+        with self.lock:
+            self._depth += 1
+            if self._depth == 1:
+                self._startGeneration = self.generation
+            try:
+                yield
+            except:
+                if self._depth == 1:
+                    self._invalidate(self._touched)
+                    self._op, self._touched = None, set()
+                raise
+            finally:
+                self._depth -= 1
+
+            if self._depth == 0:
+                self._invalidate(self._touched)
+                self._commit()
+
+    def _log(self, op, *args):
+        if self._depth == 1:
+            self._op = (op, args)
+
+    def touch(self, *items):
+        """Note that something changed; items are the links and lists changed by the current mutation."""
+        self.generation += 1
+        if self._depth:
+            self._touched.update(items)
+        else:
+            self._invalidate(items)
+
+    def _invalidate(self, items):
+        """Drop cached resolutions through the changed links and lists, and re-index them.
+
+        Inside mutating() this runs once the whole mutation is done, so a
+        reader can't cache a half-applied change.
+        """
+        lists = {item for item in items if isinstance(item, ListOfLinks)}
+        links = [item for item in items if not isinstance(item, ListOfLinks)]
+        for link in links:
+            lists.update(link.lists)
+
+        for LL in lists:
+            self.resolutions.invalidate(LL.name)
+            self._retarget(LL)
+            if self.spelling is not None:
+                self._respell(LL.name)
+        for link in links:
+            self._rekey(link)
+
+        if self.searches is not None:
+            for item in items:
+                self._reindex(item)
+
+    def _commit(self):
+        op, touched = self._op, self._touched
+        self._op, self._touched = None, set()
+        if self.store and op:
+            generation = self.generation
+            start = time.time()
+            written = self.store.record(self, op[0], op[1], touched)
+            self._recordSave("clicks" if op[0] == "clicks" else "edit", time.time() - start, written)
+            # the store has it now, unless it missed an earlier change (one made outside of mutating(), or a
+            # mutation that raised partway); then it stays dirty until save() compacts
+            if op[0] != "clicks" and self._savedGeneration == self._startGeneration:
+                self._savedGeneration = generation
+
+    def _recordSave(self, kind, seconds, written):
+        """written is in bytes, or rows for sqlite"""
+        stats = self.saveStats.setdefault(kind, {"count": 0, "seconds": 0.0, "written": 0})
+        stats["count"] += 1
+        stats["seconds"] += seconds
+        stats["written"] += written
+        stats["lastSeconds"] = seconds
+        stats["lastWritten"] = written
+        stats["lastTime"] = time.time()
+
+    def isDirty(self):
+        """Return (edited, clicked) since the last save."""
+        return (self.generation != self._savedGeneration,
+                self.clickGeneration != self._savedClickGeneration)
+
+    def openJournal(self, fn):
+        """Replay the journal next to the snapshot fn and log further mutations to it."""
+        journal = Journal(fn)
+        journal.replay(self)
+        journal.open()
+        self.store = journal
+        self._buildIndexes()  # replayed clicks may not have reached g_db's rankings
+        print("Replayed %s journal records up to #%s" % (journal.nrecords, journal.seq))
+
+    def _replay(self, op, args):
+        if op == "addlink":
+            lists, url, title, owner, linkid, when = args
+            self.addLink(lists, url, title, owner, linkid=linkid, when=when)
+        elif op == "editlink":
+            linkid, url, title, lists, editor, when = args
+            self.editLink(self.getLink(linkid), url, title, lists, editor, when)
+        elif op == "deletelink":
+            self.deleteLink(self.getLink(args[0]))
+        elif op == "deletelist":
+            self.deleteList(self.lists[args[0]])
+        elif op == "renamelist":
+            self.renameList(self.lists[args[0]], args[1])
+        elif op == "setbehavior":
+            self.setBehavior(self.lists[args[0]], args[1])
+        elif op == "setvariable":
+            self.setVariable(*args)
+        elif op == "clicks":
+            links, lists = args
+            for linkid, clicks in links.items():
+                link = self.linksById.get(int(linkid))
+                if link:
+                    Clickable._import(link, clicks)
+            for listname, clicks in lists.items():
+                if listname in self.lists:
+                    Clickable._import(self.lists[listname], clicks)
+        else:
+            raise ValueError("unknown journal op %s" % op)
 
     @staticmethod
     def load(db=cfg_fnDatabase):
         """Attempt to load the database defined at cfg_fnDatabase. Create a
         new one if the database doesn't already exist.
         """
+        if cfg_persistence == "sqlite":
+            return SqliteStore(cfg_fnSqlite).load(db)
+
         try:
             print("Loading DB from %s" % db)
-            return pickle.load(open(db, 'rb'))
+            g = pickle.load(open(db, 'rb'))
         except IOError:
             print(sys.exc_info()[1])
             print("Creating new database...")
-            return LinkDatabase()
+            g = LinkDatabase()
+
+        if cfg_persistence == "journal":
+            g.openJournal(db)
+
+        return g
+
+    def save(self, force=False):
+        """Make all changes durable; does nothing if nothing changed since the last save.
+
+        With a store, edits already are durable and only the clicks get logged.
+        """
+        edited, clicked = self.isDirty()
+        if not (force or edited or clicked):
+            self.saveStats["skipped"] += 1
+            return
+
+        if self.store:
+            if force or edited:  # changed outside of mutating(), so the store hasn't seen it
+                return self.compact()
+            return self._logClicks()
+
+        generation, clickGeneration = self.generation, self.clickGeneration
+        start = time.time()
+        with self.lock:
+            data = pickle.dumps(self)
 
-    def save(self):
         #TODO: Make this get saved to a database, this is a temporary solution to prevent corruption
         tmpfile = cfg_fnDatabase + '.tmp'
-        pickle.dump(self, open(tmpfile, "wb"))
+        with open(tmpfile, "wb") as f:
+            f.write(data)
         shutil.copyfile(tmpfile, cfg_fnDatabase)
         os.remove(tmpfile)
 
+        self._savedGeneration, self._savedClickGeneration = generation, clickGeneration
+        self._recordSave("full", time.time() - start, len(data))
+
+    def _logClicks(self):
+        clickGeneration = self.clickGeneration
+        with self.mutating():
+            clicked, self._unsavedClicks = self._unsavedClicks, set()
+            links = {L.linkid: Clickable._export(L) for L in clicked if L in self.ranking}
+            lists = {L.name: Clickable._export(L) for L in clicked if L in self.listRanking}
+            if links or lists:
+                self._touched.update([L for L in clicked if L in self.ranking or L in self.listRanking])
+                self._log("clicks", links, lists)
+        self._savedClickGeneration = clickGeneration
+
+    def compact(self):
+        """Write a full snapshot (with a journal, its records are dropped once that is on disk)."""
+        if not self.store:
+            return self.save(force=True)
+
+        self._logClicks()
+        generation = self.generation
+        start = time.time()
+        written = self.store.compact(self)
+        self._savedGeneration = generation
+        self._recordSave("compact", time.time() - start, written)
+
+    def checkpoint(self):
+        """Called periodically from a background thread."""
+        self.save()
+        if self.store and self.store.needsCompaction():
+            self.compact()
+
     def nextlinkid(self):
-        r = self._nextlinkid
-        self._nextlinkid += 1
-        return r
+        with self.lock:
+            r = self._nextlinkid
+            self._nextlinkid += 1
+            return r
 
     def addRegexList(self, regex=None, url=None, desc=None, owner=""):
         r = RegexList(self.nextlinkid(), regex)
@@ -601,89 +2072,255 @@ class LinkDatabase:
         self._addRegexList(r, owner)
 
     def _addRegexList(self, r, owner):
-        self.regexes[r.regex] = r
-        self._addList(r)     # add to all indexes
-
-    def addLink(self, lists, url, title, owner=""):
-        if url in self.linksByUrl:
-            raise RuntimeError("existing url")
+        with self.lock:
+            self.regexes[r.regex] = r
+            self.regexDispatcher.add(r)
+            self._addList(r)     # add to all indexes
 
+    def addLink(self, lists, url, title, owner="", linkid=None, when=None):
         if type(lists) == str:
             lists = lists.split()
 
-        link = Link(self.nextlinkid(), url, title)
+        with self.mutating():
+            if url in self.linksByUrl:
+                raise RuntimeError("existing url")
+
+            if linkid is None:
+                linkid = self.nextlinkid()
+            else:  # replaying the journal
+                self._nextlinkid = max(self._nextlinkid, linkid + 1)
 
-        for kw in lists:
-            self.getList(kw, create=True).addLink(link)
+            link = Link(linkid, url, title)
 
-        self._addLink(link, owner)
+            for kw in lists:
+                self.getList(kw, create=True).addLink(link)
+
+            self._addLink(link, owner, when)
+            self.touch(link, *link.lists)
+            self._log("addlink", lists, url, title, owner, link.linkid, link.lastEdit()[0])
 
         return link
 
-    def _addLink(self, link, editor=None):
-        if editor:
-            link.editedBy(editor)
+    def _addLink(self, link, editor=None, when=None):
+        with self.lock:
+            if editor:
+                link.editedBy(editor, when)
 
-        self.linksById[link.linkid] = link
-        self.linksByUrl[link._url] = link
+            self.touch(link)
+            self.linksById[link.linkid] = link
+            self.linksByUrl[link._url] = link
+            self.ranking.add(link)
+            self._relisted(link)
 
     def _changeLinkUrl(self, link, newurl):
+        self.touch(link)
         if link._url in self.linksByUrl:
             del self.linksByUrl[link._url]
         link._url = newurl
+        link._template = None
         self.linksByUrl[newurl] = link
 
     def _addList(self, LL):
         self.lists[LL.name] = LL
+        self.listRanking.add(LL)
+        self.touch(LL)
+
+    def editLink(self, link, url, title, lists, editor, when=None):
+        """Set a link's url, title and list names; raises InvalidKeyword(listname) for a bad list."""
+        with self.mutating():
+            self.touch(link, *link.lists)
+            newlistset = []
+            for listname in lists:
+                if "{*}" in url:
+                    if listname[-1] != "/":
+                        listname += "/"
+                try:
+                    newlistset.append(self.getList(listname, create=True))
+                except Exception:
+                    raise InvalidKeyword(listname)
+
+            if link._url != url:
+                self._changeLinkUrl(link, url)
+            link.title = title
+
+            for LL in newlistset:
+                if LL not in link.lists:
+                    LL.addLink(link)
+
+            for LL in [x for x in link.lists]:
+                if LL not in newlistset:
+                    LL.removeLink(link)
+                    if not LL.links:
+                        self.deleteList(LL)
+
+            link.lists = newlistset
+            self.touch(*newlistset)
+            self._relisted(link)
+
+            link.editedBy(editor, when)
+            self._log("editlink", link.linkid, url, title, lists, editor, link.lastEdit()[0])
+
+    def setBehavior(self, LL, behavior):
+        with self.mutating():
+            LL._url = behavior
+            self.touch(LL)
+            self._log("setbehavior", LL.name, behavior)
+
+    def setVariable(self, varname, value):
+        with self.mutating():
+            # copy-on-write, so templates can iterate the variables without a lock
+            self.variables = dict(self.variables, **{varname: value})
+            self.touch()
+            self.resolutions.invalidateWhere(lambda LL, L, url: "{" + varname in L._url)
+            self._log("setvariable", varname, value)
 
     def deleteLink(self, link):
-        for LL in list(link.lists):
-            LL.removeLink(link)
-            if not LL.links:  # auto-delete lists with no links
-                self.deleteList(LL)
+        with self.mutating():
+            self._log("deletelink", link.linkid)
+            self.touch(link, *link.lists)
+
+            for LL in list(link.lists):
+                LL.removeLink(link)
+                if not LL.links:  # auto-delete lists with no links
+                    self.deleteList(LL)
 
-        self._removeLinkFromUrls(link._url)
+            self._removeLinkFromUrls(link._url)
 
-        if link.linkid in self.linksById:
-            del self.linksById[link.linkid]
+            if link.linkid in self.linksById:
+                del self.linksById[link.linkid]
+            self.ranking.remove(link)
+            self._relisted(link)
 
-        if isinstance(link, RegexList):
-            del self.regexes[link.regex]
+            if isinstance(link, RegexList):
+                del self.regexes[link.regex]
+                self.regexDispatcher.remove(link.regex)
 
         return "deleted go/%s" % link.linkid
 
     def _removeLinkFromUrls(self, url):
-        if url in self.linksByUrl:
-            del self.linksByUrl[url]
+        with self.lock:
+            if url in self.linksByUrl:
+                self.touch()
+                del self.linksByUrl[url]
 
     def deleteList(self, LL):
-        for link in list(LL.links):
-            LL.removeLink(link)
+        with self.mutating():
+            self._log("deletelist", LL.name)
+            self.touch(LL, *LL.links)
 
-        del self.lists[LL.name]
-        self.deleteLink(LL)
+            for link in list(LL.links):
+                LL.removeLink(link)
+                self._relisted(link)
+
+            del self.lists[LL.name]
+            self.listRanking.remove(LL)
+            self.deleteLink(LL)
         return "deleted go/%s" % LL.name
 
+    def matchRegexes(self, kw):
+        """Return [(RegexList, Link, generated Link)] for all regexes matching kw."""
+        ret = []
+        for R, m in self.regexDispatcher.matches(kw):
+            ret.extend([(R, L, genL) for L, genL in R.matches(kw, m)])
+        return ret
+
     def getLink(self, linkid):
         return self.linksById.get(int(linkid), None)
 
     def getAllLists(self):
-        return byClicks(list(self.lists.values()))
+        return self.listRanking.top()
+
+    def search(self, query, n=10):
+        """The n most clicked lists and links whose names, titles or urls contain query: (lists, links)."""
+        if self.searches is None:
+            with self.lock:
+                if self.searches is None:  # built on first use, so startup doesn't pay for it
+                    searches = (SearchIndex(), SearchIndex())
+                    for LL in self.lists.values():
+                        self._reindex(LL, searches)
+                    for link in self.linksById.values():
+                        self._reindex(link, searches)
+                    self.searches = searches
+
+        lists, links = self.searches
+        return lists.search(query, self.listRanking, n), links.search(query, self.ranking, n)
+
+    def _reindex(self, item, searches=None):
+        """Update item's search text, or drop it once it's been deleted."""
+        lists, links = searches or self.searches
+        if isinstance(item, ListOfLinks):
+            if self.lists.get(item.name) is item:
+                lists.add(item, item.name)
+            else:
+                lists.remove(item)
+        elif self.linksById.get(item.linkid) is item:
+            links.add(item, "%s %s" % (item.title, item._url))
+        else:
+            links.remove(item)
+
+    def searchStats(self):
+        if self.searches is None:
+            return None
+        return {"lists": self.searches[0].stats(), "links": self.searches[1].stats()}
+
+    def suggest(self, keyword, n=5):
+        """Up to n lists with names near keyword, nearest and then most clicked first."""
+        if self.spelling is None:
+            with self.lock:
+                if self.spelling is None:  # built on first use, like the search indexes
+                    spelling = SpellingIndex()
+                    for name, LL in self.lists.items():
+                        if not isinstance(LL, RegexList):
+                            spelling.add(name)
+                    self.spelling = spelling
+
+        keyword = keyword.lower()
+        near = []
+        for d, name in self.spelling.search(keyword, maxdist=1 if len(keyword) <= 3 else 2):
+            LL = self.lists.get(name)
+            if LL is not None:
+                near.append((d, -LL.recentClicks, -LL.totalClicks, name, LL))
+        return [LL for *_, LL in sorted(near)[:n]]
+
+    def _respell(self, name):
+        """Add or drop a list name from the spelling index after the list was created or deleted."""
+        LL = self.lists.get(name)
+        if LL is None or isinstance(LL, RegexList):
+            self.spelling.remove(name)
+        else:
+            self.spelling.add(name)
+
+    def getTopLinks(self, n=None):
+        """The n most clicked non-generative links (all of them if n is None)."""
+        ret = []
+        for link in self.ranking:
+            if n is not None and len(ret) >= n:
+                break
+            if link not in self.folders:
+                ret.append(link)
+        return ret
 
     def getSpecialLinks(self):
-        links = set()
-        for R in list(g_db.regexes.values()):
+        links = set(self.folders)
+        for R in list(self.regexes.values()):
             links.update(R.links)
 
-        links.update(self.getFolders())
-
         return list(links)
 
     def getFolders(self):
-        return [x for x in list(self.linksById.values()) if x.isGenerative()]
+        return list(self.folders)
 
     def getNonFolders(self):
-        return [x for x in list(self.linksById.values()) if not x.isGenerative()]
+        return list(self.nonFolders)
+
+    def randomLink(self):
+        """A random non-generative link that has a keyword going straight to it."""
+        for _ in range(20):  # most links have one, so this rarely falls through to the scan
+            link = self.nonFolders.choice()
+            if link.usage():
+                return link
+
+        return random.choice([x for x in self.nonFolders if x.usage()])
 
     def getList(self, listname, create=False):
         if "\\" in listname:  # is a regex
@@ -694,12 +2331,12 @@ class LinkDatabase:
         if not sanelistname:
             raise InvalidKeyword("keyword '%s' not sanitary" % listname)
 
-        if sanelistname not in self.lists:
-            if not create:
-                return None
-            self._addList(ListOfLinks(self.nextlinkid(), sanelistname, redirect="freshest"))
+        LL = self.lists.get(sanelistname)
+        if LL is None and create:
+            LL = ListOfLinks(self.nextlinkid(), sanelistname, redirect="freshest")
+            self._addList(LL)
 
-        return self.lists[sanelistname]
+        return LL
 
     def getRegex(self, listname, create=False):
         try:
@@ -707,69 +2344,551 @@ class LinkDatabase:
         except:
             raise InvalidKeyword(listname)
 
-        if listname not in self.regexes:
-            if not create:
-                return None
-            self._addRegexList(RegexList(self.nextlinkid(), listname), "")
+        R = self.regexes.get(listname)
+        if R is None and create:
+            R = RegexList(self.nextlinkid(), listname)
+            self._addRegexList(R, "")
+
+        return R
+
+    def resolve(self, keyword, path=None, cookie=None):
+        """Return (list, target link, url) for a keyword that redirects, else None.
+
+        Raises InvalidKeyword like getList.  path and cookie (the raw
+        variables cookie) default to the current request's.  Results are
+        cached per keyword, path and cookie, except for lists that redirect
+        at random.
+        """
+        if path is None:
+            path = cherrypy.request.path_info
+            cookie = cherrypy.request.cookie.get("variables")
+            cookie = cookie and cookie.value
+        key = (keyword, path, cookie)
+        value = self.resolutions.get(key)
+        if value is not None:
+            return value
+
+        epoch = self.resolutions.epoch
+        LL = self.getList(keyword, create=False)
+        target = LL and LL.getDefaultLink()
+        if not target:
+            return None
 
-        return self.regexes[listname]
+        variables = dict(urllib.parse.parse_qsl(cookie)) if cookie else {}
+        value = (LL, target, target.url(path=path, variables=variables))
+        if LL._url != "random" and value[2] is not None:
+            self.resolutions.put(key, value, epoch)
+        return value
 
     def renameList(self, LL, newname):
         assert newname not in self.lists
-        oldname = LL.name
-        self.lists[newname] = self.lists[oldname]
-        del self.lists[oldname]
-        LL.name = newname
+        with self.mutating():
+            oldname = LL.name
+            self._log("renamelist", oldname, newname)
+            self.touch(LL)
+            self.lists[newname] = self.lists[oldname]
+            del self.lists[oldname]
+            LL.name = newname
+            for link in LL.links:  # adding or dropping a trailing "/" makes its links folders or not
+                self._relisted(link)
+            self.resolutions.invalidate(oldname)  # touch() only covers the new name
+            if self.spelling is not None:
+                self._respell(oldname)
         return "renamed go/%s to go/%s" % (oldname, LL.name)
 
     def _export(self, fn):
         print("exporting to %s" % fn)
+        progress = Progress("exported")
         with open(fn, "w") as f:
-            for k, v in list(self.variables.items()):
-                f.write("variable %s %s\n" % (k, v))
+            for line in self._exportLines():
+                f.write(line + "\n")
+                progress.tick()
+        progress.report()
 
-            for L in list(self.linksById.values()):
-                f.write(L._export() + "\n")
+    def _exportLines(self):
+        for k, v in list(self.variables.items()):
+            yield "variable %s %s" % (k, v)
 
-            for LL in list(self.lists.values()):
-                f.write(LL._export() + "\n")
+        for L in list(self.linksById.values()):
+            yield L._export()
+
+        for LL in list(self.lists.values()):
+            yield LL._export()
 
     # for the tsv dumper
     def _dump(self, fh):
         for link in list(self.linksById.values()):
             fh.write(link._dump() + "\n")
 
-    def _import(self, fn):
-        print("importing from %s" % fn)
-        with open(fn, "r") as f:
-            for l in f.readlines():
-                if not l.strip(): continue
-                print(l.strip())
-                a, b = l.split(" ", 1)
-                if a == "regex":
-                    R = RegexList(self.nextlinkid())
-                    R._import(b)
-                elif a == "link":
-                    L = Link(self.nextlinkid())
-                    L._import(b)
-                    self._addLink(L)
-                elif a == "list":
-                    listname, rest = b.split(" ", 1)
-                    if listname in self.lists:
-                        LL = self.lists[listname]
-                    else:
-                        LL = ListOfLinks(self.nextlinkid())
-                    LL._import(b)
-                elif a == "variable":
-                    k, v = b.split(" ", 1)
-                    self.variables[k] = v.strip()
+    importBatch = 10000  # lines applied per hold of the lock
 
-        assert self._nextlinkid == max(self.linksById.keys()) + 1
+    def _import(self, fn, dryRun=False):
+        """Import an export file, streaming it in batches.
+
+        With dryRun, the file is imported into a scratch database instead,
+        every bad line is reported, and nothing is saved.  Returns the
+        number of bad lines.
+        """
+        global g_db
+        print("%s %s" % ("validating" if dryRun else "importing from", fn))
+
+        db, saved = (LinkDatabase(), g_db) if dryRun else (self, None)
+        g_db = db  # the Link._import methods go through g_db
+        progress = Progress("validated" if dryRun else "imported")
+        errors = 0
+        try:
+            with open(fn, "r") as f:
+                while True:
+                    batch = list(itertools.islice(f, self.importBatch))
+                    if not batch:
+                        break
+
+                    with db.mutating(), db.regexDispatcher.batch():
+                        for l in batch:
+                            progress.tick()
+                            try:
+                                db._importLine(l)
+                            except Exception as e:
+                                print("%s:%d: %s: %s" % (fn, progress.lines, e.__class__.__name__, e))
+                                errors += 1
+                                if not dryRun:
+                                    raise
+        finally:
+            if dryRun:
+                g_db = saved
+
+        assert db._nextlinkid > max(db.linksById, default=0)
+
+        progress.report()
+        if dryRun:
+            print("%d links, %d lists, %d regexes, %d variables; %d bad lines" % (len(db.linksById), len(db.lists),
+                                                                                   len(db.regexes), len(db.variables),
+                                                                                   errors))
+        else:
+            self.compact()
+
+        return errors
+
+    def _importLine(self, l):
+        if not l.strip():
+            return
+
+        a, b = l.split(" ", 1)
+        if a == "regex":
+            R = RegexList(self.nextlinkid())
+            R._import(b)
+            self._addRegexList(R, "")
+        elif a == "link":
+            L = Link(self.nextlinkid())
+            L._import(b)
+            self._addLink(L)
+        elif a == "list":
+            listname, rest = b.split(" ", 1)
+            if listname in self.lists:
+                LL = self.lists[listname]
+            else:
+                LL = ListOfLinks(self.nextlinkid())
+            LL._import(b)
+        elif a == "variable":
+            k, v = b.split(" ", 1)
+            self.variables = dict(self.variables, **{k: v.strip()})
+
+
+class MappedDatabase:
+    """A read-only database snapshot file, read lazily through mmap.
+
+    write() lays a LinkDatabase out as a string table and arrays: links
+    sorted by id, lists sorted by name with the links each has in order,
+    and the click counts and day rings of both.  Opening the file reads
+    just its table of contents, so a keyword or link id can be resolved
+    right away, whatever the size of the database; the lists and links
+    looked up are built from the file on first use.  Links keep only their
+    latest edit, and link.lists has only the lists built so far.
+
+    Serves redirects through FastRedirects at startup while the full
+    LinkDatabase loads (see loadInBackground); clicks made meanwhile wait
+    in pendingClicks.
+    """
+    magic = b"GODBMAP1"
+    noString = 0xFFFFFFFF  # string index standing for None
+
+    # section -> array typecode
+    sections = {"strings": "B", "stringStarts": "Q",
+                "linkIds": "I", "linkUrls": "I", "linkTitles": "I", "linkEditTimes": "d", "linkEditors": "I",
+                "linkArchived": "Q", "linkLastDays": "I", "linkDayClicks": "I",
+                "listNames": "I", "listIds": "I", "listRedirects": "I", "listIsRegex": "B",
+                "listStarts": "I", "listMembers": "I",
+                "listArchived": "Q", "listLastDays": "I", "listDayClicks": "I"}
+
+    def __init__(self, fn):
+        self.fn = fn
+        with open(fn, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(self.magic)] != self.magic:
+            raise ValueError("%s is not a mapped database" % fn)
+
+        tocLength, = struct.unpack_from("<Q", self.map, len(self.magic))
+        toc = json.loads(self.map[len(self.magic) + 8:len(self.magic) + 8 + tocLength])
+        if toc["byteorder"] != sys.byteorder or toc["recentDays"] != Clickable.recentDays:
+            raise ValueError("%s was written for another platform or version" % fn)
+
+        view = memoryview(self.map)
+        for name, (offset, count) in toc["sections"].items():
+            typecode = self.sections[name]
+            setattr(self, name, view[offset:offset + count * array.array(typecode).itemsize].cast(typecode))
+        self.variables = toc["variables"]
+
+        self.lock = threading.RLock()
+        self.resolutions = ResolutionCache(cfg_resolutionCacheSize)
+        self.built = {}           # ("link" or "list", row) -> Link or ListOfLinks
+        self.pendingClicks = []   # (clickable, day) for the full database; None once it has them
+
+    def __repr__(self):
+        return '%s(fn=%s, links=%s, lists=%s, built=%s)' % (self.__class__.__name__, self.fn, len(self.linkIds),
+                                                            len(self.listIds), len(self.built))
+
+    @classmethod
+    def write(cls, db, fn):
+        """Write db out to fn in this format."""
+        strings, stringIds = [], {}
+
+        def string(s):
+            if s is None:  # e.g. a list with no behavior
+                return cls.noString
+            s = str(s)
+            if s not in stringIds:
+                stringIds[s] = len(strings)
+                strings.append(s.encode())
+            return stringIds[s]
+
+        a = {name: array.array(typecode) for name, typecode in cls.sections.items()}
+
+        def clicks(prefix, item):
+            a[prefix + "Archived"].append(item.archivedClicks)
+            a[prefix + "LastDays"].append(item._lastClickDay)
+            a[prefix + "DayClicks"].extend(item.dayClicks or [0] * Clickable.recentDays)
+
+        with db.lock:
+            links = sorted(db.linksById.values(), key=lambda L: L.linkid)
+            lists = sorted(db.lists.values(), key=lambda LL: LL.name.encode())
+            rows = {L: row for row, L in enumerate(links)}
+            for L in links:
+                edittime, editor = L.lastEdit()
+                a["linkIds"].append(L.linkid)
+                a["linkUrls"].append(string(L._url))
+                a["linkTitles"].append(string(L.title))
+                a["linkEditTimes"].append(edittime)
+                a["linkEditors"].append(string(editor))
+                clicks("link", L)
+
+            a["listStarts"].append(0)
+            for LL in lists:
+                a["listNames"].append(string(LL.name))
+                a["listIds"].append(LL.linkid)
+                a["listRedirects"].append(string(LL._url))
+                a["listIsRegex"].append(isinstance(LL, RegexList))
+                a["listMembers"].extend(rows[L] for L in LL.links if L in rows)
+                a["listStarts"].append(len(a["listMembers"]))
+                clicks("list", LL)
+            variables = dict(db.variables)
+
+        a["strings"] = array.array("B", b"".join(strings))
+        a["stringStarts"].extend(itertools.accumulate((len(s) for s in strings), initial=0))
+
+        # the table of contents gives each section's offset, so it's sized with placeholder offsets first
+        toc = {"byteorder": sys.byteorder, "recentDays": Clickable.recentDays, "variables": variables,
+               "sections": {name: [0, len(values)] for name, values in a.items()}}
+        offset = len(cls.magic) + 8 + len(json.dumps(toc)) + 16 * len(a)
+        for name, values in a.items():
+            offset += -offset % 8
+            toc["sections"][name][0] = offset
+            offset += len(values) * values.itemsize
+        header = json.dumps(toc).encode()
+
+        tmpfile = fn + ".tmp"
+        with open(tmpfile, "wb") as f:
+            f.write(cls.magic + struct.pack("<Q", len(header)) + header)
+            for name, values in a.items():
+                f.write(b"\0" * (toc["sections"][name][0] - f.tell()))
+                values.tofile(f)
+        os.replace(tmpfile, fn)
+
+    @staticmethod
+    def isFresh(fn):
+        """Whether fn is at least as new as the database files, i.e. it has every edit they have."""
+        try:
+            written = os.stat(fn).st_mtime
+        except OSError:
+            return False
+
+        # sqlite's edits may sit in the -wal file until a checkpoint moves them into the database file
+        stores = {"pickle": [cfg_fnDatabase],
+                  "journal": [cfg_fnDatabase, cfg_fnDatabase + ".journal", cfg_fnDatabase + ".journal.old"],
+                  "sqlite": [cfg_fnSqlite, cfg_fnSqlite + "-wal"]}[cfg_persistence]
+        return all(not os.path.exists(x) or os.stat(x).st_mtime <= written for x in stores)
+
+    def string(self, i):
+        if i == self.noString:
+            return None
+        return bytes(self.strings[self.stringStarts[i]:self.stringStarts[i + 1]]).decode()
+
+    def _clicks(self, item, prefix, row):
+        item.archivedClicks = getattr(self, prefix + "Archived")[row]
+        item._lastClickDay = getattr(self, prefix + "LastDays")[row]
+        if item._lastClickDay:
+            n = Clickable.recentDays
+            item.dayClicks = array.array("I", getattr(self, prefix + "DayClicks")[row * n:(row + 1) * n])
+            item._recountClicks()
+
+    def _link(self, row):
+        link = self.built.get(("link", row))
+        if link is None:
+            link = Link(self.linkIds[row])
+            link._url = self.string(self.linkUrls[row])
+            link.title = self.string(self.linkTitles[row])
+            if self.linkEditTimes[row]:
+                link.edits = [(self.linkEditTimes[row], self.string(self.linkEditors[row]))]
+            self._clicks(link, "link", row)
+            self.built[("link", row)] = link
+        return link
+
+    def _list(self, row):
+        LL = self.built.get(("list", row))
+        if LL is None:
+            name, redirect = self.string(self.listNames[row]), self.string(self.listRedirects[row])
+            if self.listIsRegex[row]:
+                LL = RegexList(self.listIds[row], name)
+                LL._url = redirect
+            else:
+                LL = ListOfLinks(self.listIds[row], name, redirect)
+            LL.links = [self._link(x) for x in self.listMembers[self.listStarts[row]:self.listStarts[row + 1]]]
+            LL.ranking = ClickRanking(LL.links)
+            for link in LL.links:
+                link.lists.append(LL)
+            self._clicks(LL, "list", row)
+            self.built[("list", row)] = LL
+        return LL
+
+    def getList(self, listname, create=False):
+        if "\\" in listname:  # is a regex
+            try:
+                re.compile(listname)
+            except:
+                raise InvalidKeyword(listname)
+        elif not sanitary(listname):
+            raise InvalidKeyword("keyword '%s' not sanitary" % listname)
+        else:
+            listname = sanitary(listname)
+
+        key = listname.encode()
+        lo, hi = 0, len(self.listNames)
+        while lo < hi:  # binary search of the names, which are sorted by their utf-8
+            mid = (lo + hi) // 2
+            i = self.listNames[mid]
+            if bytes(self.strings[self.stringStarts[i]:self.stringStarts[i + 1]]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(self.listNames) or self.string(self.listNames[lo]) != listname:
+            return None
+
+        with self.lock:
+            return self._list(lo)
+
+    def getLink(self, linkid):
+        linkid = int(linkid)
+        row = bisect.bisect_left(self.linkIds, linkid)
+        if row == len(self.linkIds) or self.linkIds[row] != linkid:
+            return None
+
+        with self.lock:
+            return self._link(row)
+
+    resolve = LinkDatabase.resolve
+
+    def checkpoint(self):
+        pass  # nothing of its own to save
 
-        self.save()
+
+def writeMapped():
+    """Save g_db as a MappedDatabase for the next start, once it has been checkpointed."""
+    if cfg_fnMapped and isinstance(g_db, LinkDatabase):
+        start = time.time()
+        MappedDatabase.write(g_db, cfg_fnMapped)
+        print("Wrote %s in %.1fs" % (cfg_fnMapped, time.time() - start))
+
+
+def switchDatabase(mapped, db):
+    """Serve from db instead of the MappedDatabase mapped, giving it the clicks mapped took meanwhile."""
+    with mapped.lock:
+        useDatabase(db)
+        pending, mapped.pendingClicks = mapped.pendingClicks, None
+    g_clicks.apply(clickEvents(db, clickBatch(pending)))
+
+
+def loadInBackground(load=None, retryEvery=30):
+    """Load the full database while the MappedDatabase g_db answers redirects, then switch to it.
+
+    load returns the full database (default LinkDatabase.load); if it fails, it's tried again every
+    retryEvery seconds, and redirects keep coming from the MappedDatabase meanwhile.
+    """
+    mapped = g_db
+    start = time.time()
+    while True:
+        try:
+            db = (load or LinkDatabase.load)()
+            break
+        except Exception as e:
+            print("Loading the full database failed, trying again in %ss: %r" % (retryEvery, e))
+            time.sleep(retryEvery)
+    switchDatabase(mapped, db)
+    print("Switched from %s to the full database after %.1fs" % (mapped.fn, time.time() - start))
+
+
+def refuseWhileLoading():
+    """Answer 503 until the full database is loaded; FastRedirects answers redirects from the MappedDatabase till then."""
+    if isinstance(g_db, MappedDatabase):
+        cherrypy.response.headers["Retry-After"] = "1"
+        raise cherrypy.HTTPError(503, "The database is still loading")
+
+
+cherrypy.tools.loading = cherrypy.Tool("on_start_resource", refuseWhileLoading)
+
+
+class PageCache:
+    """Bounded LRU of rendered pages, valid until the database changes.
+
+    An entry is reused while the database has had no edits since it was
+    rendered; clicks only make it stale once it is older than staleness
+    seconds, so click counts on a cached page may lag by that much.
+    """
+    maxsize = 256
+
+    def __init__(self, maxsize=None, staleness=0):
+        self.maxsize = maxsize or self.maxsize
+        self.staleness = staleness
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key -> (db, generation, clickGeneration, time, etag, body)
+        self.instance = "%08x" % random.getrandbits(32)  # generations restart with the process
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return '%s(entries=%s, hits=%s, misses=%s)' % (self.__class__.__name__, len(self.entries),
+                                                       self.hits, self.misses)
+
+    def get(self, key, db):
+        """Return (etag, body) for key if still valid for db, else None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                edb, generation, clickGeneration, when, etag, body = entry
+                if (edb is db and generation == db.generation and
+                        (clickGeneration == db.clickGeneration or time.time() - when < self.staleness)):
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    return etag, body
+                del self.entries[key]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, db, generation, clickGeneration, body):
+        """Store body as rendered at the given database generations; returns its etag."""
+        etag = '"%s.%x.%d.%d"' % (self.instance, hash(key) & 0xffffffff, generation, clickGeneration)
+        with self.lock:
+            self.entries[key] = (db, generation, clickGeneration, time.time(), etag, body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return etag
+
+    def stats(self):
+        return {"entries": len(self.entries), "maxsize": self.maxsize, "staleness": self.staleness,
+                "hits": self.hits, "misses": self.misses}
+
+
+def toWriter(method, path, body=None, headers={}):
+    """Make a request of the writer process; returns the response and its body."""
+    conn = http.client.HTTPConnection(*g_writer, timeout=30)
+    try:
+        conn.request(method, path, body, dict(headers, **{FromReaders.header: g_writerSecret}))
+        response = conn.getresponse()
+        return response, response.read()
+    finally:
+        conn.close()
+
+
+hopByHopHeaders = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer",
+                   "transfer-encoding", "upgrade", "content-length"}
+
+
+def forwardToWriter(param=None):
+    """In a reader process, relay the writer's answer to this request instead of handling it here.
+
+    With param, only requests that have that parameter are relayed.
+    """
+    if not g_writer:
+        return
+    if param and param not in cherrypy.serving.request.params:
+        return
+
+    request = cherrypy.serving.request
+    headers = {"X-Forwarded-Host": request.headers.get("Host", cfg_hostname),
+               "X-Forwarded-Proto": request.scheme,
+               "X-Forwarded-For": request.remote.ip}
+    if "Cookie" in request.headers:
+        headers["Cookie"] = request.headers["Cookie"]
+
+    path = urllib.parse.quote(request.path_info)
+    params = urllib.parse.urlencode(request.params, doseq=True)
+    if request.method == "POST":
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+        response, body = toWriter("POST", path, params, headers)
+    else:
+        response, body = toWriter(request.method, path + (params and "?" + params), None, headers)
+
+    cherrypy.response.status = response.status
+    for name, value in response.getheaders():
+        if name.lower() == "set-cookie":  # may come more than once
+            cherrypy.response.cookie.load(value)
+        elif name.lower() not in hopByHopHeaders:
+            cherrypy.response.headers[name] = value
+    cherrypy.response.body = body
+    request.handler = None
+
+
+class FromReaders:
+    """WSGI middleware of the writer process: refuses every request without g_writerSecret.
+
+    Any local process can reach the writer's loopback port; this keeps
+    them from making edits or clicks, and from setting the X-Forwarded-*
+    headers that tools.proxy trusts there.
+    """
+    header = "X-Go-Writer"
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        secret = environ.get("HTTP_X_GO_WRITER", "").encode("latin1")
+        if not (g_writerSecret and hmac.compare_digest(secret, g_writerSecret.encode())):
+            start_response("403 Forbidden", [("Content-Type", "text/plain")])
+            return [b"only the reader processes may ask the writer"]
+        return self.app(environ, start_response)
+
+
+cherrypy.tools.forward = cherrypy.Tool("before_handler", forwardToWriter, priority=30)
 
 
 class Root:
+    _cp_config = {"tools.metrics.on": True,
+                  "tools.loading.on": True,
+                  "tools.profiler.on": bool(cfg_profileEvery or cfg_profileToken)}  # no cost unless configured
+
+    def __init__(self):
+        self.pages = PageCache(staleness=cfg_pageCacheStaleness)
+
     def redirect(self, url, status=307):
         cherrypy.response.status = status
         cherrypy.response.headers["Location"] = url
@@ -777,8 +2896,37 @@ class Root:
     def undirect(self):
         raise cherrypy.HTTPRedirect(cherrypy.request.headers.get("Referer", "/"))
 
-    def notfound(self, msg):
-        return env.get_template("notfound.html").render(message=msg)
+    def notfound(self, msg, suggestions=()):
+        return env.get_template("notfound.html").render(message=msg, suggestions=suggestions)
+
+    def renderCached(self, template, render=None, **kwargs):
+        """Render template, or reuse an earlier rendering of this page for this user.
+
+        render(), if given, is called to make the page instead of rendering
+        template with kwargs.  Sends an ETag for the database generation the
+        page was rendered at, and answers a matching If-None-Match with 304.
+        """
+        cookie = cherrypy.request.cookie.get("variables")
+        key = (template, cherrypy.request.path_info, cherrypy.request.query_string,
+               getSSOUsername(False), cookie and cookie.value, today())
+
+        db = g_db
+        cached = self.pages.get(key, db)
+        if cached:
+            etag, body = cached
+        else:
+            generation, clickGeneration = db.generation, db.clickGeneration
+            body = render() if render else env.get_template(template).render(**kwargs)
+            etag = self.pages.put(key, db, generation, clickGeneration, body)
+
+        cherrypy.response.headers["ETag"] = etag
+        cherrypy.response.headers["Cache-Control"] = "no-cache"
+        ifNoneMatch = cherrypy.request.headers.get("If-None-Match", "")
+        if etag in [x.strip().lstrip("W/") for x in ifNoneMatch.split(",")]:
+            cherrypy.response.status = 304
+            return ""
+
+        return body
 
     def redirectIfNotFullHostname(self, scheme=None):
         if scheme is None:
@@ -817,8 +2965,8 @@ class Root:
 
     @cherrypy.expose
     def lucky(self):
-        luckylink = random.choice(g_db.getNonFolders())
-        luckylink.clicked()
+        luckylink = g_db.nonFolders.choice()
+        g_clicks.click(luckylink)
         return self.redirect(deampify(luckylink.url()))
 
     @cherrypy.expose
@@ -855,51 +3003,59 @@ class Root:
 
         # try it as a list
         try:
+            if not forceListDisplay:
+                resolved = g_db.resolve(keyword)
+                if resolved:
+                    ll, listtarget, url = resolved
+                    g_clicks.click(ll, listtarget)
+                    g_metrics.count("outcome", "redirect")
+                    return self.redirect(deampify(url))
+
             ll = g_db.getList(keyword, create=False)
         except InvalidKeyword as e:
-            return self.notfound(str(e))
+            g_metrics.count("outcome", "notfound")
+            return self.notfound(str(e), g_db.suggest(keyword))
 
         if not ll:  # nonexistent list
             # check against all special cases
-            matches = []
-            for R in list(g_db.regexes.values()):
-                matches.extend([(R, L, genL) for L, genL in R.matches(keyword)])
+            matches = g_db.matchRegexes(keyword)
+            g_metrics.count("regexMatches", n=len(matches))
 
             if not matches:
+                g_metrics.count("outcome", "notfound")
                 kw = sanitary(keyword)
                 if not kw:
-                    return self.notfound("No match found for '%s'" % keyword)
+                    return self.notfound("No match found for '%s'" % keyword, g_db.suggest(keyword))
 
                 # serve up empty fake list
-                return env.get_template('list.html').render(L=ListOfLinks(0), keyword=kw)
+                return env.get_template('list.html').render(L=ListOfLinks(0), keyword=kw,
+                                                            suggestions=g_db.suggest(kw))
             elif len(matches) == 1:
                 R, L, genL = matches[0]  # actual regex, generated link
-                R.clicked()
-                L.clicked()
+                g_clicks.click(R, L)
+                g_metrics.count("outcome", "redirect")
                 return self.redirect(deampify(genL.url()))
             else:  # len(matches) > 1
                 LL = ListOfLinks(-1)  # -1 means non-editable
                 LL.links = [genL for R, L, genL in matches]
+                LL.ranking = ClickRanking(LL.links)
+                g_metrics.count("outcome", "list")
                 return env.get_template('list.html').render(L=LL, keyword=keyword)
 
-        listtarget = ll.getDefaultLink()
-
-        if listtarget and not forceListDisplay:
-            ll.clicked()
-            listtarget.clicked()
-            return self.redirect(deampify(listtarget.url()))
-
-        tmplList = env.get_template('list.html')
-        return tmplList.render(L=ll, keyword=keyword)
+        g_metrics.count("outcome", "list")
+        return self.renderCached('list.html', L=ll, keyword=keyword)
 
     @cherrypy.expose
     def special(self):
-        LL = ListOfLinks(-1)
-        LL.name = "Smart Keywords"
-        LL.links = g_db.getSpecialLinks()
+        def render():
+            LL = ListOfLinks(-1)
+            LL.name = "Smart Keywords"
+            LL.links = g_db.getSpecialLinks()
+            LL.ranking = ClickRanking(LL.links)
+            return env.get_template('list.html').render(L=LL, keyword="special")
 
         env.globals['g_db'] = g_db
-        return env.get_template('list.html').render(L=LL, keyword="special")
+        return self.renderCached('special', render)
 
     @cherrypy.expose
     def _login_(self, redirect=""):
@@ -916,10 +3072,12 @@ class Root:
     def _link_(self, linkid):
         link = g_db.getLink(linkid)
         if link:
-            link.clicked()
+            g_clicks.click(link)
+            g_metrics.count("outcome", "redirect")
             return self.redirect(link.url(), status=301)
 
         cherrypy.response.status = 404
+        g_metrics.count("outcome", "notfound")
         return self.notfound("Link %s does not exist" % linkid)
 
     @cherrypy.expose
@@ -946,15 +3104,17 @@ class Root:
         return env.get_template("list.html").render(L=K, keyword=keyword)
 
     @cherrypy.expose
+    @cherrypy.tools.forward()
     def _setbehavior_(self, keyword, **kwargs):
         K = g_db.getList(keyword, create=False)
 
         if "behavior" in kwargs:
-            K._url = kwargs["behavior"]
+            g_db.setBehavior(K, kwargs["behavior"])
 
         return self.redirectToEditList(keyword)
 
     @cherrypy.expose
+    @cherrypy.tools.forward()
     def _delete_(self, linkid, returnto=""):
 
         g_db.deleteLink(g_db.getLink(linkid))
@@ -963,6 +3123,7 @@ class Root:
 
     @cherrypy.expose
     @cherrypy.tools.allow(methods=['POST'])
+    @cherrypy.tools.forward()
     def _modify_(self, **kwargs):
         username = getSSOUsername()
 
@@ -984,33 +3145,10 @@ class Root:
 
         if linkid:
             link = g_db.getLink(linkid)
-            if link._url != url:
-                g_db._changeLinkUrl(link, url)
-            link.title = title
-
-            newlistset = []
-            for listname in lists:
-                if "{*}" in url:
-                    if listname[-1] != "/":
-                        listname += "/"
-                try:
-                    newlistset.append(g_db.getList(listname, create=True))
-                except:
-                    return self.redirectToEditLink(error="invalid keyword '%s'" % listname, **kwargs)
-
-            for LL in newlistset:
-                if LL not in link.lists:
-                    LL.addLink(link)
-
-            for LL in [x for x in link.lists]:
-                if LL not in newlistset:
-                    LL.removeLink(link)
-                    if not LL.links:
-                        g_db.deleteList(LL)
-
-            link.lists = newlistset
-
-            link.editedBy(username)
+            try:
+                g_db.editLink(link, url, title, lists, username)
+            except InvalidKeyword as e:
+                return self.redirectToEditLink(error="invalid keyword '%s'" % e, **kwargs)
 
             g_db.save()
 
@@ -1044,13 +3182,78 @@ class Root:
         return self.redirect("/." + returnto)
 
     @cherrypy.expose
+    @cherrypy.tools.forward(param="vacwm")  # check.html cleans up the database with it
     def _internal_(self, *args, **kwargs):
         # check, toplinks, special, dumplist
         return env.get_template(args[0] + ".html").render(**kwargs)
 
     @cherrypy.expose
     def toplinks(self, n="100"):
-        return env.get_template("toplinks.html").render(n=int(n))
+        return self.renderCached("toplinks.html", n=int(n))
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def _stats_(self):
+        edited, clicked = g_db.isDirty()
+        return {"generation": g_db.generation,
+                "clickGeneration": g_db.clickGeneration,
+                "dirty": {"edits": edited, "clicks": clicked},
+                "saves": g_db.saveStats,
+                "clicks": g_clicks.stats(),
+                "resolutions": g_db.resolutions.stats(),
+                "pages": self.pages.stats(),
+                "search": g_db.searchStats(),
+                "spelling": g_db.spelling and g_db.spelling.stats(),
+                "snapshots": g_snapshots and g_snapshots.stats()}
+
+    @cherrypy.expose
+    @cherrypy.tools.allow(methods=['POST'])
+    def _clicks_(self):
+        """Click batches from the reader processes; only the writer takes them."""
+        if g_snapshots is None or g_writer:
+            raise cherrypy.NotFound()
+
+        g_clicks.apply(clickEvents(g_db, json.loads(cherrypy.request.body.read())))
+        return ""
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def _search_(self, q="", n="10"):
+        try:
+            n = min(int(n), 100)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "n must be a number")
+        lists, links = g_db.search(q, n)
+        return {"lists": [{"keyword": LL.name, "usage": LL.usage(), "links": len(LL.links),
+                           "clicks": LL.recentClicks} for LL in lists],
+                "links": [{"linkid": L.linkid, "title": L.title, "url": L._url, "keyword": L.usage(),
+                           "clicks": L.recentClicks} for L in links]}
+
+    @cherrypy.expose
+    def _profile_(self, token=None, handler=None, n="30", format="text", reset=None):
+        """Profiles gathered by g_profiler; needs cfg_profileToken, as ?token= or the X-Go-Profile header."""
+        if not g_profiler.isAdmin(token or cherrypy.request.headers.get(Profiler.header)):
+            raise cherrypy.HTTPError(403)
+
+        if reset:
+            g_profiler.reset()
+            return "reset"
+
+        if format == "pstats":
+            data = g_profiler.dump(handler)
+            if data is None:
+                raise cherrypy.NotFound()
+            cherrypy.response.headers["Content-Type"] = "application/octet-stream"
+            cherrypy.response.headers["Content-Disposition"] = 'attachment; filename="%s.pstats"' % handler
+            return data
+
+        cherrypy.response.headers["Content-Type"] = "text/plain; charset=utf-8"
+        return g_profiler.report(handler, int(n)) or "nothing profiled yet"
+
+    @cherrypy.expose
+    def _metrics_(self):
+        cherrypy.response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+        return g_metrics.render(g_db)
 
     @cherrypy.expose
     def variables(self):
@@ -1068,33 +3271,690 @@ class Root:
         return self.redirect("variables")
 
     @cherrypy.expose
+    @cherrypy.tools.forward()
     def _set_variable_(self, varname="", value=""):
         if varname and value:
-            g_db.variables[varname] = value
+            g_db.setVariable(varname, value)
             g_db.save()
 
         return self.redirect("/variables")
 
 
+class FastRedirects:
+    """WSGI app answering plain redirects before CherryPy's dispatch.
+
+    GET /keyword[/...] for a list with a default link and GET /_link_/N
+    are answered straight from g_db, the same way Root.default() and
+    Root._link_() would.  Everything else (list views, regexes, editing,
+    SSO, other hostnames) goes on to app.
+    """
+    def __init__(self, app):
+        self.app = app
+        # segments CherryPy would dispatch to a Root method instead of default()
+        self.reserved = set(name for name in dir(Root) if getattr(getattr(Root, name), "exposed", False))
+        self.hits = 0
+
+    def __repr__(self):
+        return '%s(app=%r, hits=%s)' % (self.__class__.__name__, self.app, self.hits)
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        target = self.target(environ)
+        if target is None:
+            return self.app(environ, start_response)
+
+        handler, status, url = target
+        self.hits += 1
+        start_response(status, [("Location", url), ("Content-Length", "0"),
+                                ("Content-Type", "text/html;charset=utf-8")])
+        g_metrics.count("outcome", "redirect")
+        g_metrics.observe(handler, time.perf_counter() - start)
+        return [b""]
+
+    def target(self, environ):
+        """Return (Root method it stands in for, status, url) to redirect to, or None to leave the request to app."""
+        if environ.get("REQUEST_METHOD") not in ("GET", "HEAD"):
+            return None
+        if environ.get("HTTP_HOST", "").find(cfg_hostname) < 0:  # redirectIfNotFullHostname
+            return None
+
+        path = environ.get("PATH_INFO", "")
+        if not path.isascii():  # CherryPy decodes these differently
+            return None
+
+        segments = path[1:].split("/")
+        if not all(segments) or segments[0][0] == ".":
+            return None
+
+        cookie = None
+        if "variables=" in environ.get("HTTP_COOKIE", ""):
+            cookies = http.cookies.SimpleCookie(environ["HTTP_COOKIE"])
+            cookie = cookies["variables"].value if "variables" in cookies else None
+
+        if segments[0] == "_link_":
+            if len(segments) != 2 or not segments[1].isdigit():
+                return None
+            link = g_db.getLink(segments[1])
+            if not link:
+                return None
+            variables = dict(urllib.parse.parse_qsl(cookie)) if cookie else {}
+            url = link.url(path=path, variables=variables)
+            if url is None or not url.isascii():
+                return None
+            g_clicks.click(link)
+            return "_link_", "301 Moved Permanently", url
+
+        if segments[0].replace(".", "_") in self.reserved:
+            return None
+
+        keyword = segments[0] + ("/" if len(segments) > 1 else "")
+        try:
+            resolved = g_db.resolve(keyword, path, cookie)
+        except InvalidKeyword:
+            return None
+        if not resolved or resolved[2] is None or not resolved[2].isascii():
+            return None
+
+        LL, link, url = resolved
+        g_clicks.click(LL, link)
+        return "default", "307 Temporary Redirect", deampify(url)
+
+
+class ClickRecorder:
+    """Records clicks on a background thread, so redirects don't wait on click bookkeeping.
+
+    Clicks are queued as (clickable, day) and applied in batches, with
+    duplicates within a batch coalesced into one clicked(n) call.  When the
+    queue is full, clicks are dropped (and counted) rather than blocking.
+    Until start() is called, clicks are applied immediately.
+    """
+    maxQueued = 100000
+    batchSize = 1000
+
+    def __init__(self, maxQueued=None, batchSize=None):
+        self.queue = queue.Queue(maxQueued or self.maxQueued)
+        self.batchSize = batchSize or self.batchSize
+        self.thread = None
+        self.lock = threading.Lock()  # for the counters, which request threads update too
+        self.queued = 0     # clicks accepted
+        self.dropped = 0    # clicks lost to a full queue
+        self.applied = 0    # clicked() calls made for them
+        self.batches = 0
+
+    def __repr__(self):
+        return '%s(queued=%s, depth=%s, dropped=%s)' % (self.__class__.__name__, self.queued,
+                                                        self.queue.qsize(), self.dropped)
+
+    def click(self, *clickables):
+        events = [(x, today()) for x in clickables]
+        if not self.thread:
+            with self.lock:
+                self.queued += len(events)
+            return self.apply(events)
+
+        queued = 0
+        for event in events:
+            try:
+                self.queue.put_nowait(event)
+                queued += 1
+            except queue.Full:
+                pass
+        with self.lock:
+            self.queued += queued
+            self.dropped += len(events) - queued
+
+    def apply(self, events):
+        db = g_db
+        if isinstance(db, MappedDatabase):  # until switchDatabase() hands them to the full one
+            with db.lock:
+                if db.pendingClicks is not None:
+                    db.pendingClicks.extend(events)
+                    return
+            db = g_db
+
+        if not all(db.holds(clickable) for clickable, day in events):
+            # queued before switchDatabase() or a snapshot swapped g_db; count them on the same links there
+            events = clickEvents(db, clickBatch(events))
+
+        counts = collections.Counter(events)
+        with db.lock:
+            for (clickable, day), n in counts.items():
+                clickable.clicked(n, day)
+        with self.lock:
+            self.applied += len(counts)
+            self.batches += 1
+
+    def run(self):
+        while True:
+            events = [self.queue.get()]
+            while len(events) < self.batchSize:
+                try:
+                    events.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = None in events
+            events = [x for x in events if x is not None]
+            if events:
+                try:
+                    self.apply(events)
+                except Exception as e:
+                    print("error recording clicks: %s" % e)
+            if stopping:
+                return
+
+    def start(self):
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run, name="ClickRecorder", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Apply the clicks still queued and stop the thread."""
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        with self.lock:
+            return {"depth": self.queue.qsize(), "queued": self.queued, "dropped": self.dropped,
+                    "applied": self.applied, "batches": self.batches}
+
+
+def clickBatch(events):
+    """(clickable, day) events as JSON-able counts, by link id and list name."""
+    batch = {"links": [], "lists": []}
+    for (clickable, day), n in collections.Counter(events).items():
+        if isinstance(clickable, ListOfLinks):
+            batch["lists"].append((clickable.name, day, n))
+        else:
+            batch["links"].append((clickable.linkid, day, n))
+    return batch
+
+
+def clickEvents(db, batch):
+    """The events of a clickBatch() made in another process, for the links and lists of db still there."""
+    events = []
+    for linkid, day, n in batch["links"]:
+        link = db.getLink(linkid)
+        if link:
+            events.extend([(link, day)] * n)
+    for name, day, n in batch["lists"]:
+        LL = db.lists.get(name)
+        if LL:
+            events.extend([(LL, day)] * n)
+    return events
+
+
+class ClickForwarder(ClickRecorder):
+    """The ClickRecorder of a reader process: batches go to the writer instead of into g_db."""
+    def apply(self, events):
+        batch = clickBatch(events)
+        try:
+            toWriter("POST", "/_clicks_", json.dumps(batch), {"Content-Type": "application/json"})
+        except (OSError, http.client.HTTPException) as e:
+            with self.lock:
+                self.dropped += len(events)
+            print("error forwarding clicks: %s" % e)
+            return
+
+        with self.lock:
+            self.applied += len(batch["links"]) + len(batch["lists"])
+            self.batches += 1
+
+
+class Snapshots:
+    """Database generations the writer process publishes for the readers.
+
+    The writer pickles g_db to fn once it has changed: right away for
+    edits, at most every clickEvery seconds when only clicks changed.  The
+    file is swapped in with os.replace(), and a reader loads it again
+    whenever it is a different file than the one it last loaded.
+
+    Only the file is common to the processes: every reader unpickles its
+    own private copy of the database, so they take about n times its
+    memory, and each edit costs a pickle in the writer and an unpickle in
+    every reader.  (The read-only MappedDatabase format would share the
+    pages, but answers nothing beyond redirects.)
+    """
+    clickEvery = 60
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.published = None     # (generation, clickGeneration) of g_db last published
+        self.publishedAt = 0
+        self.loaded = None        # (inode, mtime) of the snapshot being served
+        self.publishes = 0
+        self.loads = 0
+
+    def __repr__(self):
+        return '%s(fn=%s, publishes=%s, loads=%s)' % (self.__class__.__name__, self.fn, self.publishes, self.loads)
+
+    def stamp(self):
+        st = os.stat(self.fn)
+        return st.st_ino, st.st_mtime_ns
+
+    def publish(self, db):
+        """Write db out if readers should see it; returns whether it did."""
+        current = (db.generation, db.clickGeneration)
+        if current == self.published:
+            return False
+        if (self.published and current[0] == self.published[0] and
+                time.time() - self.publishedAt < self.clickEvery):
+            return False
+
+        with db.lock:
+            data = pickle.dumps(db)
+        tmpfile = self.fn + ".tmp"
+        with open(tmpfile, "wb") as f:
+            f.write(data)
+        os.replace(tmpfile, self.fn)
+
+        self.published, self.publishedAt = current, time.time()
+        self.loaded = self.stamp()  # what readers forked from here already have
+        self.publishes += 1
+        return True
+
+    def refresh(self):
+        """Serve the latest snapshot if it's not the one being served; returns whether it was loaded."""
+        try:
+            stamp = self.stamp()
+        except FileNotFoundError:
+            return False
+        if stamp == self.loaded:
+            return False
+
+        with open(self.fn, "rb") as f:
+            db = pickle.load(f)
+        db.generation = g_db.generation + 1  # so no page or ETag from an older snapshot is reused
+        useDatabase(db)
+        self.loaded = stamp
+        self.loads += 1
+        return True
+
+    def stats(self):
+        return {"published": self.published, "publishes": self.publishes, "loads": self.loads}
+
+
+class Metrics:
+    """Request latencies by handler, and counts of how requests turned out.
+
+    Rendered in Prometheus' text format by render(), along with the save
+    statistics and sizes of the database; cheap enough to leave on.
+    """
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    # counter name -> (metric, label, help)
+    counterInfo = {"outcome": ("go_outcomes_total", "outcome", "Keyword and link requests by how they were answered."),
+                   "regexMatches": ("go_regex_matches_total", None, "Regex matches for keywords with no list.")}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}   # handler -> [count in each bucket ..., count above them, total seconds]
+        self.counters = collections.Counter()  # (counter name, label value) -> count
+
+    def __repr__(self):
+        return '%s(handlers=%s)' % (self.__class__.__name__, len(self.latencies))
+
+    def observe(self, handler, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.latencies.get(handler)
+            if histogram is None:
+                histogram = self.latencies[handler] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[i] += 1
+            histogram[-1] += seconds
+
+    def count(self, name, label="", n=1):
+        with self.lock:
+            self.counters[name, label] += n
+
+    def render(self, db):
+        with self.lock:
+            latencies = {handler: list(histogram) for handler, histogram in self.latencies.items()}
+            counters = dict(self.counters)
+
+        lines = []
+
+        def metric(name, kind, help, samples):
+            """samples are (name suffix, ((label, value), ...), sample value)"""
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for suffix, labels, value in samples:
+                labels = ",".join('%s="%s"' % (k, v) for k, v in labels)
+                lines.append("%s%s%s %s" % (name, suffix, labels and "{%s}" % labels, value))
+
+        samples = []
+        for handler, histogram in sorted(latencies.items()):
+            n = 0
+            for le, count in zip(self.buckets + ("+Inf", ), histogram):
+                n += count
+                samples.append(("_bucket", (("handler", handler), ("le", le)), n))
+            samples.append(("_sum", (("handler", handler), ), histogram[-1]))
+            samples.append(("_count", (("handler", handler), ), n))
+        metric("go_request_duration_seconds", "histogram", "Time to answer a request, by handler.", samples)
+
+        for name, (metricname, label, help) in self.counterInfo.items():
+            if label:
+                samples = [("", ((label, value), ), n) for (counter, value), n in sorted(counters.items())
+                           if counter == name]
+            else:
+                samples = [("", (), counters.get((name, ""), 0))]
+            metric(metricname, "counter", help, samples)
+
+        if db is not None:
+            saves = [(kind, stats) for kind, stats in sorted(db.saveStats.items()) if isinstance(stats, dict)]
+            for name, kind, key, help in [
+                    ("go_saves_total", "counter", "count", "Database saves, by kind of write."),
+                    ("go_save_seconds_total", "counter", "seconds", "Time spent saving the database."),
+                    ("go_save_written_total", "counter", "written", "Bytes (rows, for sqlite) written by saves."),
+                    ("go_save_last_seconds", "gauge", "lastSeconds", "Duration of the last save of each kind."),
+                    ("go_save_last_written", "gauge", "lastWritten", "Bytes (rows, for sqlite) of the last save.")]:
+                metric(name, kind, help, [("", (("kind", k), ), stats[key]) for k, stats in saves])
+            metric("go_saves_skipped_total", "counter", "Saves skipped because nothing had changed.",
+                   [("", (), db.saveStats["skipped"])])
+
+            metric("go_links", "gauge", "Links in the database.", [("", (), len(db.linksById))])
+            metric("go_lists", "gauge", "Keywords in the database, regexes included.", [("", (), len(db.lists))])
+            metric("go_regexes", "gauge", "Regexes in the database.", [("", (), len(db.regexes))])
+
+        clicks = g_clicks.stats()
+        metric("go_clicks_queued_total", "counter", "Clicks queued to be recorded.", [("", (), clicks["queued"])])
+        metric("go_clicks_dropped_total", "counter", "Clicks dropped because the queue was full.",
+               [("", (), clicks["dropped"])])
+
+        return "\n".join(lines) + "\n"
+
+
+class MetricsTool(cherrypy.Tool):
+    """Times each request into g_metrics, under the name of the Root method that answered it."""
+    def __init__(self):
+        cherrypy.Tool.__init__(self, "on_start_resource", self.start)
+
+    def _setup(self):
+        cherrypy.Tool._setup(self)
+        cherrypy.request.hooks.attach("on_end_resource", self.end)
+
+    def start(self):
+        # named now, before other tools (like encoding) wrap the handler
+        handler = getattr(getattr(cherrypy.request.handler, "callable", None), "__name__", "other")
+        cherrypy.request.metricsStart = (handler, time.perf_counter())
+
+    def end(self):
+        started = getattr(cherrypy.request, "metricsStart", None)
+        if started is not None:
+            handler, start = started
+            g_metrics.observe(handler, time.perf_counter() - start)
+
+
+cherrypy.tools.metrics = MetricsTool()
+
+
+class Profiler:
+    """Profiles a sample of requests with cProfile, adding up the stats per handler.
+
+    One in every `every` requests is profiled (none if every is 0), as is
+    any request whose X-Go-Profile header carries the token.
+    """
+    header = "X-Go-Profile"
+
+    def __init__(self, every=0, token=None):
+        self.every = every
+        self.token = token
+        self.requests = itertools.count(1)
+        self.lock = threading.Lock()
+        self.stats = {}      # handler -> pstats.Stats
+        self.profiled = collections.Counter()  # handler -> requests profiled
+
+    def __repr__(self):
+        return '%s(every=%s, handlers=%s)' % (self.__class__.__name__, self.every, len(self.stats))
+
+    def enabled(self):
+        return bool(self.every or self.token)
+
+    def isAdmin(self, token):
+        return bool(self.token and token and hmac.compare_digest(token, self.token))
+
+    def wanted(self, headers):
+        if self.every and next(self.requests) % self.every == 0:
+            return True
+        return self.isAdmin(headers.get(self.header))
+
+    def wrap(self, name, handler):
+        def profiled(*args, **kwargs):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:  # another thread's profile is running (python 3.12+)
+                return handler(*args, **kwargs)
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                profile.disable()
+                self.add(name, profile)
+        return profiled
+
+    def add(self, name, profile):
+        with self.lock:
+            if name in self.stats:
+                self.stats[name].add(profile)
+            else:
+                self.stats[name] = pstats.Stats(profile)
+            self.profiled[name] += 1
+
+    def report(self, name=None, n=30):
+        """The top n functions by cumulative time, for each handler (or just name)."""
+        out = io.StringIO()
+        with self.lock:
+            for handler in sorted(self.stats):
+                if name in (None, handler):
+                    out.write("== %s (%d requests)\n" % (handler, self.profiled[handler]))
+                    stats = self.stats[handler]
+                    stats.stream = out
+                    stats.sort_stats("cumulative").print_stats(n)
+        return out.getvalue()
+
+    def dump(self, name):
+        """The stats for handler name in .pstats format, or None."""
+        with self.lock:
+            stats = self.stats.get(name)
+            return stats and marshal.dumps(stats.stats)
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+            self.profiled.clear()
+
+
+class ProfilerTool(cherrypy.Tool):
+    """Runs the handler under g_profiler when it wants this request; does nothing otherwise."""
+    def __init__(self):
+        cherrypy.Tool.__init__(self, "before_handler", self.wrap, priority=40)  # before encoding wraps it
+
+    def wrap(self):
+        request = cherrypy.request
+        callable = getattr(request.handler, "callable", None)
+        if callable is not None and g_profiler.wanted(request.headers):
+            request.handler = g_profiler.wrap(callable.__name__, request.handler)
+
+
+cherrypy.tools.profiler = ProfilerTool()
+
+g_db = None  # the LinkDatabase; loaded in __main__
+g_clicks = ClickRecorder()
+g_snapshots = None  # Snapshots, when serving with several processes
+g_writer = None     # (host, port) of the writer, in a reader process
+g_writerSecret = None  # made per launch by startWorkers; the writer answers only requests carrying it
+g_metrics = Metrics()
+g_profiler = Profiler(cfg_profileEvery, cfg_profileToken)
 env = jinja2.Environment(loader=jinja2.FileSystemLoader("./html"))
 
 
+def useDatabase(db):
+    """Serve from db from now on."""
+    global g_db
+    g_db = db
+    env.globals["g_db"] = db
+
+
+def templateEnvironment():
+    """The jinja2 environment the pages are rendered with."""
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader("./html"))
+    env.filters['time_t'] = prettytime
+    env.filters['int'] = int
+    env.filters['escapekeyword'] = escapekeyword
+
+    env.globals["enumerate"] = enumerate
+    env.globals["sample"] = random.sample
+    env.globals["len"] = len
+    env.globals["min"] = min
+    env.globals["str"] = str
+    env.globals["list"] = makeList
+    env.globals.update(globals())
+    return env
+
+
+def setupServing(servers, checkpointEvery=60, role=None):
+    """Put FastRedirects in front of servers, and run the click recorder and checkpoints with the engine.
+
+    role is "reader" or "writer" when serving with several processes (see startWorkers).
+    """
+    # answer plain redirects ahead of CherryPy's dispatch
+    for server in servers:
+        server.httpserver, _ = server.httpserver_from_self()
+        server.httpserver.wsgi_app = FastRedirects(server.httpserver.wsgi_app)
+        if role == "writer":
+            server.httpserver.wsgi_app = FromReaders(server.httpserver.wsgi_app)
+
+    # record clicks off the request threads; apply the queued ones before the final checkpoint
+    cherrypy.engine.subscribe('start', g_clicks.start)
+    cherrypy.engine.subscribe('stop', g_clicks.stop, priority=10)
+
+    if role == "reader":  # serves the writer's snapshots and saves nothing itself
+        cherrypy.process.plugins.Monitor(cherrypy.engine, g_snapshots.refresh, cfg_snapshotEvery,
+                                         name="snapshots").subscribe()
+        return
+
+    cherrypy.engine.subscribe('stop', lambda: g_db.checkpoint(), priority=20)
+    cherrypy.engine.subscribe('stop', writeMapped, priority=21)
+
+    # checkpoint the database every checkpointEvery seconds
+    cherrypy.process.plugins.Monitor(cherrypy.engine, lambda: g_db.checkpoint(), checkpointEvery,
+                                     name="checkpoint").subscribe()
+
+    if role == "writer":
+        cherrypy.process.plugins.Monitor(cherrypy.engine, lambda: g_snapshots.publish(g_db), cfg_snapshotEvery,
+                                         name="snapshots").subscribe()
+
+
+class SharedPortServer(cherrypy._cpserver.Server):
+    """A Server on a port that other processes listen on too, through SO_REUSEPORT.
+
+    Unlike Server, it doesn't wait for the port to be free before starting
+    or after stopping, which never happens while the others are serving.
+    """
+    def httpserver_from_self(self, httpserver=None):
+        httpserver, bind_addr = cherrypy._cpserver.Server.httpserver_from_self(self, httpserver)
+        httpserver.reuse_port = True
+        return httpserver, bind_addr
+
+    def start(self):
+        if not self.httpserver:
+            self.httpserver, self.bind_addr = self.httpserver_from_self()
+        self.interrupt = None
+        threading.Thread(target=self._start_http_thread, name="HTTPServer").start()
+        self.wait()
+        self.running = True
+        self.bus.log("Serving on %s (shared)" % self.description)
+    start.priority = 75
+
+    def stop(self):
+        if self.running:
+            self.httpserver.stop()
+            self.running = False
+            self.bus.log("HTTP Server %s shut down" % self.httpserver)
+    stop.priority = 25
+
+
+def startWorkers(n):
+    """Fork n reader processes, leaving this one the writer; returns "reader" or "writer".
+
+    The readers share cfg_port through SO_REUSEPORT and serve from the
+    newest snapshot the writer has published.  They hand edits (see
+    forwardToWriter) and click batches (see ClickForwarder) to the writer,
+    which listens on cfg_writerPort on loopback only, and answers only
+    requests carrying the secret it made for them (see FromReaders).  An
+    edit shows up in every reader within about two cfg_snapshotEvery, plus
+    the time to pickle and load the database.  Each reader holds a copy
+    of the database of its own (see Snapshots).
+    """
+    global g_snapshots, g_writer, g_writerSecret, g_clicks
+    g_writerSecret = os.urandom(16).hex()  # inherited by the readers only
+    g_snapshots = Snapshots(cfg_fnDatabase + ".snapshot")
+    g_snapshots.publish(g_db)
+
+    # no journal file or sqlite connection may be shared across fork(); the writer reopens its own
+    store = g_db.store
+    if store:
+        store.close()
+
+    readers = []
+    for _ in range(n):
+        pid = os.fork()
+        if pid == 0:
+            random.seed()  # or every reader would pick the same random links and page-cache ETags
+            g_db.store = None  # readers save nothing; the writer makes every change
+            g_writer = ("127.0.0.1", cfg_writerPort)
+            g_clicks = ClickForwarder()
+            return "reader"
+        readers.append(pid)
+
+    if store:
+        store.open()
+
+    def stopReaders():
+        for pid in readers:
+            os.kill(pid, signal.SIGTERM)
+        for pid in readers:
+            os.waitpid(pid, 0)
+
+    # the readers send their last clicks while the writer still takes them
+    cherrypy.engine.subscribe('stop', stopReaders, priority=5)
+    return "writer"
+
+
 def main():
+    role = startWorkers(cfg_workers) if cfg_workers > 1 else None
+    serverClass = SharedPortServer if role == "reader" else cherrypy._cpserver.Server
+    if role == "reader":
+        cherrypy.server.unsubscribe()
+        cherrypy.server = SharedPortServer()
+        cherrypy.server.subscribe()
+
     cherrypy.config.update({'server.socket_host': '::',
                             'server.socket_port': cfg_port,
                             'request.query_string_encoding': "latin1",
                             })
-
-    cherrypy.https = s = cherrypy._cpserver.Server()
-    if cfg_sslEnabled:
+    if role:  # a reloaded writer would fork a second set of readers
+        cherrypy.config.update({'engine.autoreload.on': False})
+    if role == "writer":  # only the readers talk to it
+        cherrypy.config.update({'server.socket_host': '127.0.0.1',
+                                'server.socket_port': cfg_writerPort,
+                                'tools.proxy.on': True,
+                                })
+
+    cherrypy.https = s = serverClass()
+    if cfg_sslEnabled and role != "writer":
         s.socket_host = '::'
         s.socket_port = 443
         s.ssl_certificate = cfg_sslCertificate
         s.ssl_private_key = cfg_sslPrivateKey
         s.subscribe()
 
-    # checkpoint the database every 60 seconds
-    cherrypy.process.plugins.BackgroundTask(60, lambda: g_db.save()).start()
+    setupServing([cherrypy.server] + ([s] if cfg_sslEnabled and role != "writer" else []), role=role)
+    if isinstance(g_db, MappedDatabase):
+        cherrypy.engine.subscribe('start', lambda: threading.Thread(target=loadInBackground, name="load",
+                                                                    daemon=True).start())
 
     file_path = os.getcwd().replace("\\", "/")
     conf = {'/images': {"tools.staticdir.on": True, "tools.staticdir.dir": file_path + "/images"},
@@ -1106,10 +3966,14 @@ def main():
 
 if __name__ == "__main__":
 
-    g_db = LinkDatabase.load()
+    serving = not {"import", "export", "dump"} & set(sys.argv)
+    if serving and cfg_workers == 1 and cfg_fnMapped and MappedDatabase.isFresh(cfg_fnMapped):
+        g_db = MappedDatabase(cfg_fnMapped)  # until loadInBackground() has the rest
+    else:
+        g_db = LinkDatabase.load()
 
     if "import" in sys.argv:
-        g_db._import("newterms.txt")
+        sys.exit(1 if g_db._import("newterms.txt", dryRun="--dry-run" in sys.argv) else 0)
 
     elif "export" in sys.argv:
         g_db._export("newterms.txt")
@@ -1118,16 +3982,5 @@ if __name__ == "__main__":
         g_db._dump(sys.stdout)
 
     else:
-        env = jinja2.Environment(loader=jinja2.FileSystemLoader("./html"))
-        env.filters['time_t'] = prettytime
-        env.filters['int'] = int
-        env.filters['escapekeyword'] = escapekeyword
-
-        env.globals["enumerate"] = enumerate
-        env.globals["sample"] = random.sample
-        env.globals["len"] = len
-        env.globals["min"] = min
-        env.globals["str"] = str
-        env.globals["list"] = makeList
-        env.globals.update(globals())
+        env = templateEnvironment()
         main()
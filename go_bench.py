@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for the Go Redirector.
+
+    $ ./go_bench.py [--json results.json] [--baseline baseline.json] [benchmark ...]
+
+Runs every benchmark when none are named.  Requests are made in-process
+against the WSGI apps, so the numbers leave out the network and the HTTP
+server and show just the per-request cost of go.py and CherryPy.
+
+Each benchmark reports times (and sizes) where lower is better.  --json
+writes them out; --baseline compares them against an earlier --json file
+and exits with 1 if any got worse by more than --tolerance (default 25%).
+"""
+
+import argparse
+import collections
+import contextlib
+import functools
+import http.client
+import io
+import itertools
+import json
+import os
+import pickle
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+import cherrypy
+
+import go
+
+
+def zipfWeights(n, s):
+    """Cumulative weights of ranks 1..n under a Zipf distribution with exponent s."""
+    return list(itertools.accumulate(1.0 / r ** s for r in range(1, n + 1)))
+
+
+def makeDatabase(nlinks=1000, nlists=None, nregexes=20, folders=0.05, zipf=1.1, topClicks=5000, seed=0):
+    """A synthetic LinkDatabase, which also becomes go.g_db.
+
+    Every link gets its own keyword, and most also join one of nlists
+    (default nlinks/20) shared lists, picked with Zipf-distributed
+    popularity.  A share of folders of the links are generative {*}
+    folders, and a quarter of the others use a {project} variable.  Each
+    regex has one link; a fifth of them have no literal prefix.  Clicks
+    are Zipf-distributed over the links (the most clicked gets topClicks)
+    and spread over the last 60 days.
+    """
+    rng = random.Random(seed)
+    db = go.g_db = go.LinkDatabase()  # clicks rerank through g_db
+    nlists = nlists or max(1, nlinks // 20)
+    listWeights = zipfWeights(nlists, zipf)
+
+    with db.mutating():
+        for i in range(nlinks):
+            owner = 'user%d' % (i % 20)
+            if rng.random() < folders:
+                db.addLink(['docs%d/' % i], 'http://example.com/docs/%d/{*}' % i, 'folder %d' % i, owner)
+                continue
+
+            lists = ['kw%d' % i]
+            if rng.random() < 0.8:
+                lists.append('group%d' % rng.choices(range(nlists), cum_weights=listWeights)[0])
+            url = 'http://example.com/%d' % i + ('/{project}' if i % 4 == 0 else '')
+            db.addLink(lists, url, 'link %d' % i, owner)
+
+        for j in range(nregexes):
+            regex = r'([a-z]+)%d-(\d+)' % j if j % 5 == 0 else r'tkt%d-(\d+)' % j
+            db.addLink([regex], 'http://tickets.example.com/%d/{1}' % j, 'tickets %d' % j, 'user%d' % j)
+
+    links = list(db.linksById.values())
+    rng.shuffle(links)
+    todayord = go.today()
+    for rank, link in enumerate(links, 1):
+        n = int(topClicks / rank ** zipf)
+        days = sorted(rng.sample(range(60), min(3, n)), reverse=True)
+        for k, daysAgo in enumerate(days):
+            clicks = n // len(days) + (k < n % len(days))
+            link.clicked(clicks, todayord - daysAgo)
+            link.lists[0].clicked(clicks, todayord - daysAgo)
+
+    return db
+
+
+def wsgiGet(app, path):
+    """GET path from the WSGI app; returns the status line."""
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'SCRIPT_NAME': '', 'QUERY_STRING': '',
+               'SERVER_NAME': go.cfg_hostname, 'SERVER_PORT': str(go.cfg_port), 'SERVER_PROTOCOL': 'HTTP/1.1',
+               'HTTP_HOST': go.cfg_hostname, 'REMOTE_ADDR': '127.0.0.1',
+               'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr,
+               'wsgi.version': (1, 0), 'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False}
+    status = []
+    body = app(environ, lambda s, headers, exc_info=None: status.append(s))
+    for _ in body:
+        pass
+    if hasattr(body, 'close'):
+        body.close()
+    return status[0]
+
+
+def timed(fn, seconds=1.0, repeat=3):
+    """Microseconds per call of fn: the best of repeat runs of about seconds/repeat each."""
+    start = time.perf_counter()
+    fn()
+    batch = max(1, int(0.01 / max(time.perf_counter() - start, 1e-7)))  # about 10ms per batch
+
+    best = float("inf")
+    for _ in range(repeat):
+        n, start = 0, time.perf_counter()
+        while True:
+            for _ in range(batch):
+                fn()
+            n += batch
+            elapsed = time.perf_counter() - start
+            if elapsed >= seconds / repeat:
+                break
+        best = min(best, elapsed / n)
+    return best * 1e6
+
+
+def popularKeywords(db, n=100):
+    """The keywords of the n most clicked lists that redirect."""
+    return [LL.name for LL in db.listRanking if not LL.isGenerative() and LL.getDefaultLink()][:n]
+
+
+def benchRedirects():
+    """Requests/sec for keyword and link-id redirects, through CherryPy and through FastRedirects."""
+    db = makeDatabase()
+    cherrypy.config.update({'environment': 'embedded', 'log.screen': False})
+    cherrypy.tree.mount(go.Root(), '/')
+    fast = go.FastRedirects(cherrypy.tree)
+
+    paths = {'keyword': ['/' + kw for kw in popularKeywords(db)],
+             'link id': ['/_link_/%d' % db.getList(kw).links[0].linkid for kw in popularKeywords(db)]}
+
+    results = {}
+    for kind, urls in paths.items():
+        times = []
+        for app in (cherrypy.tree, fast):
+            assert wsgiGet(app, urls[0])[:3] in ('301', '307')
+            it = itertools.cycle(urls)
+            times.append(timed(lambda: wsgiGet(app, next(it))))
+        print("%-8s  cherrypy %8.0f req/s   fast path %8.0f req/s   (%.1fx)" % (kind, 1e6 / times[0], 1e6 / times[1],
+                                                                             times[0] / times[1]))
+        results[kind + " cherrypy"], results[kind + " fast path"] = times
+    return {name: (t, "us") for name, t in results.items()}
+
+
+def benchResolve():
+    """LinkDatabase.resolve() of the most clicked keywords, cached and not."""
+    db = makeDatabase()
+    it = itertools.cycle(popularKeywords(db))
+
+    def uncached():
+        db.resolutions.clear()
+        kw = next(it)
+        db.resolve(kw, '/' + kw)
+
+    results = {"cached": timed(lambda: db.resolve(next(it), '/x')),
+               "uncached": timed(uncached)}
+    for name, t in results.items():
+        print("resolve %-8s  %6.2f us" % (name, t))
+    return {name: (t, "us") for name, t in results.items()}
+
+
+def benchRegexes():
+    """RegexList.matches() and the RegexDispatcher, on keywords that match and ones that don't."""
+    db = makeDatabase()
+    R = db.regexes[r'tkt1-(\d+)']
+    results = {"RegexList.matches hit": timed(lambda: R.matches('tkt1-1234')),
+               "RegexList.matches miss": timed(lambda: R.matches('nothing-here')),
+               "matchRegexes hit": timed(lambda: db.matchRegexes('tkt7-1234')),
+               "matchRegexes miss": timed(lambda: db.matchRegexes('nothing-here'))}
+    for name, t in results.items():
+        print("%-24s  %6.2f us" % (name, t))
+    return {name: (t, "us") for name, t in results.items()}
+
+
+def benchUrls():
+    """Link.url() for plain links, {project} variables and {*} folders, and ListOfLinks.url()."""
+    db = makeDatabase()
+    plain = next(L for L in db.nonFolders if '{' not in L._url)
+    variable = next(L for L in db.nonFolders if '{project}' in L._url)
+    folder = db.getFolders()[0]
+    LL = db.getList(popularKeywords(db)[0])
+    results = {"plain": timed(lambda: plain.url(path='/x')),
+               "variable": timed(lambda: variable.url(path='/x', variables={'project': 'go'})),
+               "folder": timed(lambda: folder.url(path='/%s/a/b' % folder.lists[0].name[:-1], variables={})),
+               "list": timed(lambda: LL.url(keyword=LL.name))}
+    for name, t in results.items():
+        print("url %-8s  %6.2f us" % (name, t))
+    return {name: (t, "us") for name, t in results.items()}
+
+
+def benchRender():
+    """Rendering toplinks.html and the biggest list's list.html (without the page cache)."""
+    db = makeDatabase()
+    go.env = go.templateEnvironment()
+    biggest = max(db.lists.values(), key=lambda LL: len(LL.links))
+    toplinks, listPage = go.env.get_template('toplinks.html'), go.env.get_template('list.html')
+    results = {"toplinks": timed(lambda: toplinks.render(n=100)),
+               "list": timed(lambda: listPage.render(L=biggest, keyword=biggest.name))}
+    print("toplinks.html (100 links)   %8.0f us" % results["toplinks"])
+    print("list.html (%d links)       %8.0f us" % (len(biggest.links), results["list"]))
+    return {name: (t, "us") for name, t in results.items()}
+
+
+@contextlib.contextmanager
+def scratchFiles():
+    """A temporary directory that the database is saved to, with go.py's output silenced."""
+    saved = go.cfg_fnDatabase, go.cfg_persistence
+    tmpdir = tempfile.mkdtemp()
+    go.cfg_fnDatabase, go.cfg_persistence = os.path.join(tmpdir, 'godb.pickle'), "pickle"
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield tmpdir
+    finally:
+        go.cfg_fnDatabase, go.cfg_persistence = saved
+        shutil.rmtree(tmpdir)
+
+
+def benchPersistence(nlinks=20000):
+    """LinkDatabase.save()/load() and _export()/_import() of a larger database."""
+    db = makeDatabase(nlinks)
+    with scratchFiles() as tmpdir:
+        fnExport = os.path.join(tmpdir, 'newterms.txt')
+        results = {"save": timed(lambda: db.save(force=True), repeat=2),
+                   "load": timed(lambda: go.LinkDatabase.load(go.cfg_fnDatabase), repeat=2),
+                   "export": timed(lambda: db._export(fnExport), repeat=2),
+                   "import": timed(lambda: go.LinkDatabase()._import(fnExport), repeat=2)}
+    go.g_db = db  # _import left its scratch database there
+
+    for name, t in results.items():
+        print("%-6s %d links  %7.1f ms" % (name, nlinks, t / 1000))
+    return {name: (t, "us") for name, t in results.items()}
+
+
+def benchStartup(sizes=(1000, 20000)):
+    """Time to the first redirect from a database file: loading the pickle, and opening a MappedDatabase."""
+    results = {}
+    for nlinks in sizes:
+        db = makeDatabase(nlinks)
+        kw = popularKeywords(db, 1)[0]
+        with scratchFiles() as tmpdir:
+            fnMapped = os.path.join(tmpdir, 'godb.map')
+            db.save(force=True)
+            go.MappedDatabase.write(db, fnMapped)
+            times = [timed(lambda: go.LinkDatabase.load(go.cfg_fnDatabase).resolve(kw, '/' + kw), repeat=2),
+                     timed(lambda: go.MappedDatabase(fnMapped).resolve(kw, '/' + kw), repeat=2)]
+        print("%5d links  pickle %8.2f ms   mapped %8.2f ms   (%.0fx)" % (nlinks, times[0] / 1000, times[1] / 1000,
+                                                                          times[0] / times[1]))
+        results["pickle %d" % nlinks], results["mapped %d" % nlinks] = times
+    return {name: (t, "us") for name, t in results.items()}
+
+
+@functools.lru_cache(maxsize=None)
+def dictBasedClass(cls):
+    """A class whose instances hold cls's slots in a __dict__, as links and lists did before __slots__."""
+    return type(cls.__name__, (), {})
+
+
+def dictBasedSize(obj):
+    """Bytes obj would take with its attributes in a __dict__ instead of slots."""
+    d = dictBasedClass(type(obj))()
+    for name in go.slotsOf(type(obj)):  # set in the same order every time, so the dicts share their keys
+        if hasattr(obj, name):
+            setattr(d, name, getattr(obj, name))
+    return sys.getsizeof(d) + sys.getsizeof(d.__dict__)
+
+
+def benchMemory(nlinks=20000):
+    """Bytes per link of a synthetic database, in memory and pickled, with slots and as it was with a __dict__."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    db = makeDatabase(nlinks)
+    resident = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    # what the same objects would take with a __dict__ each
+    objects = list(db.linksById.values()) + list(db.lists.values())
+    withDicts = resident + sum(dictBasedSize(obj) - sys.getsizeof(obj) for obj in objects)
+
+    pickled = len(pickle.dumps(db))
+    print("%d links: %.0f bytes/link in memory (%.0f with a __dict__ per object), %.0f bytes/link pickled" % (
+        nlinks, resident / nlinks, withDicts / nlinks, pickled / nlinks))
+
+    results = {"in memory": (resident / nlinks, "bytes/link"),
+               "in memory with __dict__": (withDicts / nlinks, "bytes/link"),
+               "pickled": (pickled / nlinks, "bytes/link")}
+    link = next(iter(db.nonFolders))
+    for obj in (link, link.lists[0]):
+        size, dictSize = sys.getsizeof(obj), dictBasedSize(obj)
+        print("%s object: %d bytes (%d with a __dict__)" % (obj.__class__.__name__, size, dictSize))
+        results[obj.__class__.__name__ + " object"] = (size, "bytes")
+        results[obj.__class__.__name__ + " object with __dict__"] = (dictSize, "bytes")
+    return results
+
+
+def percentile(sortedValues, q):
+    return sortedValues[min(len(sortedValues) - 1, int(q * len(sortedValues)))]
+
+
+def loadClient(host, port, deadline, pick, seed, every=0):
+    """Make requests from pick(rng) over one keep-alive connection until deadline, one per every seconds at most.
+
+    Returns ({route: [seconds]}, {route: failures}).
+    """
+    rng = random.Random(seed)
+    latencies, failures = collections.defaultdict(list), collections.Counter()
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    while time.perf_counter() < deadline:
+        route, method, path, body = pick(rng)
+        headers = {'Host': go.cfg_hostname}
+        if body:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 400:
+                failures[route] += 1
+        except (OSError, http.client.HTTPException):
+            failures[route] += 1
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=30)
+        latencies[route].append(time.perf_counter() - start)
+        time.sleep(max(0.0, every - (time.perf_counter() - start)))
+
+    conn.close()
+    return latencies, failures
+
+
+def benchLoad(clients=16, seconds=10, threads=10, edits=2.0, checkpoint=60, nlinks=5000):
+    """Requests/sec and latency percentiles per route from a pool of clients against a live server.
+
+    Root runs behind FastRedirects on a loopback port, set up as main()
+    does, with the click recorder and a checkpoint every checkpoint
+    seconds.  The clients ask for Zipf-popular keyword redirects, _link_
+    redirects and list pages; one more client posts an edit through
+    _modify_ edits times a second.  The clients share the server's
+    process (and GIL), so compare runs with each other rather than with
+    production.
+    """
+    db = makeDatabase(nlinks)
+    go.env = go.templateEnvironment()
+    keywords = popularKeywords(db, 1000)
+    weights = zipfWeights(len(keywords), 1.1)
+    edited = [db.getList(kw).links[0] for kw in keywords[:100]]
+
+    def pickRead(rng):
+        kw = rng.choices(keywords, cum_weights=weights)[0]
+        r = rng.random()
+        if r < 0.7:
+            return "redirect", "GET", "/" + kw, None
+        elif r < 0.85:
+            return "_link_", "GET", "/_link_/%d" % db.getList(kw).links[0].linkid, None
+        return "list", "GET", "/." + kw, None
+
+    def pickEdit(rng):
+        link = rng.choice(edited)
+        form = [("linkid", link.linkid), ("url", link._url), ("title", "edited %d" % rng.randrange(1000))]
+        form += [("lists", LL.name) for LL in link.lists]
+        return "_modify_", "POST", "/_modify_", urllib.parse.urlencode(form)
+
+    with scratchFiles():
+        cherrypy.config.update({'environment': 'embedded', 'server.socket_host': '127.0.0.1',
+                                'server.socket_port': 0, 'server.thread_pool': threads})
+        cherrypy.tree.mount(go.Root(), '/')
+        go.setupServing([cherrypy.server], checkpoint)
+        cherrypy.engine.start()
+        try:
+            host, port = cherrypy.server.bound_addr
+            deadline = time.perf_counter() + seconds
+            runs = [(pickRead, 0)] * clients + ([(pickEdit, 1.0 / edits)] if edits else [])
+            outcomes = [None] * len(runs)
+
+            def run(i, pick, every):
+                outcomes[i] = loadClient(host, port, deadline, pick, i, every)
+
+            pool = [threading.Thread(target=run, args=(i, pick, every)) for i, (pick, every) in enumerate(runs)]
+            for t in pool:
+                t.start()
+            for t in pool:
+                t.join()
+        finally:
+            cherrypy.engine.exit()
+
+    latencies, failures = collections.defaultdict(list), collections.Counter()
+    for clientLatencies, clientFailures in outcomes:
+        for route, times in clientLatencies.items():
+            latencies[route].extend(times)
+        failures.update(clientFailures)
+
+    print("%d clients, %d server threads, %d links, %.1f edits/s, checkpoint every %ds, %ds" % (
+        clients, threads, nlinks, edits, checkpoint, seconds))
+    print("%-10s %9s %9s %8s %8s %8s %8s %7s" % ("route", "requests", "req/s", "p50 ms", "p90 ms", "p99 ms",
+                                                 "max ms", "errors"))
+    results = {}
+    for route in ("redirect", "_link_", "list", "_modify_", "all"):
+        times = sorted(sum(latencies.values(), []) if route == "all" else latencies.get(route, []))
+        if not times:
+            continue
+        errors = sum(failures.values()) if route == "all" else failures[route]
+        p50, p90, p99 = [percentile(times, q) * 1000 for q in (0.5, 0.9, 0.99)]
+        print("%-10s %9d %9.0f %8.2f %8.2f %8.2f %8.2f %7d" % (route, len(times), len(times) / seconds,
+                                                              p50, p90, p99, times[-1] * 1000, errors))
+        results[route + " p50"], results[route + " p99"] = (p50, "ms"), (p99, "ms")
+    return results
+
+
+benchmarks = {"redirects": benchRedirects,
+              "resolve": benchResolve,
+              "regexes": benchRegexes,
+              "urls": benchUrls,
+              "render": benchRender,
+              "persistence": benchPersistence,
+              "startup": benchStartup,
+              "memory": benchMemory,
+              "load": benchLoad}
+
+
+def compare(results, baseline, tolerance=0.25):
+    """Print results against baseline (both as written by --json); returns the names that regressed."""
+    regressions = []
+    for name, r in sorted(results.items()):
+        b = baseline.get(name)
+        if b is None:
+            print("%-40s %12.2f %-10s (new)" % (name, r["value"], r["unit"]))
+            continue
+
+        ratio = r["value"] / b["value"] if b["value"] else 1.0
+        regressed = ratio > 1 + tolerance
+        if regressed:
+            regressions.append(name)
+        print("%-40s %12.2f %-10s %12.2f  %5.2fx%s" % (name, r["value"], r["unit"], b["value"], ratio,
+                                                      "  REGRESSED" if regressed else ""))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks for the Go Redirector")
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark", help="any of: %s (default all)" % ", ".join(benchmarks))
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against the results in this file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="slowdown allowed before a regression")
+    load = parser.add_argument_group("load", "options for the load benchmark")
+    load.add_argument("--clients", type=int, default=16, help="concurrent clients making reads")
+    load.add_argument("--seconds", type=int, default=10, help="how long to run")
+    load.add_argument("--threads", type=int, default=10, help="server.thread_pool")
+    load.add_argument("--edits", type=float, default=2.0, help="edits per second through _modify_ (0 for none)")
+    load.add_argument("--checkpoint", type=int, default=60, help="seconds between checkpoints")
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in benchmarks:
+            parser.error("unknown benchmark %r" % name)
+
+    results = {}
+    for name in args.benchmarks or benchmarks:
+        bench = benchmarks[name]
+        if bench is benchLoad:
+            bench = functools.partial(bench, clients=args.clients, seconds=args.seconds, threads=args.threads,
+                                      edits=args.edits, checkpoint=args.checkpoint)
+
+        print("== %s" % name)
+        for metric, (value, unit) in bench().items():
+            results["%s/%s" % (name, metric)] = {"value": value, "unit": unit}
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                       "results": results}, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        print("== compared to %s" % args.baseline)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("%d regressed by more than %d%%: %s" % (len(regressions), args.tolerance * 100,
+                                                         ", ".join(regressions)))
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,11 +1,30 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import collections
+import contextlib
+import copyreg
 import datetime
+import http.server
+import io
+import itertools
+import json
+import marshal
+import os
+import pickle
+import random
+import shutil
+import string
+import sys
+import tempfile
+import threading
 import unittest
 import time
 
+import cherrypy
+
 import go
+import go_bench
 
 
 class GeneralTestCases(unittest.TestCase):
@@ -231,5 +250,1154 @@ class LinkTestCases(unittest.TestCase):
         link = go.Link(url='example.com', title='example site')
         self.assertEqual('', link.usage())
 
+class UrlTemplateTestCases(unittest.TestCase):
+    def vformat(self, url, args, d):
+        d = dict(d)
+        while True:
+            try:
+                return string.Formatter().vformat(url, args, d)
+            except KeyError as e:
+                d[e.args[0]] = "{%s}" % e.args[0]
+            except IndexError:
+                return None
+
+    def test_same_as_vformat(self):
+        d = {'*': 'rest/of/path', '0': 'kw', 'project': 'go', 'n': 5}
+        for url in ['http://example.com/', 'http://example.com/{*}', 'http://x/{0}/{1}?q={2}',
+                    'http://x/{}/{}', 'http://x/{project}/{missing}/{1}', 'http://x/{{literal}}/{project}',
+                    'http://x/{project!r}', 'http://x/{n:03d}', 'http://x/{missing:>8}', 'http://x/{0.upper}']:
+            for args in [('a', 'b', None), ['a'], []]:
+                self.assertEqual(self.vformat(url, args, d), go.UrlTemplate(url).fill(args, [d]), url)
+
+    def test_scopes_in_order(self):
+        self.assertEqual('http://x/a/2', go.UrlTemplate('http://x/{a}/{b}').fill((), [{'a': 'a'}, {'a': 1, 'b': 2}]))
+
+    def test_changed_url_is_recompiled(self):
+        go.g_db = go.LinkDatabase()
+        link = go.g_db.addLink(['x'], 'http://example.com/{0}', 'X', 'xavier')
+        self.assertEqual('http://example.com/y', link.url(args=['y']))
+        go.g_db.editLink(link, 'http://example.com/z/{0}', 'X', ['x'], 'xavier')
+        self.assertEqual('http://example.com/z/y', link.url(args=['y']))
+        self.assertNotIn('_template', link.__getstate__())
+
+
+class ClickableTestCases(unittest.TestCase):
+    def setUp(self):
+        self._today = go.today
+
+    def tearDown(self):
+        go.today = self._today
+
+    def test_totals_follow_clicks_and_rolloff(self):
+        link = go.Link(url='example.com', title='example site')
+        go.today = lambda: 1000
+        link.clicked(3)
+        go.today = lambda: 1010
+        link.clicked()
+        self.assertEqual((4, 4, 1010), (link.recentClicks, link.totalClicks, link.lastClickDay))
+
+        # first click of a day more than 30 days later archives the older clicks
+        go.today = lambda: 1035
+        link.clicked(2)
+        self.assertEqual((3, 6, 1035), (link.recentClicks, link.totalClicks, link.lastClickDay))
+        self.assertTrue(link.clicksConsistent())
+
+    def test_import_recounts(self):
+        link = go.Link(url='example.com', title='example site')
+        go.Clickable._import(link, '7,{737000:2,737005:3}')
+        self.assertEqual((5, 12, 737005), (link.recentClicks, link.totalClicks, link.lastClickDay))
+        self.assertTrue(link.clicksConsistent())
+
+    def test_history_is_bounded(self):
+        link = go.Link(url='example.com', title='example site')
+        for day in range(737000, 737100):
+            link.clicked(2, day)
+        link.clicked(5, 737000)  # too old for the window; archived straight away
+        self.assertEqual((60, 205, 737099), (link.recentClicks, link.totalClicks, link.lastClickDay))
+        self.assertEqual(30, len(link.dayClicks))
+        self.assertEqual(list(range(737070, 737100)), sorted(link.clickData))
+
+        copy = go.Clickable._import(go.Link(), go.Clickable._export(link))
+        self.assertEqual((link.archivedClicks, link.clickData), (copy.archivedClicks, copy.clickData))
+
+    def test_old_click_data_is_windowed(self):
+        link = go.Link(url='example.com', title='example site')
+        link.__setstate__({'archivedClicks': 1, 'clickData': {737000: 2, 737030: 3}})
+        self.assertEqual((3, 6, 737030), (link.recentClicks, link.totalClicks, link.lastClickDay))
+
+    def test_dict_pickles_are_migrated(self):
+        class OldLink:  # pickles like Link did before it had __slots__
+            def __reduce_ex__(self, protocol):
+                return (copyreg._reconstructor, (go.Link, object, None),
+                        {'archivedClicks': 1, 'clickData': {737000: 2}, 'linkid': 7, '_url': 'http://example.com/',
+                         'title': 'T', 'edits': [(1.0, 'alice')], 'lists': [], 'retired': True})
+
+        link = pickle.loads(pickle.dumps(OldLink()))
+        self.assertEqual((7, 'http://example.com/', 3), (link.linkid, link.url(), link.totalClicks))
+        self.assertIs(sys.intern('alice'), link.edits[0][1])
+        self.assertFalse(hasattr(link, '__dict__'))
+
+    def test_inconsistent_totals_are_recounted(self):
+        link = go.Link(url='example.com', title='example site')
+        link.clicked()
+        link._recentClicks = 4
+        self.assertFalse(link.clicksConsistent())
+        link.recountClicks()
+        self.assertTrue(link.clicksConsistent())
+
+
+class ClickRankingTestCases(unittest.TestCase):
+    def setUp(self):
+        go.g_db = go.LinkDatabase()
+        self._today = go.today
+
+    def tearDown(self):
+        go.today = self._today
+
+    def test_rankings_match_byclicks(self):
+        rnd = random.Random(42)
+        links = [go.g_db.addLink(['kw%d' % (i % 3), 'all'], 'http://example.com/%d' % i, '') for i in range(30)]
+
+        for day in range(1000, 1060, 3):
+            go.today = lambda: day
+            for _ in range(20):
+                rnd.choice(links).clicked(rnd.randint(1, 3))
+            link = rnd.choice(links)
+            go.g_db.getList('all').removeLink(link)
+            go.g_db.getList('all').addLink(link)
+
+            for LL in go.g_db.lists.values():
+                self.assertEqual(go.byClicks(LL.links), LL.getPopularLinks())
+            self.assertEqual(go.byClicks(go.g_db.getNonFolders()), go.g_db.getTopLinks())
+            self.assertEqual(go.byClicks(go.g_db.lists.values()), go.g_db.getAllLists())
+
+        self.assertEqual(go.byClicks(go.g_db.getNonFolders())[:5], go.g_db.getTopLinks(5))
+
+    def test_deleted_links_leave_rankings(self):
+        link = go.g_db.addLink(['a', 'b'], 'http://example.com/', '')
+        go.g_db.addLink(['b'], 'http://example.com/2', '')
+        go.g_db.deleteLink(link)
+
+        self.assertNotIn(link, go.g_db.ranking)
+        self.assertNotIn(link, go.g_db.getList('b').ranking)
+        self.assertNotIn('a', [LL.name for LL in go.g_db.getAllLists()])
+
+    def test_rankings_rebuilt_after_unpickling(self):
+        go.g_db.addLink(['a'], 'http://example.com/', '').clicked()
+        go.g_db.addLink(['a'], 'http://example.com/2', '')
+        db = pickle.loads(pickle.dumps(go.g_db))
+
+        self.assertEqual(2, len(go.ListOfLinks.ranking.__get__(db.lists['a'])))  # built, not lazily
+        self.assertEqual(['http://example.com/', 'http://example.com/2'],
+                         [L._url for L in db.lists['a'].getPopularLinks()])
+        self.assertEqual(2, len(db.ranking))
+
+
+class FolderIndexTestCases(unittest.TestCase):
+    def setUp(self):
+        go.g_db = go.LinkDatabase()
+
+    def assertIndexed(self, db):
+        links = db.linksById.values()
+        self.assertEqual({L for L in links if L.isGenerative()}, set(db.getFolders()))
+        self.assertEqual({L for L in links if not L.isGenerative()}, set(db.getNonFolders()))
+
+    def test_indexes_follow_edits(self):
+        a = go.g_db.addLink(['a'], 'http://example.com/a', '')
+        b = go.g_db.addLink(['b/'], 'http://example.com/{*}', '')
+        c = go.g_db.addLink(['c', 'd/'], 'http://example.com/c', '')
+        go.g_db.addRegexList('x(.*)', 'http://example.com/x{0}')
+        self.assertIndexed(go.g_db)
+        self.assertEqual([a], go.g_db.getNonFolders())
+
+        go.g_db.editLink(c, 'http://example.com/c', '', ['c'], 'alice')
+        go.g_db.editLink(a, 'http://example.com/{*}', '', ['a'], 'alice')  # moves to 'a/'
+        self.assertIndexed(go.g_db)
+        self.assertEqual({a, b}, set(go.g_db.getSpecialLinks()))
+
+        go.g_db.deleteLink(b)
+        go.g_db.deleteList(go.g_db.lists['c'])
+        self.assertIndexed(go.g_db)
+        self.assertEqual([c], go.g_db.getNonFolders())
+        self.assertIs(c, go.g_db.nonFolders.choice())
+
+        self.assertIndexed(pickle.loads(pickle.dumps(go.g_db)))
+
+    def test_rename_to_and_from_a_folder(self):
+        link = go.g_db.addLink(['foo'], 'http://example.com/{*}', '')
+        self.assertEqual([], go.g_db.getFolders())
+
+        go.g_db.renameList(go.g_db.lists['foo'], 'foo/')
+        self.assertIndexed(go.g_db)
+        self.assertEqual([link], go.g_db.getFolders())
+
+        go.g_db.renameList(go.g_db.lists['foo/'], 'foo')
+        self.assertIndexed(go.g_db)
+        self.assertEqual([link], go.g_db.getNonFolders())
+
+    def test_random_link_has_a_keyword(self):
+        go.g_db.addLink(['a'], 'http://example.com/a', '')
+        go.g_db.addLink(['b/'], 'http://example.com/{*}', '')
+        for _ in range(20):
+            self.assertEqual('http://example.com/a', go.randomlink()._url)
+
+
+class DirectTargetTestCases(unittest.TestCase):
+    def setUp(self):
+        go.g_db = go.LinkDatabase()
+
+    def assertIndexed(self, db):
+        for link in db.linksById.values():
+            direct = [LL for LL in link.lists if LL.goesDirectlyTo(link)]
+            self.assertIs(direct and go.byClicks(direct)[0] or None, link.mainKeyword(), link)
+
+    def test_main_keywords_follow_changes(self):
+        rnd = random.Random(7)
+        links = [go.g_db.addLink(['kw%d' % (i % 4), 'k%d' % i], 'http://example.com/%d' % i, '') for i in range(12)]
+        for _ in range(200):
+            op = rnd.randrange(5)
+            link = rnd.choice(links)
+            if op == 0:
+                go.g_db.setBehavior(rnd.choice(list(go.g_db.lists.values())),
+                                    rnd.choice(['top', 'freshest', 'list', 'random', str(link.linkid)]))
+            elif op == 1:
+                go.g_db.editLink(link, link._url, '', rnd.sample(['kw0', 'kw1', 'kw2', 'kw3', 'k%d' % link.linkid],
+                                                                 rnd.randint(1, 3)), 'alice')
+            elif op == 2:
+                link.clicked(rnd.randint(1, 3))
+            else:
+                rnd.choice(list(go.g_db.lists.values())).clicked()
+            self.assertIndexed(go.g_db)
+
+        go.g_db = pickle.loads(pickle.dumps(go.g_db))
+        self.assertIndexed(go.g_db)
+
+    def test_deleted_links_are_dropped(self):
+        a = go.g_db.addLink(['a'], 'http://example.com/a', '')
+        b = go.g_db.addLink(['a'], 'http://example.com/b', '')
+        self.assertIs(go.g_db.lists['a'], b.mainKeyword())
+        self.assertIsNone(a.mainKeyword())
+
+        go.g_db.deleteLink(b)
+        self.assertIs(go.g_db.lists['a'], a.mainKeyword())
+        self.assertNotIn(b, go.g_db.directLists)
+        self.assertNotIn(b, go.g_db.mainKeywords)
+
+
+class SearchTestCases(unittest.TestCase):
+    def setUp(self):
+        go.g_db = go.LinkDatabase()
+        self.wiki = go.g_db.addLink(['wiki', 'docs'], 'http://wiki.example.com/Main_Page', 'Team wiki')
+        self.jira = go.g_db.addLink(['jira'], 'http://jira.example.com/', 'Issue tracker')
+        self.jira.clicked(5)
+
+    def test_matches_names_titles_and_urls(self):
+        self.assertEqual(([go.g_db.lists['wiki']], [self.wiki]), go.g_db.search('wik'))
+        self.assertEqual(([], [self.jira]), go.g_db.search('tracker'))
+        self.assertEqual(([], [self.wiki]), go.g_db.search('main page'))
+        self.assertEqual(([], [self.jira, self.wiki]), go.g_db.search('example.com'))  # by clicks
+        self.assertEqual(([go.g_db.lists['docs']], []), go.g_db.search('do'))  # short: word prefix
+        self.assertEqual(([], []), go.g_db.search('ki'))
+        self.assertEqual(([], []), go.g_db.search('w'))
+
+    def test_follows_edits(self):
+        go.g_db.search('wiki')
+        go.g_db.editLink(self.wiki, 'http://confluence.example.com/', 'Team pages', ['pages'], 'alice')
+        self.assertEqual(([], []), go.g_db.search('wiki'))
+        self.assertEqual(([go.g_db.lists['pages']], [self.wiki]), go.g_db.search('pages'))
+
+        go.g_db.deleteLink(self.jira)
+        self.assertEqual(([], []), go.g_db.search('jira'))
+
+    def test_endpoint(self):
+        results = go.Root()._search_('wiki', n='5')
+        self.assertEqual(['wiki'], [x['keyword'] for x in results['lists']])
+        with self.assertRaises(cherrypy.HTTPError) as cm:
+            go.Root()._search_('wiki', n='five')
+        self.assertEqual(400, cm.exception.status)
+
+    def test_stale_postings_are_rebuilt(self):
+        index = go.SearchIndex()
+        for i in range(10):
+            index.add('item', 'text number %d' % i)
+        self.assertEqual(['item'], index.search('number 9'))
+        self.assertEqual([], index.search('number 8'))
+
+        index.add('other', 'other text')
+        index.stale = 10 ** 6
+        index.remove('item')
+        self.assertEqual(0, index.stale)
+        self.assertEqual(['other'], index.search('text'))
+        self.assertEqual(1, len(index.postings['ext']))  # item's postings are gone
+
+
+class SuggestionTestCases(unittest.TestCase):
+    def setUp(self):
+        go.g_db = go.LinkDatabase()
+        for kw in ['jira', 'jar', 'wiki', 'wikis', 'mail']:
+            go.g_db.addLink([kw], 'http://example.com/%s' % kw, '')
+        go.g_db.addRegexList('jir(.*)', 'http://example.com/{0}')
+
+    def test_nearest_then_most_clicked(self):
+        self.assertEqual(['jira'], [LL.name for LL in go.g_db.suggest('jria')])  # not the regex
+        self.assertEqual(['jar', 'jira'], [LL.name for LL in go.g_db.suggest('jiar')])
+        self.assertEqual(['wiki', 'wikis'], [LL.name for LL in go.g_db.suggest('wikki')])
+        go.g_db.lists['wikis'].clicked()
+        self.assertEqual(['wikis', 'wiki'], [LL.name for LL in go.g_db.suggest('wiks')])
+        self.assertEqual([], go.g_db.suggest('xyz'))
+
+    def test_follows_new_and_deleted_lists(self):
+        self.assertEqual(['mail'], [LL.name for LL in go.g_db.suggest('mial')])
+        go.g_db.addLink(['maul'], 'http://example.com/maul', '')
+        go.g_db.deleteList(go.g_db.lists['mail'])
+        self.assertEqual(['maul'], [LL.name for LL in go.g_db.suggest('mial')])
+
+        go.g_db.renameList(go.g_db.lists['maul'], 'mall')
+        self.assertEqual(['mall'], [LL.name for LL in go.g_db.suggest('mial')])
+        self.assertNotIn('maul', go.g_db.spelling)
+
+    def test_edit_distance(self):
+        index = go.SpellingIndex(['kitten', 'sitting', 'mitten'])
+        self.assertEqual(3, go.editDistance('kitten', 'sitting'))
+        self.assertEqual([(1, 'mitten')], index.search('kitten'))
+        self.assertEqual([(1, 'kitten'), (1, 'mitten')], sorted(index.search('itten')))
+        index.remove('mitten')
+        self.assertEqual([], index.search('mitten', maxdist=0))
+        self.assertEqual({'kitten', 'sitting'}, index.words)
+
+
+class ClickRecorderTestCases(unittest.TestCase):
+    def setUp(self):
+        go.g_db = go.LinkDatabase()
+        self.link = go.g_db.addLink(['a'], 'http://example.com/a', 'A')
+        self.LL = go.g_db.getList('a')
+
+    def test_clicks_apply_immediately_when_not_started(self):
+        recorder = go.ClickRecorder()
+        recorder.click(self.LL, self.link)
+        self.assertEqual((1, 1), (self.LL.totalClicks, self.link.totalClicks))
+
+    def test_batches_are_coalesced(self):
+        recorder = go.ClickRecorder()
+        with go.g_db.lock:  # hold up the worker so all clicks land in one batch
+            recorder.start()
+            for _ in range(50):
+                recorder.click(self.LL, self.link)
+            self.assertEqual(0, self.link.totalClicks)
+        recorder.stop()
+
+        self.assertEqual((50, 50), (self.LL.totalClicks, self.link.totalClicks))
+        self.assertEqual(100, recorder.queued)
+        self.assertLess(recorder.applied, 100)
+        self.assertEqual(0, recorder.stats()['depth'])
+
+    def test_full_queue_drops_clicks(self):
+        recorder = go.ClickRecorder(maxQueued=2, batchSize=1)
+        with go.g_db.lock:
+            recorder.start()
+            for _ in range(100):
+                recorder.click(self.link)
+        recorder.stop()
+
+        self.assertGreaterEqual(recorder.dropped, 97)
+        self.assertEqual(100 - recorder.dropped, self.link.totalClicks)
+
+    def test_counts_clicks_from_many_threads(self):
+        recorder = go.ClickRecorder(maxQueued=100)
+        with go.g_db.lock:  # the queue fills up, so clicks are both queued and dropped
+            recorder.start()
+            threads = [threading.Thread(target=lambda: [recorder.click(self.link) for _ in range(2000)])
+                       for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        recorder.stop()
+
+        stats = recorder.stats()
+        self.assertEqual(16000, stats['queued'] + stats['dropped'])
+        self.assertEqual(stats['queued'], self.link.totalClicks)
+
+
+class ResolutionCacheTestCases(unittest.TestCase):
+    def setUp(self):
+        go.g_db = go.LinkDatabase()
+        self.a = go.g_db.addLink(['x'], 'http://example.com/a', 'A', 'alice')
+        self.b = go.g_db.addLink(['x'], 'http://example.com/{project}', 'B', 'bob')
+        go.g_db.addLink(['y'], 'http://example.com/y', 'Y', 'yves')
+        cherrypy.request.path_info = '/x'
+
+    def resolve(self, keyword):
+        cherrypy.request.path_info = '/' + keyword
+        return go.g_db.resolve(keyword)[2]
+
+    def test_list_as_target(self):
+        outer = go.g_db.getList('outer', create=True)
+        outer.addLink(go.g_db.lists['y'])  # as an import can leave it
+        self.assertEqual('http://example.com/y', go.g_db.resolve('outer', '/outer')[2])
+        self.assertEqual('http://example.com/go', go.g_db.resolve('x', '/x', 'project=go')[2])
+
+    def test_hits_and_misses(self):
+        self.assertEqual('http://example.com/{project}', self.resolve('x'))
+        self.assertEqual('http://example.com/{project}', self.resolve('x'))
+        self.assertIsNone(go.g_db.resolve('nothing'))
+        self.assertEqual({'hits': 1, 'misses': 2}, {k: go.g_db.resolutions.stats()[k] for k in ('hits', 'misses')})
+
+    def test_edits_invalidate(self):
+        self.resolve('x')
+        self.resolve('y')
+        go.g_db.editLink(self.b, 'http://example.com/b', 'B', ['x'], 'bob')
+        self.assertEqual(1, len(go.g_db.resolutions))
+        self.assertEqual('http://example.com/b', self.resolve('x'))
+
+        go.g_db.setBehavior(go.g_db.getList('x'), 'top')
+        self.a.clicked()
+        self.assertEqual('http://example.com/a', self.resolve('x'))
+
+        go.g_db.deleteLink(self.a)
+        self.assertEqual('http://example.com/b', self.resolve('x'))
+
+    def test_renamed_list_stops_resolving(self):
+        self.assertEqual('http://example.com/y', self.resolve('y'))
+        go.g_db.renameList(go.g_db.lists['y'], 'z')
+        self.assertIsNone(go.g_db.resolve('y', '/y'))
+        self.assertEqual('http://example.com/y', self.resolve('z'))
+
+    def test_variables_invalidate_their_users(self):
+        self.resolve('x')
+        self.resolve('y')
+        go.g_db.setVariable('project', 'go')
+        self.assertEqual(1, len(go.g_db.resolutions))
+        self.assertEqual('http://example.com/go', self.resolve('x'))
+
+    def test_top_follows_clicks(self):
+        go.g_db.setBehavior(go.g_db.getList('x'), 'top')
+        self.a.clicked()
+        self.assertEqual('http://example.com/a', self.resolve('x'))
+        self.b.clicked(2)
+        self.assertEqual('http://example.com/{project}', self.resolve('x'))
+        self.a.clicked()
+        self.assertEqual(1, len(go.g_db.resolutions))
+
+    def test_random_is_not_cached(self):
+        go.g_db.setBehavior(go.g_db.getList('x'), 'random')
+        self.resolve('x')
+        self.assertEqual(0, len(go.g_db.resolutions))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = go.ResolutionCache(maxsize=2)
+        x, y = go.g_db.getList('x'), go.g_db.getList('y')
+        cache.put('x1', (x, self.a, 'a'), cache.epoch)
+        cache.put('y1', (y, self.a, 'a'), cache.epoch)
+        cache.get('x1')
+        cache.put('x2', (x, self.b, 'b'), cache.epoch)
+        self.assertEqual(['x1', 'x2'], list(cache.entries))
+
+        stale = cache.epoch
+        cache.invalidate('x')
+        cache.put('x3', (x, self.a, 'a'), stale)
+        self.assertEqual({}, cache.entries)
+
+
+class PageCacheTestCases(unittest.TestCase):
+    def setUp(self):
+        go.g_db = go.LinkDatabase()
+        self.link = go.g_db.addLink(['a'], 'http://example.com/a', 'A', 'alice')
+
+    def test_edits_invalidate(self):
+        cache = go.PageCache()
+        etag = cache.put('a', go.g_db, go.g_db.generation, go.g_db.clickGeneration, 'page')
+        self.assertEqual((etag, 'page'), cache.get('a', go.g_db))
+        self.assertIsNone(cache.get('a', go.LinkDatabase()))
+
+        go.g_db.setVariable('project', 'go')
+        self.assertIsNone(cache.get('a', go.g_db))
+        self.assertNotEqual(etag, cache.put('a', go.g_db, go.g_db.generation, go.g_db.clickGeneration, 'page'))
+
+    def test_clicks_within_staleness(self):
+        fresh, lagging = go.PageCache(), go.PageCache(staleness=60)
+        for cache in fresh, lagging:
+            cache.put('a', go.g_db, go.g_db.generation, go.g_db.clickGeneration, 'page')
+        self.link.clicked()
+
+        self.assertIsNone(fresh.get('a', go.g_db))
+        self.assertEqual('page', lagging.get('a', go.g_db)[1])
+
+
+class FastRedirectsTestCases(unittest.TestCase):
+    def setUp(self):
+        go.g_db = go.LinkDatabase()
+        self.link = go.g_db.addLink(['a', 'a/'], 'http://example.com/{project}/{*}', 'A', 'alice')
+        self.app = go.FastRedirects(lambda environ, start_response: 'fallthrough')
+
+    def get(self, path, method='GET', host=go.cfg_hostname, cookie=''):
+        environ = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'HTTP_HOST': host, 'HTTP_COOKIE': cookie}
+        headers = []
+        ret = self.app(environ, lambda status, h: headers.extend([status] + h))
+        return headers[:2] if headers else ret
+
+    def test_redirects(self):
+        self.assertEqual(['307 Temporary Redirect', ('Location', 'http://example.com/{project}/')], self.get('/a'))
+        self.assertEqual(['307 Temporary Redirect', ('Location', 'http://example.com/go/x/y')],
+                         self.get('/a/x/y', cookie='variables=project=go'))
+        self.assertEqual(['301 Moved Permanently', ('Location', 'http://example.com/{project}/%d' % self.link.linkid)],
+                         self.get('/_link_/%d' % self.link.linkid))  # {*} is the linkid, as in Root._link_
+        self.assertEqual(3, self.link.totalClicks)
+
+    def test_falls_through(self):
+        for path in ['/', '/.a', '/a/', '/toplinks', '/robots.txt', '/nothing', '/_link_/999', '/_edit_/1']:
+            self.assertEqual('fallthrough', self.get(path), path)
+        self.assertEqual('fallthrough', self.get('/a', method='POST'))
+        self.assertEqual('fallthrough', self.get('/a', host='go'))
+        self.assertEqual(0, self.link.totalClicks)
+
+
+class MetricsTestCases(unittest.TestCase):
+    def setUp(self):
+        go.g_db = go.LinkDatabase()
+        go.g_db.addLink(['a'], 'http://example.com/a', 'A', 'alice')
+        self._metrics = go.g_metrics
+        go.g_metrics = go.Metrics()
+
+    def tearDown(self):
+        go.g_metrics = self._metrics
+
+    def test_histograms_are_cumulative(self):
+        for seconds in [0.0001, 0.003, 0.003, 20]:
+            go.g_metrics.observe('default', seconds)
+        lines = go.g_metrics.render(go.g_db).splitlines()
+
+        self.assertIn('go_request_duration_seconds_bucket{handler="default",le="0.0005"} 1', lines)
+        self.assertIn('go_request_duration_seconds_bucket{handler="default",le="0.005"} 3', lines)
+        self.assertIn('go_request_duration_seconds_bucket{handler="default",le="10"} 3', lines)
+        self.assertIn('go_request_duration_seconds_bucket{handler="default",le="+Inf"} 4', lines)
+        self.assertIn('go_request_duration_seconds_count{handler="default"} 4', lines)
+        self.assertIn('go_links 1', lines)
+
+    def test_fast_redirects_are_counted(self):
+        app = go.FastRedirects(lambda environ, start_response: 'fallthrough')
+        app({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/a', 'HTTP_HOST': go.cfg_hostname}, lambda status, h: None)
+        lines = go.g_metrics.render(go.g_db).splitlines()
+
+        self.assertIn('go_request_duration_seconds_count{handler="default"} 1', lines)
+        self.assertIn('go_outcomes_total{outcome="redirect"} 1', lines)
+
+
+class ProfilerTestCases(unittest.TestCase):
+    def setUp(self):
+        self._profiler = go.g_profiler
+        go.g_profiler = go.Profiler(every=3, token='s3cret')
+
+    def tearDown(self):
+        go.g_profiler = self._profiler
+
+    def test_sampling_and_token(self):
+        self.assertEqual([False, False, True, False, False, True], [go.g_profiler.wanted({}) for _ in range(6)])
+        self.assertTrue(go.g_profiler.wanted({'X-Go-Profile': 's3cret'}))
+        self.assertFalse(go.g_profiler.wanted({'X-Go-Profile': 'guess'}))
+        self.assertFalse(go.Profiler().enabled())
+
+    def test_stats_add_up_per_handler(self):
+        handler = go.g_profiler.wrap('special', lambda: go.byClicks([]))
+        for _ in range(2):
+            handler()
+
+        self.assertIn('== special (2 requests)', go.g_profiler.report())
+        self.assertIn('byClicks', go.g_profiler.report('special'))
+        self.assertEqual('', go.g_profiler.report('toplinks'))
+        stats = marshal.loads(go.g_profiler.dump('special'))
+        self.assertEqual(2, [v[0] for k, v in stats.items() if k[2] == 'byClicks'][0])  # calls
+
+        with self.assertRaises(cherrypy.HTTPError):
+            go.Root()._profile_(token='guess')
+        go.Root()._profile_(token='s3cret', reset='1')
+        self.assertIsNone(go.g_profiler.dump('special'))
+
+
+class BenchmarkTestCases(unittest.TestCase):
+    def test_synthetic_database(self):
+        db = go_bench.makeDatabase(200, nregexes=5, folders=0.1, topClicks=1000)
+        self.assertIs(go.g_db, db)
+        self.assertEqual(205, len(db.linksById))
+        self.assertEqual(5, len(db.regexes))
+        self.assertTrue(db.getFolders())
+        self.assertEqual(1000, db.ranking.top(1)[0].totalClicks)
+        self.assertEqual(db.getTopLinks(), go.byClicks(db.getNonFolders()))
+        for kw in go_bench.popularKeywords(db, 10):
+            self.assertTrue(db.resolve(kw, '/' + kw, None))
+        self.assertEqual(1, len(db.matchRegexes('tkt1-42')))
+
+    def test_compare_to_baseline(self):
+        baseline = {'urls/plain': {'value': 1.0, 'unit': 'us'}, 'render/list': {'value': 100.0, 'unit': 'us'}}
+        results = {'urls/plain': {'value': 1.2, 'unit': 'us'}, 'render/list': {'value': 130.0, 'unit': 'us'},
+                   'render/toplinks': {'value': 50.0, 'unit': 'us'}}
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(['render/list'], go_bench.compare(results, baseline, tolerance=0.25))
+
+
+class WorkerTestCases(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmpdir, 'godb.pickle.snapshot')
+        go.g_db = go.LinkDatabase()
+        self.link = go.g_db.addLink(['alpha', 'beta'], 'http://example.com/a', 'A')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_readers_load_published_generations(self):
+        writer, writerDb = go.Snapshots(self.fn), go.g_db
+        self.assertTrue(writer.publish(writerDb))
+        self.assertFalse(writer.publish(writerDb))
+        self.link.clicked()
+        self.assertFalse(writer.publish(writerDb))  # clicks wait for clickEvery
+
+        reader = go.Snapshots(self.fn)
+        go.g_db = go.LinkDatabase()
+        self.assertTrue(reader.refresh())
+        self.assertFalse(reader.refresh())
+        self.assertEqual('http://example.com/a', go.g_db.getList('alpha').links[0]._url)
+        self.assertIs(go.g_db, go.env.globals['g_db'])
+        generation = go.g_db.generation
+
+        writerDb.addLink(['gamma'], 'http://example.com/c', 'C')
+        self.assertTrue(writer.publish(writerDb))
+        self.assertTrue(reader.refresh())
+        self.assertTrue(go.g_db.getList('gamma'))
+        self.assertGreater(go.g_db.generation, generation)
+
+    def test_click_batches_between_processes(self):
+        alpha = go.g_db.getList('alpha')
+        events = [(self.link, 100), (self.link, 100), (alpha, 100), (self.link, 101)]
+        batch = json.loads(json.dumps(go.clickBatch(events)))
+
+        other = pickle.loads(pickle.dumps(go.g_db))
+        otherLink, otherAlpha = other.getLink(self.link.linkid), other.getList('alpha')
+        self.assertEqual({(otherLink, 100): 2, (otherAlpha, 100): 1, (otherLink, 101): 1},
+                         collections.Counter(go.clickEvents(other, batch)))
+
+        other.renameList(otherAlpha, 'gamma')
+        self.assertEqual({(otherLink, 100): 2, (otherLink, 101): 1}, collections.Counter(go.clickEvents(other, batch)))
+
+
+class ForwardTestCases(unittest.TestCase):
+    class Writer(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.server.paths.append(self.path)
+            self.server.secrets.append(self.headers.get('X-Go-Writer'))
+            self.send_response(303)
+            self.send_header('Location', 'http://localhost/done')
+            self.send_header('Set-Cookie', 'a=1; Path=/')
+            self.send_header('Set-Cookie', 'b=2; Path=/')
+            self.send_header('ETag', '"x"')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    def setUp(self):
+        go.useDatabase(go.LinkDatabase())
+        self.writer = http.server.HTTPServer(('127.0.0.1', 0), self.Writer)
+        self.writer.paths, self.writer.secrets = [], []
+        threading.Thread(target=self.writer.serve_forever, daemon=True).start()
+        go.g_writer, go.g_writerSecret = self.writer.server_address, 'secret'
+        cherrypy.config.update({'environment': 'embedded', 'log.screen': False})
+        self.app = cherrypy.tree.mount(go.Root(), '/')
+
+    def tearDown(self):
+        go.g_writer = go.g_writerSecret = None
+        self.writer.shutdown()
+        self.writer.server_close()
+
+    def get(self, path, query=''):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path.encode().decode('latin1'), 'SCRIPT_NAME': '',
+                   'QUERY_STRING': query, 'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+                   'SERVER_PROTOCOL': 'HTTP/1.1', 'HTTP_HOST': go.cfg_hostname, 'REMOTE_ADDR': '127.0.0.1',
+                   'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr,
+                   'wsgi.version': (1, 0), 'wsgi.multithread': True, 'wsgi.multiprocess': False,
+                   'wsgi.run_once': False}
+        response = []
+        b''.join(self.app(environ, lambda status, headers, exc_info=None: response.extend([status, headers])))
+        return response
+
+    def test_relays_the_writers_answer(self):
+        status, headers = self.get('/_delete_/\u00e9')
+        self.assertEqual(['/_delete_/%C3%A9'], self.writer.paths)
+        self.assertEqual(['secret'], self.writer.secrets)
+        self.assertEqual('303 See Other', status)
+        self.assertEqual(['a=1; Path=/', 'b=2; Path=/'], sorted(v for k, v in headers if k == 'Set-Cookie'))
+        self.assertIn(('Etag', '"x"'), headers)
+        self.assertIn(('Cache-Control', 'no-cache'), headers)
+        self.assertNotIn('Connection', [k for k, v in headers])
+
+    def test_writer_answers_only_readers(self):
+        app = go.FromReaders(lambda environ, start_response: start_response('200 OK', []) or [b'edited'])
+        for secret, expected in [(None, '403 Forbidden'), ('guess', '403 Forbidden'), ('\u00e9', '403 Forbidden'),
+                                 ('secret', '200 OK')]:
+            environ = {} if secret is None else {'HTTP_X_GO_WRITER': secret}
+            status = []
+            app(environ, lambda s, headers: status.append(s))
+            self.assertEqual([expected], status, secret)
+
+    def test_cleanup_is_forwarded(self):
+        self.get('/_internal_/check', 'vacwm=true')
+        self.assertEqual(['/_internal_/check?vacwm=true'], self.writer.paths)
+        self.get('/_internal_/check')
+        self.assertEqual(1, len(self.writer.paths))  # only cleaning up is forwarded
+
+
+class MappedTestCases(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmpdir, 'godb.map')
+        go.useDatabase(go.LinkDatabase())
+        self.db = go.g_db
+        self.a = self.db.addLink(['alpha', 'beta'], 'http://example.com/a', 'A', 'alice')
+        self.b = self.db.addLink(['beta'], 'http://example.com/{project}/b', 'B', 'bob')
+        self.db.addLink(['d\\d+'], 'http://example.com/{0}', 'Regex')
+        self.db.addLink(['delta'], 'http://example.com/d', 'D')
+        self.db.setBehavior(self.db.lists['beta'], 'top')
+        self.db.lists['delta']._url = None  # as in older pickles
+        self.db.setVariable('project', 'go')
+        self.b.clicked(3, 1000)
+        self.db.lists['alpha'].clicked(2, 1010)
+        go.MappedDatabase.write(self.db, self.fn)
+        self.mapped = go.MappedDatabase(self.fn)
+
+    def tearDown(self):
+        go.useDatabase(self.db)
+        shutil.rmtree(self.tmpdir)
+
+    def test_lists_and_links(self):
+        for name, LL in self.db.lists.items():
+            M = self.mapped.getList(name)
+            self.assertEqual((type(LL), LL.linkid, LL.name, LL._url), (type(M), M.linkid, M.name, M._url))
+            self.assertEqual([(L.linkid, L._url, L.title, L.lastEdit()) for L in LL.links],
+                             [(L.linkid, L._url, L.title, L.lastEdit()) for L in M.links])
+            self.assertEqual((LL.totalClicks, LL.clickData), (M.totalClicks, M.clickData))
+
+        b = self.mapped.getLink(self.b.linkid)
+        self.assertIs(b, self.mapped.getList('beta').links[0])
+        self.assertEqual(['alpha', 'beta'], sorted(LL.name for LL in self.mapped.getLink(self.a.linkid).lists))
+        self.assertEqual((3, {1000: 3}), (b.totalClicks, b.clickData))
+        self.assertIsNone(self.mapped.getList('gamma'))
+        self.assertIsNone(self.mapped.getLink(999))
+        self.assertRaises(go.InvalidKeyword, self.mapped.getList, '%%%')
+
+    def test_resolve(self):
+        for kw, path in (('alpha', '/alpha'), ('beta/', '/beta/more'), ('d42', '/d42'), ('delta', '/delta'),
+                          ('gamma', '/gamma')):
+            expected = self.db.resolve(kw, path)
+            resolved = self.mapped.resolve(kw, path)
+            self.assertEqual(expected and (expected[0].name, expected[1].linkid, expected[2]),
+                             resolved and (resolved[0].name, resolved[1].linkid, resolved[2]))
+        self.assertEqual('http://example.com/go/b', self.mapped.resolve('beta', '/beta')[2])
+
+    def test_clicks_wait_for_the_full_database(self):
+        go.useDatabase(self.mapped)
+        go.g_clicks.apply([(self.mapped.getLink(self.a.linkid), 1020), (self.mapped.getList('alpha'), 1020)])
+        self.assertEqual(0, self.db.linksById[self.a.linkid].totalClicks)
+
+        go.switchDatabase(self.mapped, self.db)
+        self.assertIs(self.db, go.g_db)
+        self.assertEqual(1, self.a.totalClicks)
+        self.assertEqual(3, self.db.lists['alpha'].totalClicks)
+        self.assertIsNone(self.mapped.pendingClicks)
+
+    def test_queued_clicks_reach_the_loaded_database(self):
+        full = pickle.loads(pickle.dumps(self.db))  # as loadInBackground() loads it, none of the same objects
+        failures = []
+
+        def load():
+            if not failures:
+                failures.append(1)
+                raise IOError("not yet")
+            return full
+
+        saved = go.g_clicks
+        go.g_clicks = recorder = go.ClickRecorder()
+        self.addCleanup(setattr, go, 'g_clicks', saved)
+        go.useDatabase(self.mapped)
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.mapped.lock:  # the clicks stay queued until the switch
+                recorder.start()
+                recorder.click(self.mapped.getLink(self.a.linkid), self.mapped.getList('alpha'))
+                go.loadInBackground(load, retryEvery=0)
+            recorder.stop()
+
+        self.assertEqual([1], failures)
+        self.assertIs(full, go.g_db)
+        self.assertEqual(1, full.getLink(self.a.linkid).totalClicks)
+        self.assertEqual(3, full.lists['alpha'].totalClicks)
+
+    def test_freshness(self):
+        self.assertFalse(go.MappedDatabase.isFresh(os.path.join(self.tmpdir, 'missing.map')))
+        saved = go.cfg_fnDatabase, go.cfg_persistence, go.cfg_fnSqlite
+        go.cfg_fnDatabase, go.cfg_persistence = os.path.join(self.tmpdir, 'godb.pickle'), "pickle"
+        try:
+            self.assertTrue(go.MappedDatabase.isFresh(self.fn))
+            self.db.save(force=True)
+            os.utime(self.fn, (0, 0))
+            self.assertFalse(go.MappedDatabase.isFresh(self.fn))
+
+            go.cfg_persistence = "sqlite"
+            go.cfg_fnSqlite = os.path.join(self.tmpdir, 'godb.sqlite')
+            for fn in (go.cfg_fnSqlite, go.cfg_fnSqlite + '-wal'):
+                open(fn, 'w').close()
+                os.utime(fn, (1, 1))
+            os.utime(self.fn, (2, 2))
+            self.assertTrue(go.MappedDatabase.isFresh(self.fn))
+            os.utime(go.cfg_fnSqlite + '-wal', (3, 3))  # edits not checkpointed into the database file yet
+            self.assertFalse(go.MappedDatabase.isFresh(self.fn))
+        finally:
+            go.cfg_fnDatabase, go.cfg_persistence, go.cfg_fnSqlite = saved
+
+
+class PersistenceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmpdir, 'godb.pickle')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def state(self, db):
+        return ([(L.linkid, L._url, L.title, L.listnames(), L.edits, L.totalClicks) for L in db.linksById.values()],
+                sorted((LL.name, LL._url, LL.totalClicks, [L.linkid for L in LL.links]) for LL in db.lists.values()),
+                db.variables, db._nextlinkid)
+
+    def mutate(self, db):
+        a = db.addLink(['a', 'b'], 'http://example.com/a', 'A', 'alice')
+        b = db.addLink(['b'], 'http://example.com/b', 'B', 'bob')
+        db.addLink(['c'], 'http://example.com/c', 'C', 'carol')
+        db.editLink(b, 'http://example.com/b2', 'B2', ['c', 'd'], 'bob')
+        db.setBehavior(db.lists['c'], 'top')
+        db.setVariable('project', 'go')
+        db.deleteLink(a)
+        b.clicked(3)
+        db.lists['d'].clicked()
+        db.save()
+
+
+class JournalTestCases(PersistenceTestCase):
+    def reopen(self):
+        go.g_db.store.close()
+        if os.path.exists(self.fn):
+            with open(self.fn, 'rb') as f:
+                go.g_db = pickle.load(f)
+        else:
+            go.g_db = go.LinkDatabase()
+        go.g_db.openJournal(self.fn)
+        return go.g_db
+
+    def test_replay_restores_state(self):
+        go.g_db = go.LinkDatabase()
+        go.g_db.openJournal(self.fn)
+        self.mutate(go.g_db)
+        expected = self.state(go.g_db)
+
+        self.assertFalse(os.path.exists(self.fn))
+        self.assertEqual(expected, self.state(self.reopen()))
+
+    def test_failed_mutation_is_saved_by_the_next_checkpoint(self):
+        go.g_db = go.LinkDatabase()
+        go.g_db.openJournal(self.fn)
+        link = go.g_db.addLink(['a'], 'http://example.com/a', 'A', 'alice')
+        with self.assertRaises(ValueError):
+            with go.g_db.mutating():  # changes the link, then fails before anything is journaled
+                go.g_db.editLink(link, 'http://example.com/a2', 'A2', ['a'], 'alice')
+                raise ValueError
+        go.g_db.addLink(['b'], 'http://example.com/b', 'B', 'bob')
+        self.assertTrue(go.g_db.isDirty()[0])
+
+        go.g_db.checkpoint()
+        self.assertFalse(go.g_db.isDirty()[0])
+        expected = self.state(go.g_db)
+        self.assertEqual(expected, self.state(self.reopen()))
+        self.assertEqual('http://example.com/a2', go.g_db.getList('a').links[0]._url)
+
+    def test_replay_after_compaction(self):
+        go.g_db = go.LinkDatabase()
+        go.g_db.openJournal(self.fn)
+        go.g_db.addLink(['x'], 'http://example.com/x', 'X', 'xavier').clicked()
+        go.g_db.compact()
+        self.assertEqual(0, go.g_db.store.nrecords)
+        self.mutate(go.g_db)
+        expected = self.state(go.g_db)
+
+        self.assertEqual(expected, self.state(self.reopen()))
+
+    def test_torn_record_is_ignored(self):
+        go.g_db = go.LinkDatabase()
+        go.g_db.openJournal(self.fn)
+        go.g_db.setVariable('project', 'go')
+        go.g_db.store.fp.write('{"seq": 2, "op": "setvar')
+        go.g_db.store.fp.flush()
+
+        self.assertEqual({'project': 'go'}, self.reopen().variables)
+
+
+class DirtyTrackingTestCases(PersistenceTestCase):
+    def setUp(self):
+        PersistenceTestCase.setUp(self)
+        self._fnDatabase = go.cfg_fnDatabase
+        go.cfg_fnDatabase = self.fn
+        go.g_db = go.LinkDatabase()
+
+    def tearDown(self):
+        go.cfg_fnDatabase = self._fnDatabase
+        PersistenceTestCase.tearDown(self)
+
+    def test_clean_save_is_skipped(self):
+        go.g_db.save()
+        self.assertFalse(os.path.exists(self.fn))
+        self.assertEqual(1, go.g_db.saveStats['skipped'])
+
+        go.g_db.addLink(['a'], 'http://example.com/a', 'A', 'alice')
+        self.assertEqual((True, False), go.g_db.isDirty())
+        go.g_db.save()
+        self.assertEqual(os.path.getsize(self.fn), go.g_db.saveStats['full']['written'])
+
+        go.g_db.checkpoint()
+        self.assertEqual((False, False), go.g_db.isDirty())
+        self.assertEqual(1, go.g_db.saveStats['full']['count'])
+        self.assertEqual(2, go.g_db.saveStats['skipped'])
+
+    def test_clicks_are_saved_separately(self):
+        go.g_db.openJournal(self.fn)
+        link = go.g_db.addLink(['a'], 'http://example.com/a', 'A', 'alice')
+        self.assertEqual((False, False), go.g_db.isDirty())
+        self.assertEqual(1, go.g_db.saveStats['edit']['count'])
+
+        link.clicked()
+        self.assertEqual((False, True), go.g_db.isDirty())
+        go.g_db.checkpoint()
+        go.g_db.checkpoint()
+        self.assertEqual(1, go.g_db.saveStats['clicks']['count'])
+        self.assertEqual(1, go.g_db.saveStats['skipped'])
+        self.assertNotIn('compact', go.g_db.saveStats)
+        go.g_db.store.close()
+
+
+class ConcurrencyTestCases(PersistenceTestCase):
+    def setUp(self):
+        PersistenceTestCase.setUp(self)
+        self._fnDatabase = go.cfg_fnDatabase
+        go.cfg_fnDatabase = self.fn
+        go.g_db = go.LinkDatabase()
+        go.g_db.addLink(['a'], 'http://example.com/a', 'A', 'alice')
+        go.g_db.addRegexList('^bug/(.*)', 'http://bugs.example.com/{1}')
+
+    def tearDown(self):
+        go.cfg_fnDatabase = self._fnDatabase
+        PersistenceTestCase.tearDown(self)
+
+    def test_readers_race_writers(self):
+        errors = []
+        done = threading.Event()
+        urls = itertools.count()
+
+        def loop(fn):
+            def run():
+                rnd = random.Random()
+                try:
+                    while not done.is_set():
+                        fn(rnd)
+                except Exception as e:
+                    errors.append(e)
+                    done.set()
+            return threading.Thread(target=run)
+
+        def read(rnd):
+            LL = go.g_db.getList(rnd.choice('abc'))
+            if LL:
+                LL.getDefaultLink()
+                LL.url(keyword=LL.name)
+                LL.getPopularLinks()
+            go.g_db.matchRegexes('bug/%d' % rnd.randint(0, 9))
+            go.g_db.getTopLinks(5)
+            list(go.g_db.variables.items())
+
+        def write(rnd):
+            link = go.g_db.addLink([rnd.choice('abc')], 'http://example.com/%d' % next(urls), '', 'w')
+            go.g_db.editLink(link, link._url, 'T', [rnd.choice('abc')], 'w')
+            go.g_db.setBehavior(go.g_db.getList(link.listnames()[0]), rnd.choice(['freshest', 'top', 'random']))
+            go.g_db.setVariable('v', str(rnd.random()))
+            if rnd.random() < 0.5:
+                go.g_db.deleteLink(link)
+
+        def click(rnd):
+            LL = go.g_db.getList(rnd.choice('abc'))
+            link = LL and LL.getDefaultLink()
+            if link:
+                recorder.click(LL, link)
+
+        recorder = go.ClickRecorder()
+        recorder.start()
+        threads = [loop(read) for _ in range(4)] + [loop(write), loop(click), loop(lambda rnd: go.g_db.save(force=True))]
+        for t in threads:
+            t.start()
+        time.sleep(1)
+        done.set()
+        for t in threads:
+            t.join()
+        recorder.stop()
+
+        self.assertEqual([], errors)
+        for LL in go.g_db.lists.values():
+            self.assertEqual(sorted(id(L) for L in LL.links), sorted(id(L) for L in LL.ranking))
+        with open(self.fn, 'rb') as f:
+            self.assertEqual(len(pickle.load(f).regexes), 1)
+
+
+class ImportExportTestCases(PersistenceTestCase):
+    def setUp(self):
+        PersistenceTestCase.setUp(self)
+        self._fnDatabase = go.cfg_fnDatabase
+        go.cfg_fnDatabase = self.fn
+        self.fnTerms = os.path.join(self.tmpdir, 'newterms.txt')
+
+    def tearDown(self):
+        go.cfg_fnDatabase = self._fnDatabase
+        PersistenceTestCase.tearDown(self)
+
+    def summary(self, db):
+        return (sorted((L._url, L.title, sorted(L.listnames()), L.totalClicks) for L in db.linksById.values()),
+                sorted((LL.name, LL._url) for LL in db.lists.values()), db.variables)
+
+    def test_round_trip(self):
+        go.g_db = db = go.LinkDatabase()
+        db.addLink(['a', 'b'], 'http://example.com/a', 'A', 'alice').clicked(3)
+        db.addLink(['b'], 'http://example.com/b', 'B', 'bob')
+        db.setBehavior(db.lists['b'], 'top')
+        db.setVariable('project', 'go')
+        db._export(self.fnTerms)
+
+        go.g_db = go.LinkDatabase()
+        self.assertEqual(0, go.g_db._import(self.fnTerms))
+        self.assertEqual(self.summary(db), self.summary(go.g_db))
+        self.assertTrue(os.path.exists(self.fn))
+
+    def test_dry_run_reports_bad_lines(self):
+        with open(self.fnTerms, 'w') as f:
+            f.write('variable project go\nlink http://example.com/a a 0,{} None A\nlink garbage\n')
+        go.g_db = db = go.LinkDatabase()
+
+        self.assertEqual(1, db._import(self.fnTerms, dryRun=True))
+        self.assertIs(db, go.g_db)
+        self.assertEqual(({}, {}), (db.linksById, db.variables))
+        self.assertFalse(os.path.exists(self.fn))
+
+
+class SqliteTestCases(PersistenceTestCase):
+    def setUp(self):
+        PersistenceTestCase.setUp(self)
+        self.fnSqlite = os.path.join(self.tmpdir, 'godb.sqlite')
+        self.saved = go.cfg_fnDatabase, go.cfg_fnSqlite
+        go.cfg_fnDatabase, go.cfg_fnSqlite = self.fn, self.fnSqlite  # save() without a store writes cfg_fnDatabase
+
+    def tearDown(self):
+        go.cfg_fnDatabase, go.cfg_fnSqlite = self.saved
+        PersistenceTestCase.tearDown(self)
+
+    def reopen(self):
+        if go.g_db.store:
+            go.g_db.store.close()
+        go.g_db = go.SqliteStore(self.fnSqlite).load(self.fn)
+        return go.g_db
+
+    def test_rows_restore_state(self):
+        self.reopen()
+        self.mutate(go.g_db)
+        go.g_db.renameList(go.g_db.lists['d'], 'e')
+        regex = go.g_db.addLink([r'bug(\d+)'], 'http://bugs.example.com/{1}', 'bugs', 'dave')
+        expected = self.state(go.g_db)
+
+        db = self.reopen()
+        self.assertEqual(expected, self.state(db))
+        self.assertEqual([regex.linkid], [L.linkid for L in db.getRegex(r'bug(\d+)').links])
+        self.assertEqual(1, len(db.matchRegexes('bug12')))
+
+    def test_migrates_pickle(self):
+        go.g_db = go.LinkDatabase()
+        self.mutate(go.g_db)
+        go.g_db.addLink(['b'], 'http://example.com/e', 'E', 'eve')  # b has two links, newest first
+        with open(self.fn, 'wb') as f:
+            pickle.dump(go.g_db, f)
+        expected = self.state(go.g_db)
+
+        self.assertEqual(expected, self.state(self.reopen()))
+        self.assertEqual(expected, self.state(self.reopen()))
+
+    def test_edit_writes_only_touched_rows(self):
+        self.reopen()
+        link = go.g_db.addLink(['a'], 'http://example.com/a', 'A', 'alice')
+        go.g_db.addLink(['b'], 'http://example.com/b', 'B', 'bob')
+        go.g_db.editLink(link, 'http://example.com/a', 'A', ['c'], 'alice')
+
+        conn = go.g_db.store.conn
+        self.assertEqual([('b', ), ('c', )], conn.execute("SELECT name FROM lists ORDER BY name").fetchall())
+        self.assertEqual(2, conn.execute("SELECT count(*) FROM memberships").fetchone()[0])
+
+
+class RegexDispatchTestCases(unittest.TestCase):
+    def setUp(self):
+        go.g_db = go.LinkDatabase()
+
+    def test_literal_prefix(self):
+        self.assertEqual('jira-', go.literalPrefix(r'JIRA-(\d+)'))
+        self.assertEqual('bug', go.literalPrefix(r'^bugs?/(.*)'))
+        self.assertEqual('', go.literalPrefix(r'(\d+)'))
+        self.assertEqual('', go.literalPrefix(r'abc|def'))
+
+    def test_only_prefix_candidates_are_tried(self):
+        for regex in [r'jira-(\d+)', r'bug(\d+)', r'(\d{5})']:
+            go.g_db.getRegex(regex, create=True)
+
+        self.assertEqual(sorted([r'jira-(\d+)', r'(\d{5})']),
+                         sorted(go.g_db.regexDispatcher.candidates('Jira-12')))
+
+    def test_match_regexes(self):
+        R = go.g_db.getRegex(r'jira-(\d+)', create=True)
+        R._url = None
+        link = go.g_db.addLink([r'jira-(\d+)'], 'https://jira.example.com/browse/JIRA-{1}', 'jira')
+
+        matches = go.g_db.matchRegexes('JIRA-42')
+        self.assertEqual(1, len(matches))
+        self.assertEqual((R, link), matches[0][:2])
+        self.assertEqual('https://jira.example.com/browse/JIRA-42', matches[0][2]._url)
+        self.assertEqual([], go.g_db.matchRegexes('jira-x'))
+
+    def test_deleted_regex_is_not_matched(self):
+        go.g_db.addLink([r'bug(\d+)'], 'https://bugs.example.com/{1}', 'bugs')
+        go.g_db.deleteList(go.g_db.getRegex(r'bug(\d+)'))
+
+        self.assertEqual([], go.g_db.matchRegexes('bug12'))
+        self.assertEqual(0, len(go.g_db.regexDispatcher))
+
+    def test_dispatcher_rebuilt_after_unpickling(self):
+        go.g_db.getRegex(r'bug(\d+)', create=True)
+        db = pickle.loads(pickle.dumps(go.g_db))
+
+        self.assertNotIn('regexDispatcher', go.g_db.__getstate__())
+        self.assertEqual(1, len(db.regexDispatcher))
+
+    def test_adds_copy_the_tables_once(self):
+        regexes = [go.RegexList(i, r'jira%d-(\d+)' % i) for i in range(3)] + [go.RegexList(3, r'(\w+)-bug')]
+        dispatcher = go.RegexDispatcher(regexes)
+        self.assertEqual([regexes[1]], [R for R, m in dispatcher.matches('JIRA1-5')])
+
+        tables = dispatcher._tables
+        with dispatcher.batch():
+            dispatcher.add(go.RegexList(4, r'jira9-(\d+)'))
+            dispatcher.remove(r'jira0-(\d+)')
+            self.assertEqual(3, len(dispatcher))  # the add waits for the end of the batch
+        self.assertEqual([r'jira1-(\d+)', r'jira2-(\d+)', r'jira9-(\d+)'], sorted(dispatcher._tables[2]['j']))
+        self.assertEqual(4, len(tables[0]))  # matching against the old tables is undisturbed
+        self.assertEqual(3, len(tables[2]['j']))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,47 @@
+/**
+ * Keyword autocomplete for the box on the index page, from /_search_.
+ */
+
+(function () {
+    var box = document.getElementById('keyword');
+    var completions = document.getElementById('completions');
+    var pending = null;
+
+    function addOption(value, label, seen) {
+        if (!value || seen[value]) {
+            return;
+        }
+        seen[value] = true;
+        var option = document.createElement('option');
+        option.value = value;
+        option.label = label;
+        completions.appendChild(option);
+    }
+
+    box.oninput = function () {
+        var q = box.value;
+        clearTimeout(pending);
+        if (q.length < 2) {
+            return;
+        }
+        pending = setTimeout(function () {
+            var xhr = new XMLHttpRequest();
+            xhr.open('GET', '/_search_?n=10&q=' + encodeURIComponent(q));
+            xhr.onload = function () {
+                if (xhr.status != 200 || box.value != q) {
+                    return;
+                }
+                var results = JSON.parse(xhr.responseText);
+                var seen = {};
+                completions.innerHTML = '';
+                results.lists.forEach(function (list) {
+                    addOption(list.keyword, list.links + (list.links == 1 ? ' link' : ' links'), seen);
+                });
+                results.links.forEach(function (link) {
+                    addOption(link.keyword, link.title || link.url, seen);
+                });
+            };
+            xhr.send();
+        }, 100);
+    };
+})();